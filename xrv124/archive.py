@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Archive of the results of all QA sessions for trend analysis.
+
+Each session is stored as one .npz file of result arrays (see results.py)
+in a directory per gantry and month of acquisition:
+    ARCHIVE_DIR/Gantry 1/2020-01/2020-01-02T10-11-12.npz
+Queries only open the files of the gantries and months requested and only
+read the requested quantity from them. Results are returned as columns,
+one row per beam.
+
+Sessions are added by run.py. To add existing results directories, or to
+query the archive, e.g. GA 90, 70 MeV, Gantry 3 over the last 24 months:
+    python archive.py --add "path/to/Gantry 3 2020-01-02" ...
+    python archive.py --gantry "Gantry 3" --ga 90 --energy 70 --months 24
+"""
+
+import csv
+import argparse
+from datetime import datetime
+from os import listdir, makedirs, replace
+from os.path import join, isdir, isfile, splitext, dirname
+
+import numpy as np
+
+import config
+from results import BeamResults, SHIFT_FIELDS, DIAMETER_FIELDS, SIGMA_FIELDS, ARC_RADIAL_FIELDS
+
+
+ARCHIVE_DIR = config.ARCHIVE_DIR
+
+# Results of a session and their components
+QUANTITIES = {"shifts":SHIFT_FIELDS, "spot_diameters":DIAMETER_FIELDS,
+              "spot_sigmas":SIGMA_FIELDS, "arc_radial":ARC_RADIAL_FIELDS}
+
+
+
+def session_path(gantry_name, acq_date, acq_time, archive_dir=ARCHIVE_DIR):
+    """Return file of session in archive; acq_date as YYYY-MM-DD and acq_time
+    as hh:mm:ss, zero-padded or not (as from run.get_acquisition_date_time)"""
+    stamp = datetime.strptime(acq_date+" "+acq_time, "%Y-%m-%d %H:%M:%S")
+    return join(archive_dir, gantry_name, stamp.strftime("%Y-%m"),
+                stamp.strftime("%Y-%m-%dT%H-%M-%S")+".npz")
+
+
+
+def session_datetime(filename):
+    """Return acquisition datetime64 of archived session from its file name;
+    ValueError if it is not of the form written by session_path"""
+    stamp = datetime.strptime(splitext(filename)[0], "%Y-%m-%dT%H-%M-%S")
+    return np.datetime64(stamp, "s")
+
+
+
+def partition_month(name):
+    """Return month (datetime64) of archive folder of form YYYY-MM; ValueError
+    if it is not"""
+    return np.datetime64( datetime.strptime(name, "%Y-%m"), "M" )
+
+
+
+def append_session(gantry_name, acq_date, acq_time, results, archive_dir=ARCHIVE_DIR):
+    """Add session to archive, replacing any earlier analysis of it
+
+    results is a dict of BeamResults, e.g. {"shifts":..., "spot_sigmas":...}
+    """
+    filename = session_path(gantry_name, acq_date, acq_time, archive_dir)
+    makedirs( dirname(filename), exist_ok=True )
+
+    first = next( iter(results.values()) )
+    arrays = {"gantry_angles":np.array(first.gantry_angles),
+              "energies":np.array(first.energies)}
+    for name,res in results.items():
+        arrays[name] = res.values
+        arrays[name+"_fields"] = np.array(res.fields)
+
+    # Write to temporary file first so a crash never leaves a bad session
+    with open(filename+".tmp","wb") as f:
+        np.savez(f, **arrays)
+    replace(filename+".tmp", filename)
+    return filename
+
+
+
+def add_results_directory(result_dir, archive_dir=ARCHIVE_DIR):
+    """Add session from results directory written by run.py
+
+    Gantry and acquisition date/time are read from db_results.csv
+    """
+    with open(join(result_dir,"db_results.csv")) as f:
+        row = next( csv.DictReader(f) )
+    acq_date, acq_time = row["ADate"].split()
+
+    results = {}
+    for name,fields in QUANTITIES.items():
+        resultsfile = join(result_dir, "results_{}.txt".format(name))
+        if isfile(resultsfile):
+            results[name] = BeamResults.from_json(resultsfile, fields)
+    return append_session(row["MachineName"], acq_date, acq_time, results, archive_dir)
+
+
+
+def to_datetime64(d):
+    """Date as "YYYY-MM-DD[ hh:mm:ss]", datetime or datetime64; None passes"""
+    if d is None:
+        return None
+    if isinstance(d, str):
+        d = d.replace(" ","T")
+    return np.datetime64(d, "s")
+
+
+
+def session_files(gantry=None, start=None, end=None, archive_dir=ARCHIVE_DIR):
+    """Return (gantry, datetime64, file) of archived sessions in time order,
+    opening only the partitions of the gantry and months requested"""
+    start, end = to_datetime64(start), to_datetime64(end)
+    if not isdir(archive_dir):
+        return []
+    gantries = [gantry] if gantry is not None else sorted(listdir(archive_dir))
+
+    sessions = []
+    for g in gantries:
+        gdir = join(archive_dir, g)
+        if not isdir(gdir):
+            continue
+        for month in sorted(listdir(gdir)):
+            try:
+                m = partition_month(month)
+            except ValueError:
+                # Not a partition of the archive
+                continue
+            if not isdir(join(gdir,month)):
+                continue
+            if (start is not None and m < start.astype("datetime64[M]")) or \
+               (end is not None and m > end.astype("datetime64[M]")):
+                continue
+            for f in sorted(listdir(join(gdir,month))):
+                if splitext(f)[1]!=".npz":
+                    continue
+                try:
+                    dt = session_datetime(f)
+                except ValueError:
+                    continue
+                if (start is None or dt>=start) and (end is None or dt<=end):
+                    sessions.append( (g, dt, join(gdir,month,f)) )
+    return sorted(sessions, key=lambda s: s[1])
+
+
+
+def query(quantity="shifts", gantry=None, ga=None, energy=None, start=None,
+          end=None, archive_dir=ARCHIVE_DIR):
+    """Return archived results matching query as columns
+
+    Returns dict of arrays with one row per beam: "gantry", "datetime",
+    "ga", "energy" and "values" of shape (n, k), plus "fields". Any of
+    gantry, ga, energy, start and end may be None to select all.
+    """
+    gantries, dates, gas, ens, values = [], [], [], [], []
+    fields = ()
+    for g, dt, filename in session_files(gantry, start, end, archive_dir):
+        with np.load(filename) as npz:
+            if quantity not in npz.files:
+                continue
+            session_gas = npz["gantry_angles"]
+            session_ens = npz["energies"]
+            # Only the selected GAs and energies
+            i = np.flatnonzero( session_gas==ga ) if ga is not None else np.arange(len(session_gas))
+            j = np.flatnonzero( session_ens==energy ) if energy is not None else np.arange(len(session_ens))
+            if len(i)==0 or len(j)==0:
+                continue
+            v = npz[quantity][np.ix_(i,j)]
+            fields = tuple( npz[quantity+"_fields"].tolist() )
+        n = len(i)*len(j)
+        gantries += [g]*n
+        dates.append( np.full(n, dt) )
+        gas.append( np.repeat(session_gas[i], len(j)) )
+        ens.append( np.tile(session_ens[j], len(i)) )
+        values.append( v.reshape(n, -1) )
+
+    if len(values)==0:
+        return {"gantry":np.array([],dtype=str), "datetime":np.array([],dtype="datetime64[s]"),
+                "ga":np.array([],dtype=int), "energy":np.array([],dtype=int),
+                "values":np.zeros([0,0]), "fields":fields}
+    return {"gantry":np.array(gantries), "datetime":np.concatenate(dates),
+            "ga":np.concatenate(gas), "energy":np.concatenate(ens),
+            "values":np.concatenate(values), "fields":fields}
+
+
+
+def months_ago(months):
+    """Return datetime64 of start of month, months ago"""
+    return ( np.datetime64("today","M") - months ).astype("datetime64[s]")
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive of XRV-124 QA results")
+    parser.add_argument("--add", nargs="+", metavar="RESULTDIR", help="add results directories written by run.py")
+    parser.add_argument("--quantity", default="shifts", choices=list(QUANTITIES), help="results to query (default: %(default)s)")
+    parser.add_argument("--gantry", help="gantry name, e.g. \"Gantry 3\"")
+    parser.add_argument("--ga", type=int, help="gantry angle")
+    parser.add_argument("--energy", type=int, help="energy (MeV)")
+    parser.add_argument("--start", help="first date, YYYY-MM-DD")
+    parser.add_argument("--end", help="last date, YYYY-MM-DD")
+    parser.add_argument("--months", type=int, help="last N months (instead of --start)")
+    parser.add_argument("--csv", help="write query results to csv file")
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR, help="archive location (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.add:
+        for result_dir in args.add:
+            print("Added {}".format( add_results_directory(result_dir, args.archive_dir) ))
+        return
+
+    start = months_ago(args.months) if args.months is not None else args.start
+    res = query(args.quantity, args.gantry, args.ga, args.energy, start, args.end, args.archive_dir)
+
+    header = ["Gantry","ADate","GA","Energy"] + list(res["fields"])
+    rows = [ [g, str(dt).replace("T"," "), ga, en] + list(v) for g,dt,ga,en,v in
+             zip(res["gantry"], res["datetime"], res["ga"].tolist(), res["energy"].tolist(), res["values"].tolist()) ]
+    if args.csv:
+        with open(args.csv,"w",newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+    else:
+        print( ",".join(header) )
+        for row in rows:
+            print( ",".join(str(e) for e in row) )
+    print("{} beams from {} sessions".format(len(rows), len(set(zip(res["gantry"].tolist(), res["datetime"].tolist())))))
+
+
+
+if __name__=="__main__":
+    main()
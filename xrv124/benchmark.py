@@ -0,0 +1,629 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the slow steps of the XRV-124 analysis. Each benchmark
+checks the results of the current method against the previous one and
+prints the time per call. The import time of the entry scripts is checked
+against STARTUP_BUDGET.
+
+Usage: python benchmark.py [datadir]
+If no directory of Logos spot files is given synthetic data is used.
+
+Stage timings of whole synthetic sessions (see synthetic.py), checked
+against the injected results:
+    python benchmark.py stages [1 4 16]
+
+Memory of each stage of a synthetic session, checked against MEMORY_BUDGETS:
+    python benchmark.py memory
+
+Per-beam analysis on worker processes of images in memory, in an image cube
+file and in shared memory:
+    python benchmark.py cube [workers]
+"""
+
+import io
+import sys
+import pickle
+import time
+import tempfile
+import subprocess
+from datetime import datetime
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from os import listdir
+from os.path import join, splitext, dirname, abspath
+
+import numpy as np
+
+import full_analyze as xan
+import archive
+import database as db
+import image_cube
+import memprofile
+import run
+import synthetic
+import timing
+from results import BeamResults
+
+
+
+def best_time(func, *args, repeat=5):
+    """Return best wall time (s) of repeat calls of func(*args)"""
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        times.append( time.perf_counter()-t0 )
+    return min(times)
+
+
+
+def write_test_spotfile(filename, nrows=600, ncols=600, pitch=0.1):
+    """Write a Logos-style spot file containing a Gaussian spot"""
+    yy,xx = np.mgrid[0:nrows,0:ncols]
+    sigma = min(nrows,ncols)/10.0
+    img = 220*np.exp( -((xx-ncols/2)**2+(yy-nrows/2)**2)/(2*sigma**2) )
+    with open(filename,"w") as f:
+        f.write("Diameter:,{:.2f},mm,Pitch:,{},mm\n".format(2.355*sigma*pitch, pitch))
+        f.write("Synthetic spot\n")
+        f.write("Size,{},{}\n".format(nrows,ncols))
+        for row in np.round(img).astype(int):
+            f.write( ",".join(str(v) for v in row)+"\n" )
+
+
+
+def rowwise_get_image_data(filename):
+    """Original row-by-row parser of get_image_data, for reference"""
+    spotdata = open(filename).readlines()
+    pitch = float( spotdata[0].split("Pitch:,")[1].split(",")[0].strip() )
+    nrows = int( spotdata[2].split(",")[1].strip() )
+    ncols = int( spotdata[2].split(",")[2].strip() )
+    spotimage = np.zeros( [nrows,ncols] )
+    for row in range(3,nrows+3):
+        spotimage[row-3] = np.array( spotdata[row].split(",") ).astype(float)
+    return spotimage, pitch
+
+
+
+def bench_get_image_data(spotfile, repeat=10):
+    """Compare bulk parser of get_image_data with row-by-row version (which
+    gives float64 images)"""
+
+    img_old, pitch_old = rowwise_get_image_data(spotfile)
+    img_new, pitch_new = xan.get_image_data(spotfile)
+    identical = pitch_old==pitch_new and np.array_equal(img_old,img_new)
+
+    t_old = best_time(rowwise_get_image_data, spotfile, repeat=repeat)
+    t_new = best_time(xan.get_image_data, spotfile, repeat=repeat)
+
+    print("get_image_data, {} image:".format(img_new.shape))
+    print("    identical results: {}".format(identical))
+    print("    row-by-row = {} {:.2f} MB, bulk = {} {:.2f} MB".format(img_old.dtype, img_old.nbytes/1e6,
+                                                                 img_new.dtype, img_new.nbytes/1e6) )
+    print("    row-by-row = {:.2f} ms, bulk = {:.2f} ms, speed-up = {:.1f}x".format(
+                                        1000*t_old, 1000*t_new, t_old/t_new) )
+    return identical
+
+
+
+def regionprops_centroid(img, threshold):
+    """Original regionprops-based get_centroid_of_largest_region, for
+    reference; returns rounded and unrounded (x,y) centroids"""
+    from skimage.measure import label, regionprops
+    thresh = (img / img.max()) > (threshold/100.0)
+    props = regionprops( label(thresh, connectivity=thresh.ndim) )
+    largest_diam = -999
+    largest_index = -1        
+    for i,p in enumerate(props):
+        if p.equivalent_diameter>largest_diam:
+            largest_diam = p.equivalent_diameter
+            largest_index = i
+    c = props[largest_index].centroid
+    return [ int(round(c[1],0)), int(round(c[0],0)) ], [ c[1], c[0] ]
+
+
+
+def bench_centroids(images, threshold=50.0):
+    """Compare centroid engine with regionprops on list of images"""
+
+    identical = True
+    maxdiff = 0
+    for img in images:
+        old, old_sub = regionprops_centroid(img, threshold)
+        new = xan.get_centroid_of_largest_region(img, threshold)
+        new_sub = xan.get_centroid_of_largest_region(img, threshold, subpixel=True)
+        identical = identical and old==new
+        maxdiff = max( maxdiff, abs(old_sub[0]-new_sub[0]), abs(old_sub[1]-new_sub[1]) )
+
+    t0 = time.perf_counter()
+    for img in images:
+        regionprops_centroid(img, threshold)
+    t_old = time.perf_counter()-t0
+    t0 = time.perf_counter()
+    for img in images:
+        xan.get_centroid_of_largest_region(img, threshold)
+    t_new = time.perf_counter()-t0
+    t0 = time.perf_counter()
+    for img in images:
+        xan.get_centroid_of_largest_region(img, threshold, weighted=True, subpixel=True)
+    t_wtd = time.perf_counter()-t0
+
+    n = len(images)
+    print("Centroid of largest region, {} images:".format(n))
+    print("    identical results: {}, max sub-pixel difference = {:.1e} pixels".format(identical, maxdiff))
+    print("    regionprops = {:.2f} ms, engine = {:.2f} ms, speed-up = {:.1f}x".format(
+                                    1000*t_old/n, 1000*t_new/n, t_old/t_new) )
+    print("    intensity-weighted sub-pixel = {:.2f} ms".format(1000*t_wtd/n) )
+    return identical
+
+
+
+def bench_beam_shift(records):
+    """Compare beam_shift on whole image and on region around spot"""
+
+    use_roi = xan.USE_ROI
+    results = {}
+    times = {}
+    for roi in (False,True):
+        xan.USE_ROI = roi
+        t0 = time.perf_counter()
+        results[roi] = [ xan.beam_shift(r) for r in records ]
+        times[roi] = time.perf_counter()-t0
+    xan.USE_ROI = use_roi
+
+    area = np.mean( [ xan.spot_roi(r.entry)[0].stop - xan.spot_roi(r.entry)[0].start for r in records ] ) * \
+           np.mean( [ xan.spot_roi(r.entry)[1].stop - xan.spot_roi(r.entry)[1].start for r in records ] )
+    n = len(records)
+    print("Spot shifts (3 centroids per beam), {} beams:".format(n))
+    print("    identical results: {}, ROI ~{:.0%} of image".format(
+                            results[False]==results[True], area/records[0].entry.size) )
+    print("    whole image = {:.2f} ms, ROI = {:.2f} ms per beam, speed-up = {:.1f}x".format(
+                            1000*times[False]/n, 1000*times[True]/n, times[False]/times[True]) )
+    return results[False]==results[True]
+
+
+
+def synthetic_images(n=20, size=600, seed=1):
+    """Return list of entry-exit style images: Gaussian spot, darker shadow"""
+    rng = np.random.default_rng(seed)
+    yy,xx = np.mgrid[0:size,0:size]
+    images = []
+    for i in range(n):
+        cx, cy = size/2+rng.normal(0,5,2)
+        sigma = rng.uniform(30,70)
+        img = 220*np.exp( -((xx-cx)**2+(yy-cy)**2)/(2*sigma**2) )
+        img += rng.normal(0,1.0,img.shape)
+        images.append( np.round(img).clip(0,255) )
+    return images
+
+
+
+def synthetic_profiles(n=100, length=560, pitch=0.1, seed=1):
+    """Return list of noisy Gaussian profiles with sigma 2.5-8 mm"""
+    rng = np.random.default_rng(seed)
+    x = np.arange(length)*pitch
+    profiles = []
+    for i in range(n):
+        sigma = rng.uniform(2.5,8.0)
+        x0 = x[length//2] + rng.normal(0,1.0)
+        p = 220*np.exp(-(x-x0)**2/(2*sigma**2)) + rng.normal(0,1.0,length)
+        profiles.append(p)
+    return profiles
+
+
+
+def entry_spot_profiles(directory):
+    """Return x and y entry spot profiles of all beams in directory, plus pitch"""
+    beams = [splitext(f)[0] for f in listdir(directory) 
+             if splitext(f)[1]==".csv" and str.isdigit(splitext(f)[0])]
+    profiles = []
+    pitch = None
+    for beam_id in beams:
+        entry, pitch = xan.get_image_data( join(directory,beam_id)+".csv" )
+        profiles.append( xan.angled_profile(entry, 0) )
+        profiles.append( xan.angled_profile(entry, 90) )
+    return profiles, pitch
+
+
+
+def bench_sigma_fits(profiles, pitch):
+    """Compare sigmas and run time of fast, batch and lmfit Gaussian fits"""
+
+    t0 = time.perf_counter()
+    sig_lmfit = np.array( [xan.sigma_from_gaussian_lmfit(p, pitch) for p in profiles] )
+    t_lmfit = time.perf_counter()-t0
+    t0 = time.perf_counter()
+    sig_fast = np.array( [xan.sigma_from_gaussian_fast(p, pitch) for p in profiles] )
+    t_fast = time.perf_counter()-t0
+    t0 = time.perf_counter()
+    sig_batch = xan.sigmas_from_gaussian_batch(profiles, pitch)
+    t_batch = time.perf_counter()-t0
+
+    print("Gaussian sigma fits, {} profiles:".format(len(profiles)))
+    print("    lmfit = {:.1f} ms in total".format(1000*t_lmfit))
+    maxdiff = 0
+    for name,sig,t in [("fast",sig_fast,t_fast), ("batch",sig_batch,t_batch)]:
+        diff = np.abs(sig-sig_lmfit)
+        maxdiff = max(maxdiff, diff.max())
+        print("    {:5} = {:.1f} ms in total, speed-up = {:.1f}x, max |{}-lmfit| = {:.2e} mm".format(
+                                    name, 1000*t, t_lmfit/t, name, diff.max()) )
+    return maxdiff
+
+
+
+def bench_archive(years=5, gantries=4):
+    """Time queries of an archive of monthly sessions of all gantries"""
+    gas = [int(g) for g in archive.config.GANTRY_ANGLE_OPTIONS[0].split(",")]
+    ens = [int(e) for e in archive.config.ENERGIES.split(",")]
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as archive_dir:
+        t0 = time.perf_counter()
+        for g in range(1,gantries+1):
+            for m in range(12*years):
+                date = str( np.datetime64("2020-01-02") + np.timedelta64(30*m,"D") )
+                shifts = BeamResults(gas, ens, rng.normal(0,0.4,(len(gas),len(ens),2)), ("x","y"))
+                archive.append_session("Gantry {}".format(g), date, "10:00:00", 
+                                       {"shifts":shifts}, archive_dir)
+        t_write = time.perf_counter()-t0
+        n = gantries*12*years
+        last = str( np.datetime64("2020-01-02") + np.timedelta64(30*(12*years-1),"D") )
+        start = str( np.datetime64(last,"M") - 24 )+"-01"
+
+        t0 = time.perf_counter()
+        one = archive.query("shifts", "Gantry 3", 90, 70, start, None, archive_dir)
+        t_one = time.perf_counter()-t0
+        t0 = time.perf_counter()
+        everything = archive.query("shifts", archive_dir=archive_dir)
+        t_all = time.perf_counter()-t0
+
+    print("Archive of {} sessions ({} gantries, {} years):".format(n, gantries, years))
+    print("    adding session = {:.1f} ms".format(1000*t_write/n))
+    print("    GA 90, 70 MeV, Gantry 3, last 24 months: {} beams in {:.1f} ms".format(
+                                                len(one["values"]), 1000*t_one))
+    print("    all beams of all sessions: {} beams in {:.1f} ms".format(
+                                                len(everything["values"]), 1000*t_all))
+    return len(everything["values"])==n*len(gas)*len(ens)
+
+
+
+def rowwise_write_results_data(conn, df):
+    """Original write_results_data: one execute per row, for reference"""
+    cursor = conn.cursor()
+    sql = '''INSERT INTO "%s" (ADate, MachineName, GA, Energy, [x-offset], [y-offset], Diameter)
+             VALUES (?, ?, ?, ?, ?, ?, ?)'''%(db.RESULTS_TABLE)
+    for i,row in df.iterrows():
+        data = [ row["ADate"], row["MachineName"], int(row["GA"]), int(row["Energy"]),
+                 row["x-offset"], row["y-offset"], row["Diameter"] ]
+        cursor.execute(sql, data)
+    conn.commit()
+
+
+
+def bench_db_writes(repeat=5):
+    """Compare row-by-row and executemany writes of a session's results
+    to the SQLite stand-in database"""
+    import pandas as pd
+    gas = [int(g) for g in db.config.GANTRY_ANGLE_OPTIONS[0].split(",")]
+    ens = [int(e) for e in db.config.ENERGIES.split(",")]
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame( [ ["2020-01-02 10:00:00","Gantry 1",ga,en]+list(rng.normal(0,0.4,2))+[8.0]
+                         for ga in gas for en in ens ], columns=db.RESULTS_COLUMNS )
+
+    def batched(conn, df):
+        db.write_results_data(conn, df.itertuples(index=False, name=None))
+        conn.commit()
+
+    times = {}
+    counts = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name,func in [("row-by-row",rowwise_write_results_data), ("executemany",batched)]:
+            conn = db.connect_sqlite( join(tmpdir,name+".sqlite") )
+            times[name] = best_time(func, conn, df, repeat=repeat)
+            counts[name] = conn.execute( 'SELECT COUNT(*) FROM "%s"'%(db.RESULTS_TABLE) ).fetchone()[0]
+            conn.close()
+
+    print("Database write of {} results rows (SQLite):".format(len(df)))
+    print("    rows written: {}".format(counts))
+    print("    row-by-row = {:.2f} ms, executemany = {:.2f} ms, speed-up = {:.1f}x".format(
+            1000*times["row-by-row"], 1000*times["executemany"], times["row-by-row"]/times["executemany"]) )
+    return counts["row-by-row"]==counts["executemany"]
+
+
+
+# Import time budget (s) of the entry scripts so that the tool opens quickly,
+# and slow packages that must not be imported at start up
+STARTUP_BUDGET = 0.5
+DEFERRED = ["pandas","matplotlib","reportlab","lmfit","skimage","scipy.optimize",
+            "PySimpleGUI","pypyodbc"]
+
+
+
+def import_profile(module):
+    """Return total import time (s) of module in a new interpreter and 
+    {package:cumulative time (s)} from python -X importtime"""
+    proc = subprocess.run( [sys.executable,"-X","importtime","-c","import "+module],
+                           cwd=dirname(abspath(__file__)), capture_output=True, text=True )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line.split("|")
+        if not fields[1].strip().isdigit():
+            continue    # header line
+        times[fields[2].strip()] = int(fields[1])/1e6
+    return times[module], times
+
+
+
+def bench_startup(modules=("run","single_spot_script","watch"), budget=STARTUP_BUDGET, repeat=3):
+    """Check import time of entry scripts against budget and that slow
+    packages are deferred until needed"""
+    ok = True
+    print("Start-up (import) time, budget {:.2f} s:".format(budget))
+    for module in modules:
+        profiles = [ import_profile(module) for i in range(repeat) ]
+        total, times = min( profiles, key=lambda p: p[0] )
+        loaded = [ m for m in DEFERRED if m in times ]
+        slowest = sorted( [m for m in times if "." not in m and m!=module], 
+                          key=lambda m: -times[m] )[:3]
+        ok = ok and total<=budget and not loaded
+        print("    {:20} {:.3f} s {}; slowest: {}".format(module, total, 
+                    "OK" if total<=budget else "OVER BUDGET",
+                    ", ".join( "{} {:.3f} s".format(m,times[m]) for m in slowest ) ))
+        if loaded:
+            print("        should be deferred: {}".format(", ".join(loaded)))
+    return ok
+
+
+
+def bench_timing_overhead(n=100000):
+    """Time per call of stage timers and per-beam timing decorator when
+    timing is disabled and enabled"""
+    def plain(x):
+        return x
+    timed = timing.per_beam(lambda x: {"beam":x})(plain)
+
+    def calls(func):
+        for i in range(n):
+            func(1)
+    def stages():
+        for i in range(n):
+            with timing.stage("stage"):
+                pass
+
+    enabled = timing.ENABLED
+    times = {}
+    for on in (False,True):
+        timing.ENABLED = on
+        times[on] = ( best_time(calls, timed, repeat=3) - best_time(calls, plain, repeat=3),
+                                  best_time(stages, repeat=3) )
+        timing.reset()
+    timing.ENABLED = enabled
+
+    print("Timing instrumentation overhead per call:")
+    for on in (False,True):
+        print("    {:8} per-beam = {:.2f} us, stage = {:.2f} us".format(
+                "enabled" if on else "disabled", 1e6*times[on][0]/n, 1e6*times[on][1]/n))
+    return times[False]
+
+
+
+# Stages of run.full_analysis timed by bench_stages
+STAGES = ["parse", "shadow centroids", "sigma fits", "3D vectors", "plots", "PDF", "DB insert"]
+
+# Max difference from the injected results of synthetic sessions; shifts
+# are found to the nearest pixel
+TRUTH_TOLERANCES = {"shifts":0.2, "shifts_3d":0.01, "spot_sigmas":0.05,
+                    "spot_diameters":1e-9, "arc_radial":1e-9}
+
+
+
+def analyse_synthetic_session(directory, gantry_angles, energies, outputdir, conn, times):
+    """Analyse synthetic session as run.full_analysis (without the
+    executor), adding the time of each stage to times; return max errors
+    of the results (see synthetic.max_errors)"""
+
+    def timed(stage, func, *args):
+        t0 = time.perf_counter()
+        with timing.stage(stage), redirect_stdout(io.StringIO()):
+            out = func(*args)
+        times[stage] = times.get(stage,0) + time.perf_counter()-t0
+        return out
+
+    import full_plot as xplot
+    import full_report as xreport
+    gas, ens = gantry_angles, energies
+    beams = run.get_ordered_beams( run.get_filenames(directory) )
+    records = timed("parse", xan.load_beams, directory, beams)
+    results = {"shifts":timed("shadow centroids", xan.analyse_shifts, gas, ens, records),
+               "spot_sigmas":timed("sigma fits", xan.analyse_spot_profiles, gas, ens, records),
+               "shifts_3d":timed("3D vectors", xan.shift_vector_logos_coords, gas, ens, records, run.TARGET),
+               "spot_diameters":xan.read_spot_diameters(gas, ens, records),
+               "arc_radial":xan.read_arc_radial_widths(gas, ens, records)}
+    errors = synthetic.max_errors( results, synthetic.read_truth(directory) )
+
+    run.image_to_bev(results["shifts"])
+    pngs = timed("plots", xplot.render_figures, run.report_figures(results), outputdir)
+    with redirect_stdout(io.StringIO()):
+        acq_datetime = " ".join( run.get_acquisition_date_time(join(directory,"output.txt")) )
+    timed("PDF", xreport.summary_reportlab, "A", "B", results["shifts"], acq_datetime, "Gantry 1",
+          [ pngs[name] for name in run.REPORT_IMAGES ], join(outputdir,"report.pdf"))
+
+    adate = datetime.strptime(acq_datetime, '%Y-%m-%d %H:%M:%S')
+    rows = db.session_rows(adate, "Gantry 1", results["shifts"], results["spot_diameters"])
+    timed("DB insert", db.write_session, conn, db.session_record("Gantry 1", adate, "A", "B", rows))
+    return errors
+
+
+
+def bench_stages(counts=(1,4,16), gantry_angles=(180,90,0,-90), energies=(245,200,150,100,70),
+                 size=300):
+    """Time each stage of the analysis of 1, 4 and 16 synthetic sessions and
+    check the results against the injected shifts, sigmas, etc"""
+    gas, ens = list(gantry_angles), list(energies)
+    timings = {}
+    errors = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sessions = []
+        for n in range(max(counts)):
+            directory = join(tmpdir, "session{}".format(n+1))
+            synthetic.make_session(directory, gas, ens, size, seed=n,
+                                   acq_datetime="2020-01-{:02d} 10:11:12".format(n%28+1))
+            sessions.append(directory)
+
+        for count in counts:
+            times = {}
+            conn = db.connect_sqlite( join(tmpdir,"qa{}.sqlite".format(count)) )
+            for directory in sessions[:count]:
+                for name,err in analyse_synthetic_session(directory, gas, ens, tmpdir, conn, times).items():
+                    errors[name] = max(errors.get(name,0), err)
+            conn.close()
+            timings[count] = times
+
+    print("Stage timings (s), synthetic sessions of {} beams, {}x{} images:".format(
+                                                    len(gas)*len(ens), size, size))
+    print("    {:18}".format("stage") + "".join( "{:>14}".format("{} session{}".format(c, "s" if c>1 else ""))
+                                                for c in counts ))
+    for stage in STAGES+["total"]:
+        row = [ timings[c][stage] if stage!="total" else sum(timings[c].values()) for c in counts ]
+        print("    {:18}".format(stage) + "".join( "{:14.3f}".format(t) for t in row ))
+    print("    {:18}".format("per session") + "".join( "{:14.3f}".format(sum(timings[c].values())/c)
+                                                      for c in counts ))
+
+    ok = True
+    print("Max difference from injected results:")
+    for name,tol in TRUTH_TOLERANCES.items():
+        ok = ok and errors[name]<=tol
+        print("    {:15} {:.2e} mm {}".format(name, errors[name], "OK" if errors[name]<=tol else
+                                            "OVER TOLERANCE ({} mm)".format(tol)))
+    return ok
+
+
+
+# Budgets (MB) for the increase in memory traced by tracemalloc from the
+# start of each stage to its peak, for a synthetic session of 20 beams of
+# 600x600 pixels; see bench_memory
+MEMORY_BUDGETS = {"parse":25, "shadow centroids":1, "sigma fits":6, "3D vectors":1,
+                  "plots":20, "PDF":20, "DB insert":1}
+
+
+
+def bench_memory(gantry_angles=(180,90,0,-90), energies=(245,200,150,100,70), size=600,
+                 budgets=MEMORY_BUDGETS):
+    """Profile memory of each stage of the analysis of a synthetic session
+    (see memprofile.py) and check the peak increase of each against budgets"""
+    gas, ens = list(gantry_angles), list(energies)
+    enabled = memprofile.ENABLED
+    with tempfile.TemporaryDirectory() as tmpdir:
+        directory = join(tmpdir, "session")
+        synthetic.make_session(directory, gas, ens, size)
+        conn = db.connect_sqlite( join(tmpdir,"qa.sqlite") )
+        # Run once first so that modules imported by a stage are not counted
+        analyse_synthetic_session(directory, gas, ens, tmpdir, conn, {})
+        conn.execute('DELETE FROM "%s"'%(db.SESSION_TABLE))
+        conn.commit()
+
+        memprofile.reset()
+        memprofile.ENABLED = True
+        try:
+            analyse_synthetic_session(directory, gas, ens, tmpdir, conn, {})
+        finally:
+            memprofile.ENABLED = enabled
+            memprofile.stop()
+        conn.close()
+    print( memprofile.format_report().split("\n\n")[0] )
+
+    ok = True
+    print("Peak increase in traced memory (MB), {} beams of {}x{} pixels:".format(
+                                                    len(gas)*len(ens), size, size))
+    for s in memprofile.stages():
+        increase = (s["peak"]-s["start"])/memprofile.MB
+        budget = budgets.get(s["name"])
+        within = budget is None or increase<=budget
+        ok = ok and within
+        print("    {:18} {:8.1f} {}".format(s["name"], increase, "" if budget is None else
+                    "OK (budget {})".format(budget) if within else "OVER BUDGET ({})".format(budget)))
+    memprofile.reset()
+    return ok
+
+
+
+def bench_image_cube(gantry_angles=(180,90,0,-90), energies=(245,200,150,100,70), size=600,
+                     workers=4):
+    """Compare shifts, sigmas and diameters found on worker processes
+    (xan.analyse_beams) from records holding their images and from records
+    of an image cube in a file and in shared memory, and the bytes sent to
+    and returned from the workers per beam"""
+    gas, ens = list(gantry_angles), list(energies)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        directory = join(tmpdir, "session")
+        synthetic.make_session(directory, gas, ens, size)
+        beams = run.get_ordered_beams( run.get_filenames(directory) )
+        with ProcessPoolExecutor(workers) as executor, redirect_stdout(io.StringIO()):
+            records = {"in memory":xan.load_beams(directory, beams),
+                       "cube file":xan.load_beams(directory, beams, executor,
+                                                  join(tmpdir,"images.npy"), gas, ens),
+                       "shared memory":xan.load_beams(directory, beams, executor,
+                                                      image_cube.SHARED, gas, ens)}
+            # Start the workers and import the analysis in them
+            xan.analyse_beams(gas, ens, records["in memory"], executor)
+            for name,recs in records.items():
+                beam_results = xan.analyse_beams(gas, ens, recs, executor)
+                sent = len( pickle.dumps(image_cube.detach(recs[0])) )
+                returned = len( pickle.dumps(xan.beam_summary(recs[0], gas[0], ens[0])) )
+                results[name] = ( beam_results, sent, returned,
+                                  best_time(xan.analyse_beams, gas, ens, recs, executor, repeat=3) )
+        del records
+        image_cube.close()
+
+    identical = all( np.array_equal(results["in memory"][0][key].values, res[0][key].values)
+                     for res in results.values() for key in res[0] )
+    print("Shifts, sigmas and diameters of {} beams of {}x{} pixels on {} worker processes:".format(
+                                            len(gas)*len(ens), size, size, workers))
+    print("    identical results: {}".format(identical))
+    for name,(beam_results,sent,returned,t) in results.items():
+        print("    {:13} = {:.1f} ms, {:.1f} kB sent and {:.2f} kB returned per beam".format(
+                                            name, 1000*t, sent/1e3, returned/1e3))
+    return identical
+
+
+
+if __name__=="__main__":
+
+    if sys.argv[1:2]==["stages"]:
+        sys.exit( 0 if bench_stages( [int(n) for n in sys.argv[2:]] or (1,4,16) ) else 1 )
+    if sys.argv[1:2]==["memory"]:
+        sys.exit( 0 if bench_memory() else 1 )
+    if sys.argv[1:2]==["cube"]:
+        bench_image_cube( workers=int(sys.argv[2]) if len(sys.argv)>2 else 4 )
+        sys.exit()
+
+    bench_startup()
+    bench_timing_overhead()
+    bench_archive()
+    bench_db_writes()
+
+    if len(sys.argv)>1:
+        datadir = sys.argv[1]
+        spotfile = [join(datadir,f) for f in listdir(datadir) 
+                    if splitext(f)[1]==".csv" and str.isdigit(splitext(f)[0])][0]
+        bench_get_image_data(spotfile)
+        bench_sigma_fits( *entry_spot_profiles(datadir) )
+        bench_centroids( [ xan.get_image_data(join(datadir,f))[0] for f in listdir(datadir)
+                           if splitext(f)[1] in (".csv",".txt") and str.isdigit(splitext(f)[0]) ] )
+        beams = [ splitext(f)[0] for f in listdir(datadir) 
+                  if splitext(f)[1]==".csv" and str.isdigit(splitext(f)[0]) ]
+        bench_beam_shift( xan.load_beams(datadir, beams) )
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            spotfile = join(tmpdir,"1.csv")
+            write_test_spotfile(spotfile)
+            bench_get_image_data(spotfile)
+        bench_sigma_fits( synthetic_profiles(456), 0.1 )
+        images = synthetic_images()
+        bench_centroids( images )
+        # Exit spot with darker ball-bearing shadow in centre
+        yy,xx = np.mgrid[0:images[0].shape[0],0:images[0].shape[1]]
+        shadow = np.where( (xx-xx.mean())**2+(yy-yy.mean())**2 < 20**2, 0.7, 1.0 )
+        bench_beam_shift( [ xan.BeamRecord("1", img, np.round(img*shadow), 0.1, 
+                                           None, None, None, None, None) for img in images ] )
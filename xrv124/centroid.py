@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Centroid of the largest connected region of a thresholded image.
+
+The bounding box of the thresholded image is labelled once; the largest
+region is found from the label area counts (bincount) and its centroid
+from the row and column index sums of that region, without building
+skimage regionprops objects.
+"""
+
+import numpy as np
+
+
+
+# 8-connectivity; same as skimage label(connectivity=2)
+STRUCTURE = np.ones( [3,3], dtype=bool )
+
+
+
+def label_regions(mask):
+    """Return label image, number of regions and area (pixels) of each label
+
+    areas[0] is the background
+    """
+    from scipy.ndimage import label
+    label_img, nregions = label(mask, structure=STRUCTURE)
+    areas = np.bincount( label_img.ravel(), minlength=nregions+1 )
+    return label_img, nregions, areas
+
+
+
+def bounding_box(mask):
+    """Return (row slice, col slice) bounding all True pixels, or None"""
+    rows = np.flatnonzero( mask.any(axis=1) )
+    if len(rows)==0:
+        return None
+    cols = np.flatnonzero( mask.any(axis=0) )
+    return slice(rows[0],rows[-1]+1), slice(cols[0],cols[-1]+1)
+
+
+
+def largest_region(mask):
+    """Return (region mask, bounding box, area, number of regions) of 
+    largest region in mask
+
+    Only the bounding box of the mask is labelled and the region mask covers
+    that box. Largest is by area (hence equivalent diameter); ties go to the
+    first region in raster order. Region mask is None if there are no regions.
+    """
+    bbox = bounding_box(mask)
+    if bbox is None:
+        return None, None, 0, 0
+    label_img, nregions, areas = label_regions(mask[bbox])
+    largest = 1 + np.argmax( areas[1:] )
+    return label_img==largest, bbox, areas[largest], nregions
+
+
+
+def region_centroid(region, weights=None):
+    """Return (row, col) centroid of boolean region mask as floats
+
+    If weights (e.g. the image) are given the centroid is intensity-weighted
+    """
+    if weights is None:
+        row_sums = np.count_nonzero(region, axis=1).astype(float)
+        col_sums = np.count_nonzero(region, axis=0).astype(float)
+    else:
+        w = np.where(region, weights, 0)
+        row_sums = w.sum(axis=1, dtype=float)
+        col_sums = w.sum(axis=0, dtype=float)
+    # Projections onto rows and columns; centroid from index sums
+    total = row_sums.sum()
+    row = np.dot( np.arange(len(row_sums)), row_sums ) / total
+    col = np.dot( np.arange(len(col_sums)), col_sums ) / total
+    return row, col
+
+
+
+def centroid_of_largest_region(mask, weights=None, subpixel=False):
+    """Return [x,y] centroid of largest region in mask and number of regions
+
+    Centroid is rounded to the nearest pixel unless subpixel is True, and is
+    intensity-weighted if weights are given. Centroid is None if no region.
+    """
+    region, bbox, area, nregions = largest_region(mask)
+    if region is None:
+        return None, 0
+
+    if weights is not None:
+        weights = weights[bbox]
+    row, col = region_centroid(region, weights)
+    # Back to full image coords
+    row += bbox[0].start
+    col += bbox[1].start
+    # Centroid is (row, col) - i.e. (y,x) so flip it
+    if subpixel:
+        return [ col, row ], nregions
+    return [ int(round(col,0)), int(round(row,0)) ], nregions
+
+
+
+def equivalent_diameter(area):
+    """Diameter (pixels) of circle with same area as region"""
+    return (4*area/np.pi)**0.5
@@ -5,6 +5,8 @@
 Input and analysis options for XRV-124 analysis
 """
 
+from os.path import join, expanduser
+
 
 GANTRY_NAMES = ["Gantry 1","Gantry 2","Gantry 3","Gantry 4"]
 
@@ -27,6 +29,77 @@ THRESHOLD = 50.0
 THRESH_CENTROID = 50.0
 
 
+# Method used to fit Gaussian to spot profiles for sigma:
+#   "batch" - all profiles of a session fitted together (vectorised numpy)
+#   "fast"  - analytic initial guess plus least-squares (scipy), per profile
+#   "lmfit" - original Powell fit with lmfit, kept as reference
+SIGMA_FIT = "batch"
+
+
+
+# Number of processes used to read and analyse beams in parallel (1 = serial)
+WORKERS = 1
+
+
+
+# Cache parsed spot images on disk so that re-analysing a data set skips
+# reading the Logos text files. Clear/rebuild with image_cache.py
+USE_IMAGE_CACHE = False
+IMAGE_CACHE_DIR = join(expanduser("~"), ".xrv124_cache")
+
+
+
+# With WORKERS > 1 keep the images of a session in one array (image_cube.py)
+# that worker processes read without copying; a single process keeps them
+# in memory
+USE_IMAGE_CUBE = True
+# Keep the cube in shared memory (multiprocessing.shared_memory) rather than
+# a memory-mapped file in a temporary directory
+SHARED_MEMORY = True
+
+
+
+# Region of interest around spot used to find centroids (faster than whole
+# image). Found from every ROI_STEP pixel above ROI_THRESHOLD (%) of max, 
+# plus ROI_MARGIN pixels each side
+USE_ROI = True
+ROI_STEP = 4
+ROI_THRESHOLD = 10.0
+ROI_MARGIN = 20
+
+
+
+# Watch mode (watch.py): seconds between polls of the data directory and
+# seconds without a new beam before giving up on the session
+WATCH_POLL = 1.0
+WATCH_TIMEOUT = 600
+# Set True when starting watch mode partway through a session, so that the
+# beams already acquired are analysed first, from the first gantry angle and
+# energy. If False spot files already in the data directory are ignored as
+# those of an earlier session
+WATCH_EXISTING = False
+
+
+
+# Archive of results of all sessions (archive.py), partitioned by gantry
+# and month of acquisition. Each analysed session is added to it unless
+# WRITE_ARCHIVE = False
+ARCHIVE_DIR = join(expanduser("~"), "xrv124_archive")
+WRITE_ARCHIVE = True
+
+
+
+# Time each stage and per-beam operation (timing.py) and write the timings
+# to the results directory; TIMING_TRACE also writes trace.json for
+# chrome://tracing or https://ui.perfetto.dev
+TIMING = False
+TIMING_TRACE = True
+# Record memory use at the start and end of each stage (memprofile.py) and
+# write the largest allocations to the results directory; slow
+PROFILE_MEMORY = False
+
+
+
 # position of ball bearing in Logos coordinates
 TARGET = [0,0,144.8]
 
@@ -37,4 +110,13 @@ PATH_TO_DB = r"path\to\database.accdb"
 PASSWORD = "password"
 SESSION_TABLE = "xrv124session"
 RESULTS_TABLE = "xrv124results"
+# "access" for the QA database above or "sqlite" for a local stand-in
+# database (e.g. for testing), created at SQLITE_PATH if needed
+DB_BACKEND = "access"
+SQLITE_PATH = join(expanduser("~"), "xrv124_qa.sqlite")
+# Sessions that could not be written to the database are kept here until
+# the next run or "python database.py flush"
+DB_SPOOL = join(expanduser("~"), "xrv124_db_spool.jsonl")
+# Also save the database rows to db_results.csv in the results directory
+WRITE_DB_CSV = True
 
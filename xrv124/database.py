@@ -4,50 +4,160 @@ Created on Wed Dec 15 09:19:36 2021
 @author: Steven Court
 
 Interaction with QA database
+
+Sessions are written by a background thread so that the analysis and report
+never wait for the database. Sessions that cannot be written are appended
+to a local spool file (one JSON object per line) and written on the next
+run, or with:
+    python database.py flush
 """
 
-import pypyodbc
-from pypyodbc import IntegrityError
-import pandas as pd
-import easygui as eg
+import os
+import atexit
+import csv
+import json
+import queue
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from os import fsync, remove, replace
+from os.path import isfile
 
 import config
 
+# pypyodbc and easygui are imported where needed so that importing this
+# module is fast
+
 # NOTE: Cols with spaces or hyphens in name must be surrounded by square brackets
 
 DB_PATH = config.PATH_TO_DB
 SESSION_TABLE = config.SESSION_TABLE 
 RESULTS_TABLE = config.RESULTS_TABLE
 PASSWORD = config.PASSWORD
+DB_BACKEND = config.DB_BACKEND
+SQLITE_PATH = config.SQLITE_PATH
+DB_SPOOL = config.DB_SPOOL
+
+# Set True to suppress message boxes for unattended runs (messages are still
+# printed)
+HEADLESS = False
+
+RESULTS_COLUMNS = ["ADate","MachineName","GA","Energy","x-offset","y-offset","Diameter"]
+
+# Connection shared by all writes of a run; see connect() and close()
+_connection = None
+
+# Background writer thread, its queue of sessions and status; see start_writer()
+_writer = None
+_sessions = None
+_status = None
+
+
+
+def warning(msg):
+    """Print warning; also show message box unless HEADLESS"""
+    if not HEADLESS:
+        import easygui as eg
+        eg.msgbox(msg,"WARNING")
+    print(msg)
+
+
+
+def connect_sqlite(path=None):
+    """Return connection to SQLite stand-in for QA database, creating the
+    tables if needed"""
+    import sqlite3
+    # Store datetimes as text, as the default adapter is deprecated
+    sqlite3.register_adapter(datetime, lambda d: d.isoformat(" "))
+    conn = sqlite3.connect(SQLITE_PATH if path is None else path)
+    conn.execute('''
+            CREATE TABLE IF NOT EXISTS "%s" (MachineName TEXT, ADate TEXT,
+            [Operator 1] TEXT, [Operator 2] TEXT, Comments TEXT,
+            PRIMARY KEY (MachineName, ADate))
+            '''%(SESSION_TABLE))
+    conn.execute('''
+            CREATE TABLE IF NOT EXISTS "%s" (ADate TEXT, MachineName TEXT,
+            GA INTEGER, Energy INTEGER, [x-offset] REAL, [y-offset] REAL,
+            Diameter REAL)
+            '''%(RESULTS_TABLE))
+    conn.commit()
+    return conn
+
+
+
+def connect():
+    """Return connection to database, reusing the open one if there is one;
+    None if the database cannot be reached"""
+    global _connection
+    if _connection is None:
+        try:
+            if DB_BACKEND=="sqlite":
+                _connection = connect_sqlite()
+            else:
+                import pypyodbc
+                new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD)
+                _connection = pypyodbc.connect(new_connection)
+        except Exception:
+            _connection = None
+    return _connection
+
+
+
+def close():
+    """Close shared connection"""
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.close()
+        except Exception:
+            pass
+        _connection = None
+
+
+
+def integrity_errors():
+    """Exception types raised on duplicate entries by the backends in use"""
+    errors = []
+    try:
+        from pypyodbc import IntegrityError
+        errors.append(IntegrityError)
+    except Exception:
+        pass
+    import sqlite3
+    errors.append(sqlite3.IntegrityError)
+    return tuple(errors)
 
 
 
 def write_session_data(conn,mach_name,adate,op1,op2,comment):
-    """Write to session table; return True if successful"""
-        
+    """Write to session table; return False if entry already exists
+
+    Not committed; see write_session
+    """
+
     cursor = conn.cursor()   
     sql = '''
             INSERT INTO "%s" (MachineName, ADate, [Operator 1], [Operator 2], Comments)
             VALUES (?, ?, ?, ?, ?)
           '''%(SESSION_TABLE)
     data = [mach_name,adate,op1,op2,comment] 
-    
+
     try:
         cursor.execute(sql, data )
-        conn.commit()
         print(" --> Session written successfully")
         return True
-        
-    except IntegrityError:
-        eg.msgbox("Entry already exists, nothing writen to database","WARNING")
-        print("Entry already exists, nothing writen to database")
+
+    except integrity_errors():
         return False
-        
-    
 
-def write_results_data(conn,df):
-    """Write results to QA database"""    
+
+
+def write_results_data(conn,rows):
+    """Write results rows (in order of RESULTS_COLUMNS) to QA database in a
+    single executemany
+
+    Not committed; see write_session
+    """
 
     cursor = conn.cursor()   
     sql = '''
@@ -55,57 +165,323 @@ def write_results_data(conn,df):
             [x-offset], [y-offset], Diameter) 
             VALUES (?, ?, ?, ?, ?, ?, ?)  
             '''%(RESULTS_TABLE)
-            
-    for i,row in df.iterrows():
-        data = [ row["ADate"], row["MachineName"], row["GA"], row["Energy"],
-                 row["x-offset"], row["y-offset"], row["Diameter"] ]
-        #data = [ datetime.strptime(row["ADate"], '%Y-%m-%d %H:%M:%S'), row["MachineName"], row["GA"], row["Energy"],
-        #         row["x-offset"], row["y-offset"], row["Diameter"] ]
-        cursor.execute(sql, data)
-        
-    conn.commit()
+
+    cursor.executemany(sql, [tuple(r) for r in rows])
     print(" --> Results table written successfully")
 
 
-def test_db_connection():
-    conn=None  
+
+def session_exists(conn,mach_name,adate):
+    """Return True if session is already in session table"""
+    cursor = conn.cursor()   
+    cursor.execute('SELECT COUNT(*) FROM "%s" WHERE MachineName=? AND ADate=?'%(SESSION_TABLE),
+                   [mach_name,adate])
+    return cursor.fetchone()[0]>0
+
+
+
+def session_rows(adate,mach_name,shifts,diameters):
+    """Return results rows (in order of RESULTS_COLUMNS) from BeamResults of
+    shifts (BEV) and spot diameters; adate is a datetime"""
+    # Python types (not numpy) for the database drivers
+    diams = diameters.values.ravel().tolist()
+    return [ (adate, mach_name, ga, en)+tuple(xy.tolist())+(diam,)
+             for (ga,en,xy),diam in zip(shifts.beams(), diams) ]
+
+
+
+def session_record(mach_name,adate,op1,op2,rows,comment=""):
+    """Return session and its results as queued for the writer"""
+    return {"MachineName":mach_name, "ADate":adate, "Operator 1":op1,
+            "Operator 2":op2, "Comments":comment, "results":rows}
+
+
+
+def read_db_results(filename):
+    """Return session record from db_results.csv written by run.py"""
+    with open(filename, newline="") as f:
+        rows = list( csv.DictReader(f) )
+    first = rows[0]
+    adate = datetime.strptime(first["ADate"], '%Y-%m-%d %H:%M:%S')
+    results = [ (adate, r["MachineName"], int(r["GA"]), int(r["Energy"]), float(r["x-offset"]),
+                 float(r["y-offset"]), float(r["Diameter"])) for r in rows ]
+    return session_record(first["MachineName"], adate, first["Operator 1"],
+                          first["Operator 2"], results)
+
+
+
+def _insert_session(conn,session):
+    """Insert session record and its results; not committed. Return False if
+    session already exists"""
+    session_written = write_session_data(conn, session["MachineName"], session["ADate"],
+                                         session["Operator 1"], session["Operator 2"],
+                                         session["Comments"] )
+    if session_written:
+        write_results_data(conn, session["results"])
+    return session_written
+
+
+
+def write_session(conn,session):
+    """Write session record and its results in one transaction; return False
+    if session already exists"""
     try:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD)    
-        conn = pypyodbc.connect(new_connection)
+        session_written = _insert_session(conn,session)
+        if session_written:
+            conn.commit()
+        else:
+            conn.rollback()
+        return session_written
+    except Exception:
+        conn.rollback()
+        raise
+
+
+
+@contextmanager
+def spool_lock(path,wait=True):
+    """Hold exclusive lock on spool file, shared by all processes (e.g. with
+    run.py --sessions); yields False instead of waiting if wait is False and
+    another process holds it. The lock is on path+".lock", which is left in
+    place; the lock itself is released if the process dies"""
+    with open(path+".lock", "a+b") as f:
+        f.seek(0)
+        try:
+            if os.name=="nt":
+                import msvcrt
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if wait else msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if wait else fcntl.LOCK_EX|fcntl.LOCK_NB)
+            locked = True
+        except OSError:
+            if wait:
+                raise
+            locked = False
+        try:
+            yield locked
+        finally:
+            if locked and os.name=="nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+
+def spool(session,path=None):
+    """Append session record to local spool file; datetimes are stored as
+    "YYYY-MM-DD hh:mm:ss" """
+    path = DB_SPOOL if path is None else path
+    with spool_lock(path):
+        _append_session(session, path)
+
+
+
+def _append_session(session,path):
+    """Append session record to spool file; caller holds the spool lock"""
+    session = dict(session, ADate=str(session["ADate"]),
+                   results=[ [str(r[0])]+list(r[1:]) for r in session["results"] ])
+    with open(path, "a+b") as f:
+        # Start a new line if the last write was cut short
+        if f.seek(0,2)>0:
+            f.seek(-1,2)
+            if f.read(1)!=b"\n":
+                f.write(b"\n")
+        f.write( (json.dumps(session)+"\n").encode("utf-8") )
+        f.flush()
+        fsync(f.fileno())
+
+
+
+def read_spool(path):
+    """Return session records in spool file, keeping only the last of each
+    (MachineName, ADate)"""
+    sessions = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                session = json.loads(line)
+            except ValueError:
+                # Incomplete line, e.g. power lost while spooling
+                print("  Warning: skipping unreadable line in {}".format(path))
+                continue
+            adate = datetime.strptime(session["ADate"], '%Y-%m-%d %H:%M:%S')
+            session["ADate"] = adate
+            session["results"] = [ [adate]+r[1:] for r in session["results"] ]
+            sessions[ (session["MachineName"],adate) ] = session
+    return list(sessions.values())
+
+
+
+def replay_spool(conn,path=None):
+    """Write spooled sessions not already in database, each in its own
+    transaction; return (number written, number that failed)
+
+    Sessions that cannot be inserted although the database can be reached
+    are moved to path+".failed" so that they do not hold back the others.
+    The spool is moved aside while it is replayed, under the spool lock;
+    nothing is done if another process is replaying it. If the database
+    cannot be reached the replay is retried next time, skipping sessions
+    already written.
+    """
+    path = DB_SPOOL if path is None else path
+    replaying = path+".replay"
+    with spool_lock(path, wait=False) as locked:
+        if not locked:
+            return 0, 0
+        if isfile(path):
+            if isfile(replaying):
+                # Previous replay failed; retry it together with the new sessions
+                with open(path, encoding="utf-8") as new, open(replaying, "a", encoding="utf-8") as f:
+                    f.write(new.read())
+                remove(path)
+            else:
+                replace(path, replaying)
+        if not isfile(replaying):
+            return 0, 0
+
+        written = failed = 0
+        for session in read_spool(replaying):
+            if session_exists(conn, session["MachineName"], session["ADate"]):
+                continue
+            try:
+                if write_session(conn, session):
+                    written += 1
+            except Exception as e:
+                # Raises, keeping the spool, if the database cannot be reached
+                session_exists(conn, session["MachineName"], session["ADate"])
+                _append_session(session, path+".failed")
+                failed += 1
+                print("  Warning: could not write spooled session {} {} ({}); "
+                      "moved to {}".format(session["MachineName"], session["ADate"],
+                                           e, path+".failed"))
+        remove(replaying)
+    return written, failed
+
+
+
+def _writer_loop(sessions,status):
+    """Background writer: connect, write any spooled sessions, then write
+    queued sessions until None is queued. Sessions that cannot be written
+    are spooled. Warnings are kept in status for wait_for_writer, as message
+    boxes can only be shown from the main thread"""
+    status["connected"] = connect() is not None
+    status["ready"].set()
+
+    if status["connected"]:
+        try:
+            written, failed = replay_spool(connect())
+            if written:
+                print(" --> {} spooled session(s) written to database".format(written))
+            if failed:
+                status["warnings"].append("{} spooled session(s) could not be written to database; "
+                                          "moved to {}.failed".format(failed, DB_SPOOL))
+        except Exception as e:
+            status["warnings"].append("Could not write spooled sessions to database ({}); "
+                                      "they will be retried on the next run".format(e))
+
+    while True:
+        session = sessions.get()
+        if session is None:
+            break
+        try:
+            conn = connect()
+            if conn is None:
+                raise ConnectionError("cannot connect to database")
+            if not write_session(conn, session):
+                status["warnings"].append("Entry already exists, nothing writen to database")
+        except Exception as e:
+            close()
+            try:
+                spool(session)
+                status["warnings"].append("Could not write to database ({}); session saved to {}. "
+                                          "Run \"python database.py flush\" to retry".format(e, DB_SPOOL))
+            except OSError as spool_error:
+                status["warnings"].append("Could not write to database ({}) or spool ({}); "
+                                          "nothing written".format(e, spool_error))
+    close()
+
+
+
+def start_writer():
+    """Start background writer if not running; return True if it connected
+    to the database"""
+    global _writer, _sessions, _status
+    if _writer is None:
+        _sessions = queue.Queue()
+        _status = {"ready":threading.Event(), "connected":False, "warnings":[]}
+        _writer = threading.Thread(target=_writer_loop, args=(_sessions,_status),
+                                   name="database writer", daemon=True)
+        _writer.start()
+    _status["ready"].wait()
+    return _status["connected"]
+
+
+
+def wait_for_writer():
+    """Wait for queued sessions to be written (or spooled) and stop writer"""
+    global _writer
+    if _writer is None:
+        return
+    _sessions.put(None)
+    _writer.join()
+    _writer = None
+    if _status["warnings"]:
+        warning("\n".join(_status["warnings"]))
+
+# Never exit with sessions still queued
+atexit.register(wait_for_writer)
+
+
+
+def test_db_connection():
+    """Start background writer, which opens the connection used for the
+    writes of this run"""
+    if start_writer():
         print("  Success: Database connection made")
-    except:
-        eg.msgbox("Cannot connect to database; nothing will be written but analysis will continue","WARNING")
-        print("  Warning: Cannot connect to database; nothing will be written")
-    
-
- 
-def write_to_db(df,comment=""):
-    
-    conn=None  
+    else:
+        warning("  Warning: Cannot connect to database; results will be saved to {} "
+                "and written on a later run".format(DB_SPOOL))
+
+
+
+def write_to_db(session):
+    """Queue session record (see session_record) to be written in one
+    transaction by the background writer; returns immediately. See
+    wait_for_writer"""
+    start_writer()
+    _sessions.put(session)
+
+
+
+def flush():
+    """Write spooled sessions to database"""
+    conn = connect()
+    if conn is None:
+        warning("Could not connect to database; sessions kept in {}".format(DB_SPOOL))
+        return
     try:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD)    
-        conn = pypyodbc.connect(new_connection)                 
-    except:
-        eg.msgbox("Could not connect to database; nothing written","WARNING")
-        print("Could not connect to database; nothing written")
-    
-    datetimebugfix = datetime.strptime(df["ADate"][0], '%Y-%m-%d %H:%M:%S') 
-
-    if isinstance(conn,pypyodbc.Connection):
-        session_written = write_session_data(conn, str(df["MachineName"][0]),
-                                             datetimebugfix, str(df["Operator 1"][0]),
-                                             str(df["Operator 2"][0]), comment )
-        if session_written:
-            write_results_data(conn,df)
-        
- 
-    
+        written, failed = replay_spool(conn)
+        print("{} spooled session(s) written to database".format(written))
+        if failed:
+            warning("{} spooled session(s) could not be written to database; "
+                    "moved to {}.failed".format(failed, DB_SPOOL))
+    finally:
+        close()
+
+
+
 
 def main():
-    df = pd.read_csv(r"db_results.csv")    
-    write_to_db(df)    
-    
-    
-    
+    import sys
+    if sys.argv[1:]==["flush"]:
+        flush()
+        return
+    write_to_db( read_db_results(r"db_results.csv") )
+    wait_for_writer()
+
+
+
 if __name__=="__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,13 +1,19 @@
 import sys
+import threading
 from os.path import join
+from collections import namedtuple
+from concurrent.futures import as_completed
 from math import sin, cos, radians
 
 import numpy as np
-from skimage.measure import label, regionprops, profile_line
-from lmfit import Model
-from lmfit import Parameters
 
 import config
+import centroid
+import image_cache
+import image_cube
+import timing
+from results import (BeamResults, SHIFT_FIELDS, SHIFT_3D_FIELDS, DIAMETER_FIELDS,
+                     SIGMA_FIELDS, ARC_RADIAL_FIELDS)
 
 
 
@@ -15,6 +21,19 @@ import config
 THRESHOLD = config.THRESHOLD   
 # % threshold for finding centroid of spots
 THRESH_CENTROID = config.THRESH_CENTROID
+# Crop images to region around spot before finding centroids; region is
+# found from every ROI_STEP pixel above ROI_THRESHOLD (%) plus ROI_MARGIN pixels
+USE_ROI = config.USE_ROI
+ROI_STEP = config.ROI_STEP
+ROI_THRESHOLD = config.ROI_THRESHOLD
+ROI_MARGIN = config.ROI_MARGIN
+# Load parsed images from on-disk cache when available
+USE_IMAGE_CACHE = config.USE_IMAGE_CACHE
+# Gaussian fitting method for spot sigmas: "batch", "fast" or "lmfit"
+SIGMA_FIT = config.SIGMA_FIT
+
+# Scratch arrays reused from beam to beam (one set per thread); see scratch()
+_scratch = threading.local()
 
 
 
@@ -30,209 +49,414 @@ def progress_bar(value, endvalue, bar_length=50):
 
 
 
-def get_image_data(filename):
-    """Return image numpy array of image plus pitch
+def map_beams(func, args, executor=None):
+    """Return [func(*a) for a in args] showing progress bar
+
+    If a concurrent.futures executor (e.g. ProcessPoolExecutor) is given the
+    calls run on it; results are still returned in the order of args.
+    BeamRecords of an image cube are sent without their images, which the
+    workers open from the cube (see image_cube.py)
     """
+    results = []
+    if executor is None:
+        for cnt,a in enumerate(args):
+            progress_bar(cnt, len(args) )
+            results.append( func(*a) )
+    elif timing.ENABLED:
+        # Bring back the timings recorded in the worker processes
+        futures = [ executor.submit(timing.collect, image_cube.call, func, *map(image_cube.detach, a))
+                    for a in args ]
+        for cnt,f in enumerate( as_completed(futures) ):
+            progress_bar(cnt+1, len(args) )
+        for f in futures:
+            result, events = f.result()
+            timing.add_events(events)
+            results.append(result)
+    else:
+        futures = [ executor.submit(image_cube.call, func, *map(image_cube.detach, a)) for a in args ]
+        for cnt,f in enumerate( as_completed(futures) ):
+            progress_bar(cnt+1, len(args) )
+        results = [ f.result() for f in futures ]
+
+    # New line after porgress bar
+    sys.stdout.write("\n")
+    sys.stdout.flush()
+
+    return results
+
+
+
+def scratch(name, shape, dtype):
+    """Return array of given shape and dtype that is reused by every call with
+    the same name in this thread, to avoid allocating an image per beam;
+    contents are undefined"""
+    size = int( np.prod(shape) )
+    buf = getattr(_scratch, name, None)
+    if buf is None or buf.size<size or buf.dtype!=dtype:
+        buf = np.empty(size, dtype=dtype)
+        setattr(_scratch, name, buf)
+    return buf[:size].reshape(shape)
+
+
+
+def compact_image(img):
+    """Return image as uint8 if it holds only 8-bit grey values (0-255), as
+    Logos images do, otherwise as float32"""
+    if img.size and img.min()>=0 and img.max()<=255:
+        grey = img.astype(np.uint8)
+        if np.array_equal(grey, img):
+            return grey
+    return img.astype(np.float32)
+
+
+
+def parse_spot_header(spotdata):
+    """Return pitch, image shape (nrows,ncols) and index of first image row
+
+    Pitch is taken from the "Pitch:," line and the image dimensions from the
+    line that follows it giving two integers (3rd line of Logos files). Which
+    of those is the number of columns is decided by the number of values in
+    the first image row, so non-square images are read correctly.
+    """
+    pitch = None
+    for i,line in enumerate(spotdata):
+        if pitch is None:
+            if "Pitch:," in line:
+                pitch = float( line.split("Pitch:,")[1].split(",")[0].strip() )
+            continue
+        sl = line.split(",")
+        if( len(sl)<3 or not sl[1].strip().isdigit() or not sl[2].strip().isdigit()
+                or i+1>=len(spotdata) ):
+            continue
+        dims = int(sl[1]), int(sl[2])
+        # Number of pixel values in first image row
+        width = spotdata[i+1].count(",")+1
+        if width==dims[1]:
+            return pitch, (dims[0],dims[1]), i+1
+        elif width==dims[0]:
+            return pitch, (dims[1],dims[0]), i+1
+
+    raise ValueError("Could not find pitch and image dimensions in header")
+
+
+
+def parse_spot_file(filename, dtype=None):
+    """Return image numpy array, pitch and metadata of a Logos spot file
+
+    The image is uint8 (or float32 if it is not 8-bit; see compact_image)
+    unless a dtype is given. Metadata is a dict of the Diameter, Arc/Radial
+    entry widths and the "XRV Beam Data" line; values are None if not
+    present in the file
+    """
+    
+    with open(filename) as f:
+        spotdata = f.read().splitlines()
+
+    pitch, (nrows,ncols), start = parse_spot_header(spotdata)
     
-    spotdata = open(filename).readlines()
+    # Parse whole pixel block in one call; format np([rows,cols])
+    block = ",".join( spotdata[start:start+nrows] )
+    spotimage = np.fromstring(block, dtype=float if dtype is None else dtype, sep=",")
+    if spotimage.size!=nrows*ncols:
+        raise ValueError("Expected {}x{} pixels in {}, found {}".format(
+                                    nrows, ncols, filename, spotimage.size) )
+    spotimage = spotimage.reshape( [nrows,ncols] )
+    if dtype is None:
+        spotimage = compact_image(spotimage)
 
-    # Image pitch (pixel width) is in first line
-    pitch = float( spotdata[0].split("Pitch:,")[1].split(",")[0].strip() )
+    meta = parse_spot_metadata(spotdata[:start], spotdata[start+nrows:])
 
-    # 3rd line contains image dimension - ALWAYS??      ##TODO: CHECK CORRECT FOR NON-SQUARE IMAGES
-    nrows = int( spotdata[2].split(",")[1].strip() )    # or is this x dim => no. columns?
-    ncols = int( spotdata[2].split(",")[2].strip() )    # y dim => no. rows?
+    return spotimage, pitch, meta
+
+
+
+def parse_spot_metadata(header, footer):
+    """Return dict of spot diameter, arc/radial widths and beam data line
+    from the header lines and the lines following the image data
+    """
+    meta = {"diameter":None, "arc":None, "radial":None, "beamdata":None}
     
-    spotimage = np.zeros( [nrows,ncols] )   ## format np([rows,cols])
+    #First line contains diameter
+    for line in header:
+        if "Diameter:," in line:
+            meta["diameter"] = float( line.split("Diameter:,")[1].split(",")[0].strip() )
+            break
+
+    for line in footer:
+        if "Arc Style" in line:
+            meta["arc"] = float( line.split("Entry (mm):,")[1].split(",")[0].strip() )
+        if "Radial Style" in line:
+            meta["radial"] = float( line.split("Entry (mm):,")[1].split(",")[0].strip() )
+        if "XRV Beam Data" in line:
+            meta["beamdata"] = line
+
+    return meta
+
+
+
+def read_spot_file(filename, dtype=None):
+    """Return image, pitch and metadata of spot file, using the image
+    cache if enabled in config (USE_IMAGE_CACHE)
+    """
+    if not USE_IMAGE_CACHE:
+        return parse_spot_file(filename, dtype)
+
+    key = image_cache.fingerprint(filename, dtype)
+    cached = image_cache.load(key)
+    if cached is not None:
+        return cached
+    spotimage, pitch, meta = parse_spot_file(filename, dtype)
+    image_cache.save(key, spotimage, pitch, meta)
+    return spotimage, pitch, meta
+
 
-    for row in range(3,nrows+3): ## IMAGE DATA STARTS ON ROW 3
 
-        # https://scikit-image.org/docs/dev/user_guide/data_types.html
-        # says NEVER USE astype() ON AN IMAGE
-        #... but have I? Im just converting strings to floats here...
-        spotimage[row-3] = np.array( spotdata[row].split(",") ).astype(float)
+def get_image_data(filename):
+    """Return image numpy array of image plus pitch
 
+    Image is uint8 (see parse_spot_file); convert before doing arithmetic
+    that could overflow
+    """
+    spotimage, pitch, meta = read_spot_file(filename)
     return spotimage, pitch
 
 
 
+# Everything needed from a single beam, read from its entry (.csv) and 
+# exit (.txt) spot files in a single pass. p1 and p2 are the centres of 
+# the entry and exit spots in Logos coordinates (from "XRV Beam Data").
+# cube is the (path, slot) of the images if they are in an image cube
+BeamRecord = namedtuple("BeamRecord", ["beam_id","entry","exit","pitch",
+                                       "diameter","arc","radial","p1","p2","cube"],
+                        defaults=(None,))
+
+
+
+def record_beam(record, ga=None, en=None):
+    """Beam of per-beam function of a BeamRecord, for timing"""
+    return {"beam":record.beam_id, "ga":ga, "en":en}
+
+
+
+@timing.per_beam(lambda directory, beam_id: {"beam":beam_id})
+def load_beam(directory, beam_id):
+    """Return BeamRecord for beam_id from its .csv and .txt spot files"""
+
+    entry, pitch_en, meta = read_spot_file( join(directory,beam_id)+".csv" )
+    exit, pitch_ex, _  = read_spot_file( join(directory,beam_id)+".txt" )
+
+    if pitch_en!=pitch_ex:
+        print("WARNING: Pitch of entry and exit spots differs!!")
+        #TODO: deal with unequal entry/exit spot sizes
+
+    p1, p2 = None, None
+    if meta["beamdata"] is not None:
+        sl = meta["beamdata"].split(",")
+        p1 = np.array( [sl[2],sl[3],sl[4]] ).astype(float)
+        p2 = np.array( [sl[6],sl[7],sl[8]] ).astype(float)
+
+    return BeamRecord(beam_id, entry, exit, pitch_en, meta["diameter"],
+                      meta["arc"], meta["radial"], p1, p2)
+
+
+
+def load_beams(directory, beams, executor=None, cube=None, gantry_angles=None, energies=None):
+    """Return list of BeamRecords, one per beam ID in beams (ordered)
+    
+    Files are read in parallel if a concurrent.futures executor is given.
+    If the path of an image cube (.npy), or image_cube.SHARED for one in
+    shared memory, is given the images are stored in it and the records hold
+    views of it (see image_cube.py); the GAs and energies are written to its
+    index
+    """
+    if cube is None:
+        args = [ (directory, beam_id) for beam_id in beams ]
+        return map_beams(load_beam, args, executor)
+
+    # Size and type of images from the first beam
+    first = load_beam(directory, beams[0])
+    location = image_cube.create(cube, len(beams), first.entry.shape,
+                                 np.result_type(first.entry, first.exit))
+    args = [ (location, slot, directory, beam_id) for slot,beam_id in enumerate(beams) ]
+    records = [ image_cube.store(location, 0, first) ]
+    records += [ image_cube.attach(r) for r in map_beams(image_cube.load_beam, args[1:], executor) ]
+    image_cube.write_index(location, records, gantry_angles, energies)
+    return records
+
+
+
 def get_equivalent_diameter( entryspot ):
-    """Return skimage.measure.regionprops() equivalent diameter
+    """Return equivalent diameter (pixels) of thresholded entry spot
     """
     entry_max = entryspot.max()
     entry_thresh = entryspot>(entry_max*0.5) 
     # This works matches well the "diameter" in csv files
 
-    # Use skimage to get region properties
-    label_img = label(entry_thresh, connectivity=entry_thresh.ndim)
-    props = regionprops(label_img)
-    if len(props)!=1:
-        print("ERROR: regionprops() did not return a single region")
+    label_img, nregions, areas = centroid.label_regions(entry_thresh)
+    if nregions!=1:
+        print("ERROR: label() did not return a single region")
 
-    return props[0].equivalent_diameter
+    return centroid.equivalent_diameter( areas[1] )
 
 
 
-def get_centroid_of_largest_region( img, threshold, ga=None, en=None ):
-    """Return centroid of spot based on threshold image
+def spot_roi( img, step=ROI_STEP, threshold=ROI_THRESHOLD, margin=ROI_MARGIN ):
+    """Return (row slice, col slice) of region of image containing the spot
 
-    Depending on choice of threshold there may be more than 1 region identified
-    Method always chooses the largest based on diameter as this will be the main spot
+    Found cheaply from every step'th pixel in each direction: bounding box 
+    of pixels above threshold (%) of the max, plus a margin (pixels)
     """
-    # float images must be between -1 and 1
-    norm_img = img / img.max() 
+    nrows, ncols = img.shape
+    small = img[::step,::step]
+    box = centroid.bounding_box( small > float(small.max())*threshold/100.0 )
+    if box is None:
+        return slice(0,nrows), slice(0,ncols)
+    # Spot may extend up to one step beyond the sampled pixels
+    pad = step + margin
+    rows = slice( max(box[0].start*step-pad, 0), min((box[0].stop-1)*step+1+pad, nrows) )
+    cols = slice( max(box[1].start*step-pad, 0), min((box[1].stop-1)*step+1+pad, ncols) )
+    return rows, cols
 
-    # simple threshold of 50%.
-    thresh = norm_img>(threshold/100.0)
 
-    # Use skimage to get region properties
-    label_img = label(thresh, connectivity=thresh.ndim)
-    props = regionprops(label_img)
-    # Our region of interest
-    largest_region = None
 
-    if len(props)==0:
-        print("ERROR: regionprops() found no region!")
-    else:
-        if len(props)>1:
-            print("Warning: regionprops() found multiple regions\
-                      for GA={}, E={} at threshold={}. Choosing\
-                         largest.".format(ga,en, threshold) )
-        largest_diam = -999
-        largest_index = -1        
-        for i,p in enumerate(props):
-            if p.equivalent_diameter>largest_diam:
-                largest_diam = p.equivalent_diameter
-                largest_index = i
+def get_centroid_of_largest_region( img, threshold, ga=None, en=None,
+                                    weighted=False, subpixel=False ):
+    """Return centroid of spot based on threshold image
 
-        largest_region = props[largest_index]
+    Depending on choice of threshold there may be more than 1 region identified
+    Method always chooses the largest based on diameter as this will be the main spot
 
-    # Centroid of first labeled object
-    # Centroid coordinate tuple is (row, col) - i.e. (y,x) so need to flip it
-    # Rounded to nearest pixel 
-    centroid = [ int(round(largest_region.centroid[1],0)), int(round(largest_region.centroid[0],0)) ] ## Now (x,y)
-    # Leave coord as float 
-    ##centroid = [ largest_region.centroid[1], largest_region.centroid[0] ] ## Now (x,y)
+    Centroid is rounded to nearest pixel unless subpixel=True and is 
+    intensity-weighted within the region if weighted=True
+    """
+    # simple threshold of 50%; compare with threshold scaled to the max
+    # rather than normalising the image
+    thresh = scratch("mask", img.shape, bool)
+    np.greater(img, float(img.max())*threshold/100.0, out=thresh)
 
-    return centroid
+    weights = img if weighted else None
+    # Centroid of largest region as (x,y)
+    centre, nregions = centroid.centroid_of_largest_region(thresh, weights, subpixel)
 
+    if nregions==0:
+        raise ValueError("No region found for GA={}, E={} at threshold={}".format(
+                                                               ga, en, threshold))
+    elif nregions>1:
+        print("Warning: label() found multiple regions\
+                  for GA={}, E={} at threshold={}. Choosing\
+                     largest.".format(ga,en, threshold) )
 
+    return centre
 
 
-def analyse_shifts(gantry_angles, energies, directory, beams):
-    """Analyse spot shifts in x,y of IMAGE COORDINATES
+
+
+@timing.per_beam(record_beam)
+def beam_shift(record, ga=None, en=None):
+    """Return [x,y] shift (mm) of single beam in IMAGE COORDINATES
 
     Q: define shift from centre of image or centre of spot???
+    """
+    entry = record.entry
+    exit = record.exit
+    pitch = record.pitch
+
+    ## np array [y][x]
+    nrows = entry.shape[0]
+    ncols = entry.shape[1]
+
+    # Only analyse region around the spot; centroids are mapped back to 
+    # full image coords (x,y) by adding the offset of the region
+    roi = spot_roi(entry) if USE_ROI else ( slice(0,nrows), slice(0,ncols) )
+    offset = [ roi[1].start, roi[0].start ]  ## (x,y)
+    entry = entry[roi]
+    exit = exit[roi]
+    def in_image_coords(c):
+        return [ c[0]+offset[0], c[1]+offset[1] ]
+
+    # subtract exit spot from entry spot for shadow; images are uint8 so
+    # subtract as float32, into a buffer reused for every beam
+    sub = np.subtract(entry, exit, out=scratch("sub", entry.shape, np.float32), dtype=np.float32)
+
+    # centroid of shadow
+    shadowcentre = in_image_coords( get_centroid_of_largest_region( sub, THRESHOLD, ga, en ) )
+
+    ####### TODO, decide
+    # Get centre of image coords
+    imagecentre = [ ncols//2, nrows//2 ]  ## (x,y)
+    # OR should this be centre of the exitspot?
+    exitspotcentre = in_image_coords( get_centroid_of_largest_region( exit, THRESH_CENTROID , ga, en ) )
+    # Centre of entry? (To avoid issues with BB shadow)
+    entryspotcentre = in_image_coords( get_centroid_of_largest_region( entry, THRESH_CENTROID , ga, en ) )
+    # Average both the exit and entry spot centres?
+    avgcentre = [ 0.5*(exitspotcentre[0]+entryspotcentre[0]),
+                  0.5*(exitspotcentre[1]+entryspotcentre[1])  ]
+
+
+    #### experimenting #####
+    ##print("####### {},GA{}E{}".format(record.beam_id,ga,en))
+    ##print("Entry centre = {}, Exit Centre = {}".format(entryspotcentre, exitspotcentre)  )
+    ##centre_diff = [ entryspotcentre[0]-exitspotcentre[0], entryspotcentre[1]-exitspotcentre[1]  ]
+    ##print("   diff = {}".format(centre_diff) )
+    ##print("ExitSpotCentre = {}, ImageCentre = {}".format(exitspotcentre, imagecentre)  )
+    ##spot_img_diff = [ exitspotcentre[0]-imagecentre[0], exitspotcentre[1]-imagecentre[1]  ]
+    ##print("   diff = {}".format(spot_img_diff) )
+
+
+    #####   TODO: DECIDE WHAT TO USE 
+    # Benefit to image centre is it's not dependent on quality of spot image
+    # Or if Logos gets this slightly misplaced then it's better to use spots, but best
+    #     to use an avg of entry and exit in case BB shadow in exit spot affects centroid
+    # Need to be sure regionprops works well
+    ############################################################################
+    # Shift reported as centrOfImage - centreOfBBShadow
+    shift_pixels = np.array(imagecentre) - np.array(shadowcentre)
+    #
+    # Shift as centreOfExitSpot - centreOfBBShadow            
+    ##shift_pixels = np.array(exitspotcentre) - np.array(shadowcentre)
+
+    # I think we should use some info from the spots rather than just the image
+    # coordinate centre. DECISION: avg entry and exit spot centres and use a 
+    # threshold value (to determine centroid) of 50%
+    ###shift_pixels = np.array(avgcentre) - np.array(shadowcentre)
+    ########################################################################### 
+
+    # i.e. record shift  as tuple (x,y)
+    # json does not allow numpy types; need lists and ints
+    shift2 = list(shift_pixels)
+    #shift3 = [ int(s) for s in shift2 ]        
+    shift_mm = [ s*pitch for s in shift2 ]        
+
+    '''# Plot centre of image and centroid of ball-bearing shadow
+    #sub[imagecentre[1]][imagecentre[0]] = -0.99
+    #sub[shadowcentre[0]][shadowcentre[1]] = -0.99
+    #plt.imshow(sub, cmap=plt.cm.gray)
+    #plt.title("Entry-exit spots.\nImage centre and ball-bearing shadow centre shown")
+    #plt.show()'''
+
+    return list(shift_mm)
+
+
+
+def analyse_shifts(gantry_angles, energies, records, executor=None):
+    """Analyse spot shifts in x,y of IMAGE COORDINATES
 
     This means all beams were captured at all GAs and energies.
     FUNCTION WILL NOT WORK IS THERE IS MISSING DATA
-    """
-    results = {}
 
+    Beams are analysed in parallel if a concurrent.futures executor is given.
+    Returns BeamResults of x,y shifts (mm)
+    """
+    args = []
     cnt = -1
-
-    spot_img_centre_shifts = []
-    centre_shifts = []
-    
     for ga in gantry_angles:
         for en in energies:
             cnt+=1
-            
-            progress_bar(cnt, len(beams) )
-
-            # key for storing result
-            k = "GA"+str(ga)+"E"+str(en)
-
-            entry, pitch_en = get_image_data( join(directory,beams[cnt])+".csv" ) 
-            exit, pitch_ex  = get_image_data( join(directory,beams[cnt])+".txt" )
-    
-            if pitch_en!=pitch_ex:
-                print("WARNING: Pitch of entry and exit spots differs!!")
-                #TODO: deal with unequal entry/exit spot sizes
-            pitch = pitch_en
-
-            ## np array [y][x]
-            nrows = entry.shape[0]
-            ncols = entry.shape[1]
-
-            # subtract exit spot from entry spot for shadow
-            sub = entry - exit
-
-            # centroid of shadow
-            shadowcentre = get_centroid_of_largest_region( sub, THRESHOLD, ga, en )
-
-            ####### TODO, decide
-            # Get centre of image coords
-            imagecentre = [ ncols//2, nrows//2 ]  ## (x,y)
-            # OR should this be centre of the exitspot?
-            exitspotcentre = get_centroid_of_largest_region( exit, THRESH_CENTROID , ga, en )
-            # Centre of entry? (To avoid issues with BB shadow)
-            entryspotcentre = get_centroid_of_largest_region( entry, THRESH_CENTROID , ga, en )
-            # Average both the exit and entry spot centres?
-            avgcentre = [ 0.5*(exitspotcentre[0]+entryspotcentre[0]),
-                          0.5*(exitspotcentre[1]+entryspotcentre[1])  ]
-
-
-            #### experimenting #####
-            ##print("####### {},{}".format(beams[cnt],k))
-            ##print("Entry centre = {}, Exit Centre = {}".format(entryspotcentre, exitspotcentre)  )
-            centre_diff = [ entryspotcentre[0]-exitspotcentre[0], entryspotcentre[1]-exitspotcentre[1]  ]
-            ##print("   diff = {}".format(centre_diff) )
-            centre_shifts.append(  (centre_diff[0]**2+centre_diff[1]**2)**0.5   )
-      
-            ##print("ExitSpotCentre = {}, ImageCentre = {}".format(exitspotcentre, imagecentre)  )
-            spot_img_diff = [ exitspotcentre[0]-imagecentre[0], exitspotcentre[1]-imagecentre[1]  ]
-            ##print("   diff = {}".format(spot_img_diff) )
-            spot_img_centre_shifts.append(  (spot_img_diff[0]**2+spot_img_diff[1]**2)**0.5   )
-
-
-            #####   TODO: DECIDE WHAT TO USE 
-            # Benefit to image centre is it's not dependent on quality of spot image
-            # Or if Logos gets this slightly misplaced then it's better to use spots, but best
-            #     to use an avg of entry and exit in case BB shadow in exit spot affects centroid
-            # Need to be sure regionprops works well
-            ############################################################################
-            # Shift reported as centrOfImage - centreOfBBShadow
-            shift_pixels = np.array(imagecentre) - np.array(shadowcentre)
-            #
-            # Shift as centreOfExitSpot - centreOfBBShadow            
-            ##shift_pixels = np.array(exitspotcentre) - np.array(shadowcentre)
-
-            # I think we should use some info from the spots rather than just the image
-            # coordinate centre. DECISION: avg entry and exit spot centres and use a 
-            # threshold value (to determine centroid) of 50%
-            ###shift_pixels = np.array(avgcentre) - np.array(shadowcentre)
-            ########################################################################### 
-
-            # i.e. record shift  as tuple (x,y)
-            # json does not allow numpy types; need lists and ints
-            shift2 = list(shift_pixels)
-            #shift3 = [ int(s) for s in shift2 ]        
-            shift_mm = [ s*pitch for s in shift2 ]        
-            
-            # Store results in dictionary
-            #results[k] = list(shift3) 
-            results[k] = list(shift_mm) 
-        
-            '''# Plot centre of image and centroid of ball-bearing shadow
-            #sub[imagecentre[1]][imagecentre[0]] = -0.99
-            #sub[shadowcentre[0]][shadowcentre[1]] = -0.99
-            #plt.imshow(sub, cmap=plt.cm.gray)
-            #plt.title("Entry-exit spots.\nImage centre and ball-bearing shadow centre shown")
-            #plt.show()'''
-
+            args.append( (records[cnt], ga, en) )
 
-    #print("Mean shift (mm) from centre of spot from centre of image = {}".format( pitch*sum(spot_img_centre_shifts)/len(spot_img_centre_shifts) ) )
-    #print("Max shift = {}".format( max(spot_img_centre_shifts)*pitch ) )
+    shifts = map_beams(beam_shift, args, executor)
 
-    #print("Mean shift (mm) from centre of entry and exit spot = {}".format( pitch*sum(centre_shifts)/len(centre_shifts) ) )
-    #print("Max shift = {}".format( max(centre_shifts)*pitch ) )
-            
-    # New line after porgress bar
-    sys.stdout.write("\n")
-    sys.stdout.flush()
-            
-    return results
+    return BeamResults.from_beams(gantry_angles, energies, shifts, SHIFT_FIELDS)
         
 
 
@@ -255,31 +479,21 @@ def total_shift_3d(p1, p2, target):
 
 
 
-def shift_vector_logos_coords(gantry_angles, energies, directory, beams, target):
+def shift_vector_logos_coords(gantry_angles, energies, records, target):
     """Calculate 3D shift vector, in Logos coord system, from the isocentre
     to the closest point on beam vector"""
     
-    shifts_3d = {}
+    shifts_3d = []
     cnt=-1
     for ga in gantry_angles:
         for en in energies:
             cnt+=1
             
-            progress_bar(cnt, len(beams) )
+            progress_bar(cnt, len(records) )
     
-            # key for storing result
-            k = "GA"+str(ga)+"E"+str(en)
-    
-            beamfile = join(directory,beams[cnt])+".csv" 
-            # Get centre coords of entry/exit spots, p1/p2
-            dataline = ""
-            with open( beamfile ) as f:
-                for line in f.readlines():
-                    if "XRV Beam Data" in line:
-                        dataline=line
-            sl = dataline.split(",")
-            p1 = np.array( [sl[2],sl[3],sl[4]] ).astype(float)
-            p2 = np.array( [sl[6],sl[7],sl[8]] ).astype(float)                
+            # Centre coords of entry/exit spots, p1/p2
+            p1 = records[cnt].p1
+            p2 = records[cnt].p2
             
            ## shift = total_3d_shift(p1,p2,target)
 
@@ -296,13 +510,12 @@ def shift_vector_logos_coords(gantry_angles, energies, directory, beams, target)
             c = np.array( [x,y,z] )
         
             shift_vector = target - c 
-            # need list for json dump
-            shifts_3d[k] = list(shift_vector)
+            shifts_3d.append(shift_vector)
             
     # New line after porgress bar
     sys.stdout.write("\n")
     sys.stdout.flush()
-    return shifts_3d
+    return BeamResults.from_beams(gantry_angles, energies, shifts_3d, SHIFT_3D_FIELDS)
 
 
 
@@ -311,68 +524,26 @@ def shift_vector_logos_coords(gantry_angles, energies, directory, beams, target)
 
 
 
-def read_spot_diameters(gantry_angles, energies, directory, beams):
+def read_spot_diameters(gantry_angles, energies, records):
     """Retrieve entry spot "diameter" from csv file
     FUNCTION WILL NOT WORK IF THERE IS MISSING DATA
     """
     
     #TODO: Should I take the average of the entry and exit spot diameters?
     
-    results = {}
-    cnt = -1
-    for ga in gantry_angles:
-        for en in energies:
-            cnt+=1
-            
-            progress_bar(cnt, len(beams) )
-            
-            # key for storing result
-            k = "GA"+str(ga)+"E"+str(en)
-            with open( join(directory,beams[cnt])+".csv" ) as f:
-                #First line contains diameter
-                line = f.readline()
-                diameter = float( line.split("Diameter:,")[1].split(",")[0].strip() )
-                results[k] = diameter
-
-    # New line after porgress bar
-    sys.stdout.write("\n")
-    sys.stdout.flush()
-
-    return results
+    diameters = [ r.diameter for r in records[:len(gantry_angles)*len(energies)] ]
+    return BeamResults.from_beams(gantry_angles, energies, diameters, DIAMETER_FIELDS)
 
 
 
 
-def read_arc_radial_widths(gantry_angles, energies, directory, beams):
+def read_arc_radial_widths(gantry_angles, energies, records):
     """Retrieve entry spot "arc" (BEV-X) and "radial" (BEV-Y) widths 
     from entry spot csv file
     """
         
-    results = {}
-    cnt = -1
-    for ga in gantry_angles:
-        for en in energies:
-            cnt+=1
-            
-            progress_bar(cnt, len(beams) )
-            
-            # key for storing result
-            k = "GA"+str(ga)+"E"+str(en)
-            with open( join(directory,beams[cnt])+".csv" ) as f:
-                arc, radial = None, None
-                for line in f.readlines():
-                    if "Arc Style" in line:
-                        arc = float( line.split("Entry (mm):,")[1].split(",")[0].strip() )
-                    if "Radial Style" in line:
-                        radial = float( line.split("Entry (mm):,")[1].split(",")[0].strip() )             
-
-            results[k] = (arc,radial)
-
-    # New line after porgress bar
-    sys.stdout.write("\n")
-    sys.stdout.flush()
-
-    return results
+    widths = [ (r.arc, r.radial) for r in records[:len(gantry_angles)*len(energies)] ]
+    return BeamResults.from_beams(gantry_angles, energies, widths, ARC_RADIAL_FIELDS)
 
 
 
@@ -391,6 +562,9 @@ def sigma_from_gaussian_lmfit(profile, pitch):
 
     # TODO: this needs to be robust; catch poor fits; choose better starting points
 
+    # Slow to import; only needed here
+    from lmfit import Model, Parameters
+
     profile_max = max(profile)
     xvals = np.array( range(len(profile))  ) * pitch     ##PITCH
     yvals = np.array(profile) / profile_max              ## NORM
@@ -429,8 +603,159 @@ def sigma_from_gaussian_lmfit(profile, pitch):
 
 
 
-def sigma_angled_profile(spot_img, img_angle, pitch):
-    """Returns sigma of spot from a profile taken at img_angle
+def gaus_jacobian(x,a,x0,sigma):
+    """Partial derivatives of gaus() wrt a, x0 and sigma; shape (len(x),3)"""
+    g = np.exp(-(x-x0)**2/(2*sigma**2))
+    return np.column_stack( [g, a*g*(x-x0)/sigma**2, a*g*(x-x0)**2/sigma**3] )
+
+
+
+def gaussian_initial_guess(xvals, yvals, frac=0.2):
+    """Return (a, x0, sigma) estimate of Gaussian profile without iteration
+
+    Caruana's method: weighted parabola fit to log of points above frac 
+    of the max. Falls back to moments of the profile if that fails.
+    """
+    use = yvals > frac*yvals.max()
+    if np.count_nonzero(use)>=3:
+        # ln(y) = c0 + c1*x + c2*x^2; weight by y as noise is on y, not ln(y)
+        c2,c1,c0 = np.polyfit(xvals[use], np.log(yvals[use]), 2, w=yvals[use])
+        if c2<0:
+            x0 = -c1/(2*c2)
+            sigma = (-1/(2*c2))**0.5
+            a = np.exp( c0 - c1**2/(4*c2) )
+            return a, x0, sigma
+
+    # Moments
+    w = yvals.clip(min=0)
+    x0 = (w*xvals).sum()/w.sum()
+    sigma = ( (w*(xvals-x0)**2).sum()/w.sum() )**0.5
+    return yvals.max(), x0, sigma
+
+
+
+def sigma_from_gaussian_fast(profile, pitch):
+    """Return sigma from least-squares Gaussian fit with analytic Jacobian
+
+    Starts from the non-iterative gaussian_initial_guess() so the 
+    Levenberg-Marquardt fit converges in a few iterations. Falls back to
+    sigma_from_gaussian_lmfit() if the fit fails or gives sigma outside
+    the 2.5-8 mm range checked there.
+    """
+    profile_max = max(profile)
+    xvals = np.arange( len(profile) ) * pitch          ##PITCH
+    yvals = np.asarray(profile, dtype=float) / profile_max    ## NORM
+
+    p0 = gaussian_initial_guess(xvals, yvals)
+
+    from scipy.optimize import least_squares
+    fit = least_squares( lambda p: gaus(xvals,*p)-yvals, p0, 
+                         jac=lambda p: gaus_jacobian(xvals,*p), method="lm" )
+    best_sigma = abs(fit.x[2])
+
+    if( not fit.success or best_sigma<2.5 or best_sigma>8.0):
+        print("  !! sig={}: trying lmfit".format(best_sigma))
+        best_sigma = sigma_from_gaussian_lmfit(profile, pitch)
+
+    return best_sigma
+
+
+
+def sigma_from_gaussian(profile, pitch):
+    """Return sigma from Gaussian fit using method set in config (SIGMA_FIT)"""
+    if SIGMA_FIT=="lmfit":
+        return sigma_from_gaussian_lmfit(profile, pitch)
+    elif SIGMA_FIT in ("fast","batch"):
+        return sigma_from_gaussian_fast(profile, pitch)
+    else:
+        raise ValueError("Unknown SIGMA_FIT method: {}".format(SIGMA_FIT))
+
+
+
+
+def sigmas_from_gaussian_batch(profiles, pitches, max_iter=100, tol=1e-10):
+    """Return array of sigmas from Gaussian fits to all profiles in one solve
+
+    Profiles (normalised, padded to the same length and masked) are fitted
+    together by a vectorised Levenberg-Marquardt iteration with an analytic
+    Jacobian; each profile stops iterating once converged. Profiles that do
+    not converge, or give sigma outside 2.5-8 mm, are fitted individually 
+    with sigma_from_gaussian_lmfit().
+    """
+    nprof = len(profiles)
+    length = max( len(p) for p in profiles )
+    pitches = np.broadcast_to( np.asarray(pitches, dtype=float), (nprof,) )
+
+    # Padded profiles (y), positions (x) and mask of real data points (w)
+    y = np.zeros( [nprof,length] )
+    w = np.zeros( [nprof,length] )
+    for i,p in enumerate(profiles):
+        y[i,:len(p)] = np.asarray(p, dtype=float) / np.max(p)     ## NORM
+        w[i,:len(p)] = 1.0
+    x = np.arange(length)[np.newaxis,:] * pitches[:,np.newaxis]     ##PITCH
+
+    params = np.array( [ gaussian_initial_guess(x[i,w[i]>0], y[i,w[i]>0]) 
+                         for i in range(nprof) ] )
+
+    a, x0, sigma = params[:,0:1], params[:,1:2], params[:,2:3]
+    g = np.exp( -(x-x0)**2/(2*sigma**2) )
+    r = (a*g - y)*w
+    cost = (r**2).sum(axis=1)
+    lam = np.full(nprof, 1e-3)
+    active = np.ones(nprof, dtype=bool)
+    converged = np.zeros(nprof, dtype=bool)
+
+    for it in range(max_iter):
+        # Only iterate profiles still being fitted
+        idx = np.flatnonzero(active)
+        if len(idx)==0:
+            break
+        xi, wi = x[idx], w[idx]
+        a, x0, sigma = params[idx,0:1], params[idx,1:2], params[idx,2:3]
+        gi = g[idx]
+        jac = np.stack( [gi, a*gi*(xi-x0)/sigma**2, a*gi*(xi-x0)**2/sigma**3], axis=2 ) * wi[:,:,np.newaxis]
+        jt = jac.transpose(0,2,1)
+        jtj = jt @ jac
+        jtr = jt @ r[idx][:,:,np.newaxis]
+        # Marquardt damping of diagonal
+        damped = jtj + lam[idx,np.newaxis,np.newaxis] * jtj * np.eye(3)
+        ok = np.abs( np.linalg.det(damped) ) > 1e-300
+        step = np.zeros( [len(idx),3] )
+        step[ok] = np.linalg.solve( damped[ok], -jtr[ok] )[:,:,0]
+        active[idx[~ok]] = False
+        idx, step = idx[ok], step[ok]
+
+        trial = params[idx] + step
+        a, x0, sigma = trial[:,0:1], trial[:,1:2], trial[:,2:3]
+        g_trial = np.exp( -(x[idx]-x0)**2/(2*sigma**2) )
+        r_trial = (a*g_trial - y[idx])*w[idx]
+        cost_trial = (r_trial**2).sum(axis=1)
+
+        better = cost_trial <= cost[idx]
+        small = better & ( (cost[idx]-cost_trial) <= tol*cost[idx] )
+        acc = idx[better]
+        params[acc] = trial[better]
+        r[acc], g[acc], cost[acc] = r_trial[better], g_trial[better], cost_trial[better]
+        lam[acc] /= 10
+        lam[idx[~better]] *= 10
+
+        converged[idx[small]] = True
+        active[idx[small]] = False
+        active[lam > 1e10] = False
+
+    sigmas = np.abs(params[:,2])
+
+    # Individual fits where batch fit failed
+    for i in np.flatnonzero( ~converged | (sigmas<2.5) | (sigmas>8.0) ):
+        print("  !! sig={}: trying lmfit".format(sigmas[i]))
+        sigmas[i] = sigma_from_gaussian_lmfit(profiles[i], pitches[i])
+
+    return sigmas
+
+
+
+def angled_profile(spot_img, img_angle):
+    """Returns profile through centre of image taken at img_angle
     """
 
     nrows = spot_img.shape[0]
@@ -447,58 +772,152 @@ def sigma_angled_profile(spot_img, img_angle, pitch):
     startpt = (strt_y,strt_x)
     endpt   = (end_y,end_x)
     
-    profile = profile_line(spot_img, startpt, endpt)
+    # profile_line interpolates in the dtype of the image, so give it float
+    img = scratch("profile", spot_img.shape, np.float32)
+    img[...] = spot_img
+
+    from skimage.measure import profile_line
+    return profile_line(img, startpt, endpt)
+
 
-    sigma = sigma_from_gaussian_lmfit(profile, pitch)
+
+def sigma_angled_profile(spot_img, img_angle, pitch):
+    """Returns sigma of spot from a profile taken at img_angle
+    """
+    profile = angled_profile(spot_img, img_angle)
+    sigma = sigma_from_gaussian(profile, pitch)
     return sigma
 
 
 
 
-def analyse_spot_profiles(gantry_angles, energies, directory, beams):
+@timing.per_beam(record_beam)
+def beam_profiles(record, ga=None, en=None):
+    """Returns x and y profiles through single beam's entry spot 
+    (taken at specified angle in IMAGE coords)
+    """
+    entry = record.entry
+
+    ## Angle profile=0 at GA=0 SPOT and BEV and IMAGE axes all match
+    ## hence implies x-profile in IMAGE COORDS but y profile in SPOT COORDS (AT GA=0)
+    ##x_profile = angled_profile( entry, -ga )
+    ##y_profile = angled_profile( entry, 90-ga )
+
+    ## USE THESE FOR FIXED IMAGE COORD PROFILES (BEV coords)
+    x_profile = angled_profile( entry, 0 )
+    y_profile = angled_profile( entry, 90 )
+
+    return x_profile, y_profile
+
+
+
+def check_sigmas(x_sigma, y_sigma):
+    """Print sigmas if outside expected range"""
+    if(x_sigma>8 or y_sigma>8):
+        print("x_sigma={}, y_sigma={}".format(x_sigma, y_sigma) )
+    elif(x_sigma<2 or y_sigma<2):
+        print("x_sigma={}, y_sigma={}".format(x_sigma, y_sigma) )        
+
+
+
+@timing.per_beam(record_beam)
+def beam_sigmas(record, ga=None, en=None):
+    """Returns sigma of single beam's entry spot in x,y 
+    (from profiles taken at specified angle in IMAGE coords)
+    """
+    x_profile, y_profile = beam_profiles(record, ga, en)
+
+    x_sigma = sigma_from_gaussian( x_profile, record.pitch )
+    y_sigma = sigma_from_gaussian( y_profile, record.pitch )
+ 
+    check_sigmas(x_sigma, y_sigma)
+
+    return (x_sigma, y_sigma)
+
+
+
+# Results of a single beam, as returned by worker processes: [x,y] shift 
+# (mm) in IMAGE COORDINATES, (x,y) sigmas (mm) and the Logos spot diameter
+BeamSummary = namedtuple("BeamSummary", ["shift","sigmas","diameter"])
+
+
+
+@timing.per_beam(record_beam)
+def beam_summary(record, ga=None, en=None):
+    """Returns BeamSummary of single beam: shift, sigmas and diameter
+
+    With SIGMA_FIT="batch" the two profiles of the beam are fitted together,
+    which gives the same sigmas as fitting the profiles of all beams together
+    """
+    shift = beam_shift(record, ga, en)
+    if SIGMA_FIT=="batch":
+        sigmas = tuple( sigmas_from_gaussian_batch(beam_profiles(record, ga, en), record.pitch) )
+        check_sigmas(*sigmas)
+    else:
+        sigmas = beam_sigmas(record, ga, en)
+    return BeamSummary(shift, sigmas, record.diameter)
+
+
+
+def analyse_beams(gantry_angles, energies, records, executor=None):
+    """Shifts, sigmas and diameters of all beams in one pass, e.g. on worker
+    processes so that each beam is sent (see map_beams) and its BeamSummary 
+    returned only once
+
+    Returns dict of BeamResults with keys "shifts" (x,y in IMAGE COORDINATES),
+    "spot_sigmas" and "spot_diameters"
+    """
+    args = []
+    cnt = -1
+    for ga in gantry_angles:
+        for en in energies:
+            cnt+=1
+            args.append( (records[cnt], ga, en) )
+
+    summaries = map_beams(beam_summary, args, executor)
+
+    return {"shifts":BeamResults.from_beams(gantry_angles, energies,
+                                            [s.shift for s in summaries], SHIFT_FIELDS),
+            "spot_sigmas":BeamResults.from_beams(gantry_angles, energies,
+                                                 [s.sigmas for s in summaries], SIGMA_FIELDS),
+            "spot_diameters":BeamResults.from_beams(gantry_angles, energies,
+                                                    [s.diameter for s in summaries], DIAMETER_FIELDS)}
+
+
+
+def analyse_spot_profiles(gantry_angles, energies, records, executor=None):
     """Returns sigma of spot in x,y of SPOT COORDINATE system 
     (from a profile taken at specified angle in IMAGE coords)
 
 
     CHOICE of "spot" coords or "BEV" coords (to be commented out)
+    in beam_profiles(). Beams are analysed in parallel if a 
+    concurrent.futures executor is given. With SIGMA_FIT="batch" the 
+    profiles of all beams are fitted together.
     """
 
     ## CAN I SIMPLY USE PITCH IF TAKING PROFILE AT AN ANGLE???????????
 
-    results = {}
+    args = []
     cnt=-1
     for ga in gantry_angles:
         for en in energies:    
             cnt+=1
-            
-            progress_bar(cnt, len(beams) )
-
-            k="GA"+str(ga)+"E"+str(en) 
             # Print which file corresponds to which beam
-            #print("{},{}".format(beams[cnt],k))
-            
-            entry, pitch = get_image_data( join(directory,beams[cnt])+".csv" ) 
-
-            ## Angle profile=0 at GA=0 SPOT and BEV and IMAGE axes all match
-            ## hence implies x-profile in IMAGE COORDS but y profile in SPOT COORDS (AT GA=0)
-            ##x_sigma = sigma_angled_profile( entry, -ga, pitch )
-            ##y_sigma = sigma_angled_profile( entry, 90-ga,  pitch )
-
-            ## USE THESE FOR FIXED IMAGE COORD PROFILES (BEV coords)
-            x_sigma = sigma_angled_profile( entry, 0, pitch )
-            y_sigma = sigma_angled_profile( entry, 90, pitch )
-         
-
-            if(x_sigma>8 or y_sigma>8):
-                print("x_sigma={}, y_sigma={}".format(x_sigma, y_sigma) )
-            elif(x_sigma<2 or y_sigma<2):
-                print("x_sigma={}, y_sigma={}".format(x_sigma, y_sigma) )        
-
-            results[k] = (x_sigma, y_sigma)
-            
-    # New line after porgress bar
-    sys.stdout.write("\n")
-    sys.stdout.flush()
-
-    return results
+            #print("{},GA{}E{}".format(records[cnt].beam_id,ga,en))
+            args.append( (records[cnt], ga, en) )
+
+    if SIGMA_FIT=="batch":
+        profiles = map_beams(beam_profiles, args, executor)
+        # Flatten to [x0,y0,x1,y1,...]
+        flat = [ p for xy in profiles for p in xy ]
+        pitches = [ a[0].pitch for a in args for i in range(2) ]
+        with timing.stage("batch sigma fit", profiles=len(flat)):
+            fitted = sigmas_from_gaussian_batch(flat, pitches)
+        sigmas = [ (fitted[2*i], fitted[2*i+1]) for i in range(len(args)) ]
+        for x_sigma, y_sigma in sigmas:
+            check_sigmas(x_sigma, y_sigma)
+    else:
+        sigmas = map_beams(beam_sigmas, args, executor)
 
+    return BeamResults.from_beams(gantry_angles, energies, sigmas, SIGMA_FIELDS)
@@ -1,11 +1,13 @@
-import json
-from math import radians
+from os.path import join
 
 import matplotlib.pyplot as plt
 from matplotlib import cm
+from matplotlib.lines import Line2D
 import numpy as np
 import easygui
 
+from results import BeamResults
+
 
 
 def select_file():
@@ -31,87 +33,101 @@ def trim_axs(axs, N):
 
 
 
+def legend_proxies(labels, colors, marker="o"):
+    """Return one legend handle per label, drawn as a marker of given color"""
+    return [ Line2D([], [], marker=marker, linestyle="", color=c, label=l)
+             for l,c in zip(labels,colors) ]
+
+
+def reference_lines(ax, lim=1.5):
+    """Dotted lines through origin, drawn once per axes"""
+    # Previously drawn once per point at alpha=0.01 in the cycle colours,
+    # which built up to a faint line; one grey line at alpha=0.2 looks alike
+    ax.plot( [-lim,lim], [0,0], linestyle=":", color="grey", alpha=0.2 )
+    ax.plot( [0,0], [-lim,lim], linestyle=":", color="grey", alpha=0.2 )
+
+
+
 ############### SHIFTS #################
 
 
-def plot_shifts_by_gantry(gantry_angles, energies, results, imgname=None):
+def plot_shifts_by_gantry(results, imgname=None):
     """
-    Plots showing shifts for each gantry angle
+    Plots showing shifts for each gantry angle; results is BeamResults
     """
+    gantry_angles, energies = results.gantry_angles, results.energies
     rows=4
     cols=4
 
     fig,axs = plt.subplots(rows,cols, figsize=(15,12), constrained_layout=True)
     axs = trim_axs(axs, len(gantry_angles) )
 
-    for ga,ax in zip(gantry_angles,axs):
-
-        colors = cm.rainbow(np.linspace(0, 1, len(energies)))
+    colors = cm.rainbow(np.linspace(0, 1, len(energies)))
 
-        for en,c in zip(energies,colors):    
-            k="GA"+str(ga)+"E"+str(en)
-            ax.scatter(results[k][0], results[k][1], color=c, label=str(en) )
-            ax.plot( [-1.5,1.5], [0,0], linestyle=":", alpha=0.01 )
-            ax.plot( [0,0], [-1.5,1.5], linestyle=":", alpha=0.01 )
+    for ga,ax in zip(gantry_angles,axs):
+        # All energies in a single scatter
+        xy = results.by_gantry(ga)
+        ax.scatter(xy[:,0], xy[:,1], color=colors )
+        reference_lines(ax)
         ax.set_xlim(-1.5,1.5)
         ax.set_ylim(-1.5,1.5)
         ax.set_title("GA = {}".format(str(ga)))
 
-    handles, labels = plt.gca().get_legend_handles_labels()
-    by_label = dict( zip(labels,handles) )
-    fig.legend(by_label.values(), by_label.keys(), bbox_to_anchor=(0.62,0.22), ncol=3, title="Energy (MeV)" ) 
+    handles = legend_proxies( [str(en) for en in energies], colors )
+    fig.legend(handles=handles, bbox_to_anchor=(0.62,0.22), ncol=3, title="Energy (MeV)" ) 
     fig.suptitle("BEV (x,y) shifts in mm", fontsize=16)
     plt.xlabel("x shift (mm)")
     plt.ylabel("y shift (mm)")
     if imgname is not None:
         fig.savefig(imgname, dpi=fig.dpi)
+        plt.close(fig)
     else:
         plt.show()
 
 
 
 
-def plot_shifts_by_energy(gantry_angles, energies, results, imgname=None):
+def plot_shifts_by_energy(results, imgname=None):
     """
-    Plots showing shifts for each energy
+    Plots showing shifts for each energy; results is BeamResults
     """
+    gantry_angles, energies = results.gantry_angles, results.energies
     rows=4
     cols=5
 
     fig,axs = plt.subplots(rows,cols, figsize=(15,12), constrained_layout=True)
     axs = trim_axs(axs, len(energies))
 
-    for en,ax in zip(energies,axs):
-
-        colors = cm.rainbow(np.linspace(0, 1, len(gantry_angles)))
+    colors = cm.rainbow(np.linspace(0, 1, len(gantry_angles)))
 
-        for ga,c in zip(gantry_angles,colors):    
-            k="GA"+str(ga)+"E"+str(en)
-            ax.scatter(results[k][0], results[k][1], color=c, label=str(ga))
-            ax.plot( [-1.5,1.5], [0,0], linestyle=":", alpha=0.01 )
-            ax.plot( [0,0], [-1.5,1.5], linestyle=":", alpha=0.01 )
+    for en,ax in zip(energies,axs):
+        # All gantry angles in a single scatter
+        xy = results.by_energy(en)
+        ax.scatter(xy[:,0], xy[:,1], color=colors )
+        reference_lines(ax)
         ax.set_xlim(-1.5,1.5)
         ax.set_ylim(-1.5,1.5)
         ax.set_title("E = {} MeV".format(str(en)))
         
-    handles, labels = plt.gca().get_legend_handles_labels()
-    by_label = dict( zip(labels,handles) )
-    fig.legend(by_label.values(), by_label.keys(), bbox_to_anchor=(0.97,0.23), ncol=2, title="GA (degrees)" )
+    handles = legend_proxies( [str(ga) for ga in gantry_angles], colors )
+    fig.legend(handles=handles, bbox_to_anchor=(0.97,0.23), ncol=2, title="GA (degrees)" )
     fig.suptitle("BEV (x,y) shifts in mm", fontsize=16)
     plt.xlabel("x shift (mm)")
     plt.ylabel("y shift (mm)")
     if imgname is not None:
         fig.savefig(imgname, dpi=fig.dpi)
+        plt.close(fig)
     else:
         plt.show()
 
 
 
 
-def plot_xyshifts_vs_gantry(gantry_angles, energies, results, imgname=None):
+def plot_xyshifts_vs_gantry(results, imgname=None):
     """
     Plots showing x,y shifts separately vs GA for each energy
     """
+    gantry_angles, energies = results.gantry_angles, results.energies
     rows=4
     cols=5
 
@@ -120,15 +136,8 @@ def plot_xyshifts_vs_gantry(gantry_angles, energies, results, imgname=None):
 
     for en,ax in zip(energies,axs):
 
-        colors = cm.rainbow(np.linspace(0, 1, len(gantry_angles)))
-        xshifts=[]
-        yshifts=[]
-
-        for ga,c in zip(gantry_angles,colors):    
-            k="GA"+str(ga)+"E"+str(en)
-            #ax.scatter(results[k][0]*PIXEL_SIZE, results[k][1]*PIXEL_SIZE, color=c, label=str(ga))
-            xshifts.append( results[k][0] )
-            yshifts.append( results[k][1] )
+        xshifts = results.by_energy(en)[:,0]
+        yshifts = results.by_energy(en)[:,1]
         ax.set_xlim(-181,181)
         ax.set_ylim(-2,2)
         #ax.set_xlabel("GA (degree)")
@@ -145,15 +154,17 @@ def plot_xyshifts_vs_gantry(gantry_angles, energies, results, imgname=None):
     plt.ylabel("Shift (mm)")
     if imgname is not None:
         fig.savefig(imgname, dpi=fig.dpi)
+        plt.close(fig)
     else:
         plt.show()
 
 
 
-def plot_xyshifts_vs_energy(gantry_angles, energies, results, imgname=None):
+def plot_xyshifts_vs_energy(results, imgname=None):
     """
     Plots showing x,y shifts separately vs GA for each energy
     """
+    gantry_angles, energies = results.gantry_angles, results.energies
     rows=4
     cols=4
 
@@ -162,15 +173,8 @@ def plot_xyshifts_vs_energy(gantry_angles, energies, results, imgname=None):
 
     for ga,ax in zip(gantry_angles,axs):
 
-        colors = cm.rainbow(np.linspace(0, 1, len(energies)))
-        xshifts=[]
-        yshifts=[]
-
-        for en,c in zip(energies,colors):    
-            k="GA"+str(ga)+"E"+str(en)
-            #ax.scatter(results[k][0]*PIXEL_SIZE, results[k][1]*PIXEL_SIZE, color=c, label=str(ga))
-            xshifts.append( results[k][0] )
-            yshifts.append( results[k][1] )
+        xshifts = results.by_gantry(ga)[:,0]
+        yshifts = results.by_gantry(ga)[:,1]
         ax.set_xlim(60,260)
         ax.set_ylim(-2,2)
         #ax.set_xlabel("GA (degree)")
@@ -187,6 +191,7 @@ def plot_xyshifts_vs_energy(gantry_angles, energies, results, imgname=None):
     plt.ylabel("Shift (mm)")
     if imgname is not None:
         fig.savefig(imgname, dpi=fig.dpi)
+        plt.close(fig)
     else:
         plt.show()
 
@@ -194,18 +199,10 @@ def plot_xyshifts_vs_energy(gantry_angles, energies, results, imgname=None):
 def shifts_histogram(shifts, imgname=None):
     """Histogram of shifts from all spots
     
-    Input: dictionary {"GA180E150":[xshift,yshift],...}
+    Input: BeamResults of x,y shifts
     """
-    #with open(shifts22, encoding='utf-8') as F:
-    #    shifts = json.loads(F.read())
     # Absolute displacement
-    displacements=[]
-    for key in shifts:
-        xy = shifts[key]
-        total_shift = (xy[0]**2 + xy[1]**2)**0.5
-        ##if total_shift>0.99:
-        ##    print("2D {} = {}mm".format(key,total_shift))
-        displacements.append(total_shift)
+    displacements = shifts.magnitude().ravel()
     
     bins = [0+i*0.1 for i in range(25)]
     fig=plt.figure()
@@ -215,6 +212,7 @@ def shifts_histogram(shifts, imgname=None):
     plt.xlabel("Shift (mm)")
     if imgname is not None:
         fig.savefig(imgname, dpi=fig.dpi)
+        plt.close(fig)
     else:
         plt.show()
    
@@ -222,18 +220,10 @@ def shifts_histogram(shifts, imgname=None):
 def shifts_3d_histogram(shifts_3d, imgname=None):
     """Histogram of shifts in 3D Logos coords from all spots
     
-    Input: dictionary {"GA180E150":[xshift,yshift,zshift],...}
+    Input: BeamResults of x,y,z shifts
     """
-    #with open(shifts_3d22, encoding='utf-8') as F:
-    #    shifts_3d = json.loads(F.read())
     ## Absolute displacement
-    displacements=[]
-    for key in shifts_3d:
-        xyz = shifts_3d[key]
-        total_shift = (xyz[0]**2 + xyz[1]**2 + xyz[2]**2)**0.5
-        ##if total_shift>0.99:
-        ##    print("3D {} = {}mm".format(key,total_shift))
-        displacements.append(total_shift)
+    displacements = shifts_3d.magnitude().ravel()
     
     bins = [0+i*0.1 for i in range(25)]
     fig=plt.figure()
@@ -243,39 +233,25 @@ def shifts_3d_histogram(shifts_3d, imgname=None):
     plt.xlabel("Shift (mm)")
     if imgname is not None:
         fig.savefig(imgname, dpi=fig.dpi)
+        plt.close(fig)
     else:
         plt.show()     
         
         
         
-def shifts_polar(gantry_angles, energies, shifts, imgname=None):
+def shifts_polar(shifts, imgname=None):
     """Polar plot of shifts from all spots
     
-    Input: dictionary {"GA180E150":[xshift,yshift],...}
+    Input: BeamResults of x,y shifts
     """
-    #ENERGY = [245,240]+list( range(230,69,-10) )
-    #with open(shifts22, encoding='utf-8') as F:
-    #    shifts = json.loads(F.read())  
-           
+    energies = shifts.energies
     # Absolute displacement
-    displacements = {}
-    for key in shifts:
-        xy = shifts[key]
-        total_shift = (xy[0]**2 + xy[1]**2)**0.5
-        displacements[key] = total_shift
+    d = shifts.magnitude().ravel()
     
     colors = cm.rainbow(np.linspace(0, 1, len(energies)))
-    ga=[]
-    en=[]
-    d=[]
-    cols=[]   
-    for key in displacements:
-        angle = int(key.split("GA")[1].split("E")[0])   
-        ga.append( radians(angle) )
-        energy = int(key.split("E")[1])
-        en.append(energy)
-        cols.append( colors[energies.index(energy)] )        
-        d.append(displacements[key])    
+    # GA and energy of each displacement
+    ga = np.repeat( np.radians(shifts.gantry_angles), len(energies) )
+    cols = np.tile( colors, (len(shifts.gantry_angles),1) )
 
     fig, ax = plt.subplots(subplot_kw={'projection': 'polar'})   
     ax.set_rmax(2)
@@ -284,19 +260,18 @@ def shifts_polar(gantry_angles, energies, shifts, imgname=None):
     ax.grid(True)
     ax.set_theta_zero_location("N")
     ax.set_theta_direction(-1)  
-    for angle,energy,dist,c in zip(ga,en,d,cols):
-        ax.plot(angle,dist,color=c,marker='o',label=str(energy))
+    ax.scatter(ga, d, color=cols, marker='o')
     plt.title("Absolute spot shifts (mm)\n")
     
     # Set legend with energy
-    handles, labels = plt.gca().get_legend_handles_labels()
-    by_label = dict( zip(labels,handles) )
-    fig.legend(by_label.values(), by_label.keys(), bbox_to_anchor=(1.02,0.95),ncol=1, title="Energy (MeV)", frameon=False ) 
+    handles = legend_proxies( [str(en) for en in energies], colors )
+    fig.legend(handles=handles, bbox_to_anchor=(1.02,0.95),ncol=1, title="Energy (MeV)", frameon=False ) 
     #fig.legend(by_label.values(), by_label.keys(), bbox_to_anchor=(0.175,0.95),ncol=1, title="Energy (MeV)") 
 
     
     if imgname is not None:
         fig.savefig(imgname, dpi=fig.dpi) #, bbox_inches='tight'
+        plt.close(fig)
     else:
         plt.show()
 
@@ -305,67 +280,65 @@ def shifts_polar(gantry_angles, energies, shifts, imgname=None):
 
 ################ SPOT SIZES ######################
 
-def plot_spot_diameters_by_gantry(gantry_angles, energies, results, imgname=None):
+def plot_spot_diameters_by_gantry(results, imgname=None):
     """
     Plots showing spot size vs energy at each gantry angle
     """
+    gantry_angles, energies = results.gantry_angles, results.energies
     rows=4
     cols=4
 
     fig,axs = plt.subplots(rows,cols, figsize=(15,12), constrained_layout=True)
     axs = trim_axs(axs, len(gantry_angles) )
 
-    for ga,ax in zip(gantry_angles,axs):
-
-        colors = cm.rainbow(np.linspace(0, 1, len(energies)))
+    colors = cm.rainbow(np.linspace(0, 1, len(energies)))
 
-        for en,c in zip(energies,colors):    
-            k="GA"+str(ga)+"E"+str(en)
-            ax.scatter(en, results[k], color=c, label=str(en) )
+    for ga,ax in zip(gantry_angles,axs):
+        diameters = results.by_gantry(ga)[:,0]
+        ax.scatter(energies, diameters, color=colors )
         ax.set_ylim(4,15) # tune this to better see the oscilatory nature
         ax.set_title("GA = {}".format(str(ga)))
 
-    handles, labels = plt.gca().get_legend_handles_labels()
-    by_label = dict( zip(labels,handles) )
-    fig.legend(by_label.values(), by_label.keys(), bbox_to_anchor=(0.62,0.22), ncol=3, title="Energy (MeV)" ) 
+    handles = legend_proxies( [str(en) for en in energies], colors )
+    fig.legend(handles=handles, bbox_to_anchor=(0.62,0.22), ncol=3, title="Energy (MeV)" ) 
     fig.suptitle("Spot diameter (mm) vs energy", fontsize=16)
     plt.xlabel("Energy")
     plt.ylabel("Diameter (mm)")
     if imgname is not None:
         fig.savefig(imgname, dpi=fig.dpi)
+        plt.close(fig)
     else:
         plt.show()
 
 
-def plot_spot_diameters_by_energy(gantry_angles, energies, results, imgname=None):
+def plot_spot_diameters_by_energy(results, imgname=None):
     """
     Plots showing spot diameters vs GA at each beam energy
     """
+    gantry_angles, energies = results.gantry_angles, results.energies
     rows=4
     cols=5
 
     fig,axs = plt.subplots(rows,cols, figsize=(15,12), constrained_layout=True)
     axs = trim_axs(axs, len(energies) )
 
-    for en,ax in zip(energies,axs):
+    colors = cm.rainbow(np.linspace(0, 1, len(gantry_angles)))
 
-        colors = cm.rainbow(np.linspace(0, 1, len(gantry_angles)))
-
-        for ga,c in zip(gantry_angles,colors):    
-            k="GA"+str(ga)+"E"+str(en)
-            ax.scatter(ga, results[k], color=c, label=str(ga) )
+    for en,ax in zip(energies,axs):
+        diameters = results.by_energy(en)[:,0]
+        ax.scatter(gantry_angles, diameters, color=colors )
         ax.set_xlim(-200,200)
         ax.set_ylim(4,15) #use this to better see the oscilatory nature
         ax.set_title("E = {} MeV".format(str(en)))
 
-    handles, labels = plt.gca().get_legend_handles_labels()
-    by_label = dict( zip(labels,handles) )
-    fig.legend(by_label.values(), by_label.keys(), bbox_to_anchor=(0.98,0.22), ncol=2, title="GA (degrees)" ) 
+    handles = legend_proxies( [str(ga) for ga in gantry_angles], colors )
+    fig.legend(handles=handles, bbox_to_anchor=(0.98,0.22), ncol=2, title="GA (degrees)" ) 
     fig.suptitle("Spot diameter (mm) vs GA", fontsize=16)
     plt.xlabel("Gantry angle")
     plt.ylabel("Diameter (mm)")
     if imgname is not None:
         fig.savefig(imgname, dpi=fig.dpi)
+        plt.close(fig)
     else:
         plt.show()
 
@@ -374,25 +347,26 @@ def plot_spot_diameters_by_energy(gantry_angles, energies, results, imgname=None
 
 ############### SPOT SIGMAS X,Y #####################
 
-def plot_spot_sigmas(gantry_angles, energies, results, imgname=None, arc_radial=False):
+def plot_spot_sigmas(results, imgname=None, arc_radial=False):
     """Plot spot sigmas (x and y) for either SPOT or IMAGE xcoord systems
     """
+    gantry_angles, energies = results.gantry_angles, results.energies
     rows=4
     cols=5
 
     fig,axs = plt.subplots(rows,cols, figsize=(15,12), constrained_layout=True)
     axs = trim_axs(axs, len(energies) )
 
+    xlabel="x_sigma"
+    ylabel="y_sigma"
+    if arc_radial:
+        xlabel="arc width"
+        ylabel="radial width"
+
     for en,ax in zip(energies,axs):  
-        for ga in gantry_angles:    
-            k="GA"+str(ga)+"E"+str(en)
-            xlabel="x_sigma"
-            ylabel="y_sigma"
-            if arc_radial:
-                xlabel="arc width"
-                ylabel="radial width"
-            ax.scatter(ga, results[k][0], color="red", label=xlabel, alpha=0.7 )
-            ax.scatter(ga, results[k][1], color="blue", label=ylabel, alpha=0.7 )
+        xy = results.by_energy(en)
+        ax.scatter(gantry_angles, xy[:,0], color="red", alpha=0.7 )
+        ax.scatter(gantry_angles, xy[:,1], color="blue", alpha=0.7 )
 
         ax.set_xlim(-200,200)
         ax.set_ylim(2,8) #use this to better see the oscilatory nature
@@ -400,9 +374,8 @@ def plot_spot_sigmas(gantry_angles, energies, results, imgname=None, arc_radial=
             ax.set_ylim(4,15.8) ## diff lims if plotting arc & radial widths
         ax.set_title("E = {} MeV".format(str(en)))
 
-    handles, labels = plt.gca().get_legend_handles_labels()
-    by_label = dict( zip(labels,handles) )
-    fig.legend(by_label.values(), by_label.keys(), bbox_to_anchor=(0.96,0.22), ncol=1, title="Axis" )
+    handles = legend_proxies( [xlabel,ylabel], ["red","blue"] )
+    fig.legend(handles=handles, bbox_to_anchor=(0.96,0.22), ncol=1, title="Axis" )
     if arc_radial:
         fig.suptitle("Spot arc/radial widths vs GA", fontsize=16)
     else:
@@ -411,12 +384,46 @@ def plot_spot_sigmas(gantry_angles, energies, results, imgname=None, arc_radial=
     plt.ylabel("Diameter (mm)")
     if imgname is not None:
         fig.savefig(imgname, dpi=fig.dpi)
+        plt.close(fig)
     else:
         plt.show()
 
 
 
 
+############### RENDERING #####################
+
+def render_figure(func, args, kwargs, backend=None):
+    """Draw figure with plotting func, saving to kwargs["imgname"]; returns
+    image name. The pyplot backend is switched to backend if given"""
+    if backend is not None:
+        plt.switch_backend(backend)
+    before = set( plt.get_fignums() )
+    func(*args, **kwargs)
+    # Only figures made by func; the caller may have others open
+    for num in set( plt.get_fignums() ) - before:
+        plt.close(num)
+    return kwargs["imgname"]
+
+
+
+def render_figures(plots, directory, executor=None):
+    """Render and save figures; returns dict of PNG paths
+
+    plots is a dict {name: (plot function, args, kwargs)}; each figure is
+    saved as directory/name.png. Figures are rendered in parallel if a 
+    concurrent.futures executor is given.
+    """
+    jobs = {}
+    for name,(func,args,kwargs) in plots.items():
+        kwargs = dict(kwargs, imgname=join(directory,name+".png"))
+        jobs[name] = (func, args, kwargs)
+
+    if executor is None:
+        return { name:render_figure(*job) for name,job in jobs.items() }
+    # Non-interactive backend in the worker processes, which have no display
+    futures = { name:executor.submit(render_figure, *job, "Agg") for name,job in jobs.items() }
+    return { name:f.result() for name,f in futures.items() }
 
 
 
@@ -429,10 +436,8 @@ def main():
 
     resultsfile = select_file()    
 
-    results={}
     #with open("results_2020_0102_0001.txt") as filein:
-    with open(resultsfile) as filein:
-        results = json.load(filein)
+    results = BeamResults.from_json(resultsfile)
 
 
     # Note that the different plots require different
@@ -1,12 +1,8 @@
-import json
 import datetime
 
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_JUSTIFY
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, TableStyle, Table, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
+import numpy as np
+
+from results import BeamResults, beam_key
 
 
 ''' ## Temporary tolerances to be used
@@ -29,19 +25,14 @@ def get_date():
 
 
 def get_total_displacement( shifts ):
-    """Convert x,y shifts to total displacement"""
-    displacements = {}
-    for key in shifts:
-        xy = shifts[key]
-        total_shift = (xy[0]**2 + xy[1]**2)**0.5
-        displacements[key] = total_shift
-
-    return displacements
+    """Convert BeamResults of x,y shifts to total displacement"""
+    return BeamResults( shifts.gantry_angles, shifts.energies, 
+                        shifts.magnitude(), ("displacement",) )
 
 
-def get_table_data(gantry_angles, energies, displacements):
-    """Method taking dicitonary of beam (GAxEy) and total displacement
-    and formatting it for ReportLab PDF table"""
+def get_table_data(displacements):
+    """Method taking BeamResults of total displacement and formatting it 
+    for ReportLab PDF table"""
     
     data = []
 
@@ -49,48 +40,32 @@ def get_table_data(gantry_angles, energies, displacements):
     line_1 = ['Gantry', '50% energies < 1mm', 'Less than 5 energies > 1.5mm', 'No energy > 2mm']
     data.append(line_1)
 
-    for ga in gantry_angles:
-        # Store beams that were out of certain tolerances
-        gt_1 = []
-        gt_1p5 = []
-        gt_2 = []
-        gt_2p5 = []
+    n_energies = len(displacements.energies)
+    for ga in displacements.gantry_angles:
+        d = displacements.by_gantry(ga)[:,0]
 
         ## Format of data lines (row tables) is [GA, tol 1 pass/fail, tol 2 tol 3]
         data_line = ["NONE_ERROR"]*4   
         data_line[0] = str(ga)
 
-        for en in energies:
-            k="GA"+str(ga)+"E"+str(en)
-
-            if displacements[k] > 2.5:
-                gt_2p5.append(k)
-            elif displacements[k] > 2.0:
-                gt_2.append(k)
-            elif displacements[k] > 1.5:
-                gt_1p5.append(k)
-            elif displacements[k] > 1.0:
-                gt_1.append(k)
+        # Beams over the suspension limit are reported separately and not
+        # counted against the action limits
+        gt_2p5 = d > 2.5
+        below_2p5 = ~gt_2p5
 
         # Check tolerances per GA
-        if len(gt_2p5)>0:
-            print("WARNING: Suspension limit exceeded; beams {}\n".format( list(gt_2p5.keys()) ))
-            #print(gt_2p5)
-        if len(gt_2)>0:
-            #print("WARNING: 2mm Action limit exceeded for GA={}\n".format(ga))
-            #print( gt_2 + gt_2p5 )
+        if np.any(gt_2p5):
+            keys = [ beam_key(ga,en) for en,v in zip(displacements.energies,gt_2p5) if v ]
+            print("WARNING: Suspension limit exceeded; beams {}\n".format(keys))
+        if np.count_nonzero(below_2p5 & (d > 2.0)) > 0:
             data_line[3] = "FAIL"
         else:
             data_line[3] = "pass"
-        if len(gt_1p5)+len(gt_2) >= 5:
-            #print("WARNING: 1.5mm Action Limit exceeded for GA={}\n".format(ga))
-            #print( gt_1p5 + gt_2 + gt_2p5 )
+        if np.count_nonzero(below_2p5 & (d > 1.5)) >= 5:
             data_line[2] = "FAIL"
         else:
             data_line[2] = "pass"
-        if len(gt_1)+len(gt_1p5)+len(gt_2) >= len(energies)/2.0:
-            #print("WARNING: 1.0mm Action Limit exceeded for GA={}\n".format(ga))
-            #print( gt_1 + gt_1p5 + gt_2 + gt_2p5 )
+        if np.count_nonzero(below_2p5 & (d > 1.0)) >= n_energies/2.0:
             data_line[1]  = "FAIL"
         else:
             data_line[1] = "pass"
@@ -102,12 +77,20 @@ def get_table_data(gantry_angles, energies, displacements):
 
 
 
-def summary_reportlab(gantry_angles,energies,op1,op2,shifts, acq_datetime, gantry_name, images=None, output=None ):
+def summary_reportlab(op1,op2,shifts, acq_datetime, gantry_name, images=None, output=None ):
     """Print a pdf report of the beam shift results
 
-    'shifts' input is a dictionary in form { "GA0E240":[xshift, yshift] }
+    'shifts' input is BeamResults of [xshift, yshift] for each beam
     where x and y are in the image (hence BEV) coordinate system
     """
+
+    # reportlab is slow to import so only import it when making a report
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_JUSTIFY
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, TableStyle, Table, PageBreak
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import inch
     
     curr_date = get_date()
 
@@ -131,7 +114,7 @@ def summary_reportlab(gantry_angles,energies,op1,op2,shifts, acq_datetime, gantr
     displacements = get_total_displacement(shifts )
 
     # Data formatted for PDF table
-    table_data = get_table_data(gantry_angles,energies,displacements)
+    table_data = get_table_data(displacements)
 
 
     # Set up document
@@ -192,25 +175,14 @@ def summary_reportlab(gantry_angles,energies,op1,op2,shifts, acq_datetime, gantr
     beams_gt_1pt5mm = {}
     beams_gt_2mm = {}
 
-    for key in displacements:
-        ga = str(key.split("GA")[1].split("E")[0])
-        en = key.split("E")[1]+" MeV"
-        if displacements[key] > 2.0:
-            # Add new element of to existing list
-            if ga in beams_gt_2mm:
-                beams_gt_2mm[ga] = beams_gt_2mm[ga] + [en]
-            else:
-                beams_gt_2mm[ga] = [en]
-        elif displacements[key] > 1.5:
-            if ga in beams_gt_1pt5mm:
-                beams_gt_1pt5mm[ga] = beams_gt_1pt5mm[ga] + [en]
-            else:
-                beams_gt_1pt5mm[ga] = [en]
-        if displacements[key] > 1:
-            if ga in beams_gt_1mm:
-                beams_gt_1mm[ga] = beams_gt_1mm[ga] + [en]
-            else:
-                beams_gt_1mm[ga] = [en]
+    for ga in displacements.gantry_angles:
+        d = displacements.by_gantry(ga)[:,0]
+        ens = np.array( [ str(en)+" MeV" for en in displacements.energies ] )
+        for beams, select in [ (beams_gt_2mm, d>2.0), 
+                               (beams_gt_1pt5mm, (d>1.5)&(d<=2.0)),
+                               (beams_gt_1mm, d>1) ]:
+            if np.any(select):
+                beams[str(ga)] = ens[select].tolist()
 
 
     if len(beams_gt_1mm)>0:
@@ -257,10 +229,8 @@ def summary_reportlab(gantry_angles,energies,op1,op2,shifts, acq_datetime, gantr
 
 if __name__=="__main__":
 
-    shifts = {}
     #with open("results_2020_0102_0001.txt") as filein:
-    with open("results_shifts.txt") as filein:
-        shifts = json.load(filein)
+    shifts = BeamResults.from_json("results_shifts.txt")
 
     #print_pdf_summary(shifts)
     ##summary_reportlab(shifts, output="output2.pdf")
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of parsed Logos spot images. Each image is stored as a .npy
+file (loaded memory-mapped) with its pitch and metadata in a .json file
+alongside. Entries are keyed by a fingerprint of the spot file: path, size,
+modification time and a hash of its contents, so a changed file is never
+served from the cache.
+
+Enable with USE_IMAGE_CACHE in config.py. To clear the cache or rebuild it
+for a data directory:
+    python image_cache.py --clear
+    python image_cache.py --rebuild path/to/data
+"""
+
+import json
+import hashlib
+import argparse
+from os import listdir, makedirs, remove, replace, stat
+from os.path import join, isdir, isfile, abspath, splitext
+
+import numpy as np
+
+import config
+
+
+CACHE_DIR = config.IMAGE_CACHE_DIR
+
+# Increment if the parsed format changes to invalidate old entries
+# (2: images stored as uint8/float32 rather than float64)
+CACHE_VERSION = 2
+
+
+
+def fingerprint(filename, dtype=None):
+    """Return cache key of file from its path, size, mtime and content hash;
+    dtype as given to full_analyze.parse_spot_file"""
+    st = stat(filename)
+    md5 = hashlib.md5()
+    with open(filename,"rb") as f:
+        for chunk in iter(lambda: f.read(1<<20), b""):
+            md5.update(chunk)
+    key = "{}|{}|{}|{}|{}|{}".format(CACHE_VERSION, abspath(filename), st.st_size,
+                                     st.st_mtime_ns, md5.hexdigest(),
+                                     "compact" if dtype is None else np.dtype(dtype).str)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+
+def load(key, cache_dir=CACHE_DIR):
+    """Return (image, pitch, meta) for key or None if not cached
+
+    Image is memory-mapped copy-on-write so it may be modified freely
+    """
+    npyfile = join(cache_dir,key+".npy")
+    jsonfile = join(cache_dir,key+".json")
+    # json is written last so only complete entries are used
+    if not isfile(jsonfile) or not isfile(npyfile):
+        return None
+    try:
+        with open(jsonfile) as f:
+            info = json.load(f)
+        spotimage = np.load(npyfile, mmap_mode="c")
+    except (OSError, ValueError):
+        return None
+    return spotimage, info["pitch"], info["meta"]
+
+
+
+def save(key, spotimage, pitch, meta, cache_dir=CACHE_DIR):
+    """Store parsed image, pitch and metadata in cache under key"""
+    makedirs(cache_dir, exist_ok=True)
+    npyfile = join(cache_dir,key+".npy")
+    jsonfile = join(cache_dir,key+".json")
+    # Write to temporary files first so a crash never leaves a bad entry
+    np.save(npyfile+".tmp.npy", spotimage)
+    replace(npyfile+".tmp.npy", npyfile)
+    with open(jsonfile+".tmp","w") as f:
+        json.dump({"pitch":pitch, "meta":meta}, f)
+    replace(jsonfile+".tmp", jsonfile)
+
+
+
+def clear(cache_dir=CACHE_DIR):
+    """Delete all cache entries; return number of files removed"""
+    if not isdir(cache_dir):
+        return 0
+    removed = 0
+    for f in listdir(cache_dir):
+        if f.endswith(".npy") or f.endswith(".json") or f.endswith(".tmp"):
+            remove( join(cache_dir,f) )
+            removed+=1
+    return removed
+
+
+
+def rebuild(directory, cache_dir=CACHE_DIR):
+    """Parse every numeric .csv/.txt spot file in directory into the cache"""
+    # Imported here to avoid a circular import (full_analyze uses this module)
+    import full_analyze as xan
+
+    spotfiles = [f for f in listdir(directory) if str.isdigit(splitext(f)[0])
+                 and splitext(f)[1] in (".csv",".txt")]
+    for cnt,f in enumerate(spotfiles):
+        xan.progress_bar(cnt, len(spotfiles))
+        filename = join(directory,f)
+        spotimage, pitch, meta = xan.parse_spot_file(filename)
+        save(fingerprint(filename), spotimage, pitch, meta, cache_dir)
+    print("\nCached {} spot images in {}".format(len(spotfiles), cache_dir))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage cache of parsed XRV-124 spot images")
+    parser.add_argument("--clear", action="store_true", help="delete all cached images")
+    parser.add_argument("--rebuild", metavar="DATADIR", help="(re)parse all spot files of a data directory into the cache")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="cache location (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.clear:
+        print("Removed {} files from {}".format(clear(args.cache_dir), args.cache_dir))
+    if args.rebuild:
+        rebuild(args.rebuild, args.cache_dir)
+    if not args.clear and not args.rebuild:
+        parser.print_help()
+
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+All entry and exit spot images of a session in one memory-mapped array.
+
+The cube is a .npy file of shape (n_beams, 2, nrows, ncols): [i,0] is the
+entry and [i,1] the exit image of the i'th beam in order of delivery. An
+index (.json file alongside) maps each beam ID to its slot, gantry angle and
+energy and keeps the pitch and metadata of the beam, so the BeamRecords of
+a session can be made from the cube alone.
+
+A cube can also be kept in a shared memory block (multiprocessing.
+shared_memory) instead of a file, for worker processes; it is then located
+by a SharedCube of the block name, shape and dtype rather than a path, and
+has no index file.
+
+BeamRecords read from a cube hold read-only views of it and the (location,
+slot) of their images. When they are sent to worker processes (see
+full_analyze.map_beams) the images are left out and the workers open the
+same cube by its location, so images are neither re-read from the text
+files nor pickled between processes, and all processes share the same pages.
+"""
+
+import os
+import json
+import secrets
+from os.path import splitext
+from collections import namedtuple
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+# Give as location to create() to make cube in shared memory
+SHARED = "shared memory"
+
+# Location of cube in shared memory; dtype as a string, e.g. "|u1"
+SharedCube = namedtuple("SharedCube", ["name","shape","dtype"])
+
+# Cubes opened by this process: {(location, mode): array}
+_cubes = {}
+# Shared memory blocks opened by this process: {name: (block, created here)}
+_blocks = {}
+
+
+
+def index_path(path):
+    """Return path of index of cube"""
+    return splitext(path)[0]+".json"
+
+
+
+def create(location, nbeams, shape, dtype):
+    """Create empty cube for nbeams images of shape (nrows,ncols) at location,
+    a file path or SHARED; return its location (a SharedCube if in shared
+    memory)"""
+    shape = (nbeams,2)+tuple(shape)
+    if location==SHARED:
+        from multiprocessing import shared_memory
+        location = SharedCube("xrv124_"+secrets.token_hex(6), shape, np.dtype(dtype).str)
+        block = shared_memory.SharedMemory(name=location.name, create=True,
+                                           size=int(np.prod(shape))*np.dtype(dtype).itemsize)
+        _blocks[location.name] = (block, True)
+        _cubes[(location,"r+")] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    else:
+        close(location)
+        _cubes[(location,"r+")] = open_memmap(location, mode="w+", dtype=dtype, shape=shape)
+    return location
+
+
+
+def open_cube(location, mode="r"):
+    """Return cube as array (memmap if in a file), opening it once per
+    process and mode"""
+    cube = _cubes.get( (location,mode) )
+    if cube is None:
+        if isinstance(location, SharedCube):
+            cube = np.ndarray(location.shape, dtype=location.dtype, buffer=_block(location.name).buf)
+            cube.flags.writeable = mode!="r"
+        else:
+            cube = np.load(location, mmap_mode=mode)
+        _cubes[(location,mode)] = cube
+    return cube
+
+
+
+def _block(name):
+    """Return shared memory block, attaching to it once per process; only
+    the process that created a block frees it"""
+    if name not in _blocks:
+        from multiprocessing import shared_memory
+        try:
+            block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching registers the block with the
+            # resource tracker of this process, which frees it when this
+            # process ends, unless it is the tracker of the creating process
+            # (started before this process was forked or passed to it)
+            from multiprocessing import resource_tracker
+            shared = getattr(resource_tracker._resource_tracker, "_fd", None) is not None
+            block = shared_memory.SharedMemory(name=name)
+            if os.name=="posix" and not shared:
+                resource_tracker.unregister(block._name, "shared_memory")
+        _blocks[name] = (block, False)
+    return _blocks[name][0]
+
+
+
+def close(location=None):
+    """Forget open cube (all cubes if location is None) so its file can be
+    removed once its views are no longer used. Shared memory blocks are
+    closed, and freed if created by this process"""
+    for key in list(_cubes):
+        if location is None or key[0]==location:
+            del _cubes[key]
+    for name in list(_blocks):
+        if location is None or (isinstance(location, SharedCube) and location.name==name):
+            block, created = _blocks.pop(name)
+            try:
+                block.close()
+            except BufferError:
+                # Views still in use; the memory is freed when they go
+                pass
+            if created:
+                try:
+                    block.unlink()
+                except FileNotFoundError:
+                    pass
+
+
+
+def write_index(path, records, gantry_angles=None, energies=None):
+    """Write index of cube from BeamRecords in order of delivery; GA and
+    energy of each beam are given if there is one beam per GA and energy.
+    Cubes in shared memory have no index; their records hold the metadata"""
+    if isinstance(path, SharedCube):
+        return
+    pairs = [ (ga,en) for ga in gantry_angles for en in energies ] if gantry_angles and energies else []
+    if len(pairs)!=len(records):
+        pairs = [ (None,None) ]*len(records)
+    beams = []
+    for r,(ga,en) in zip(records, pairs):
+        beams.append( {"beam_id":r.beam_id, "slot":None if r.cube is None else r.cube[1],
+                       "ga":ga, "en":en, "pitch":r.pitch, "diameter":r.diameter,
+                       "arc":r.arc, "radial":r.radial,
+                       "p1":None if r.p1 is None else r.p1.tolist(),
+                       "p2":None if r.p2 is None else r.p2.tolist()} )
+    with open(index_path(path),"w") as f:
+        json.dump( {"beams":beams}, f )
+
+
+
+def read_index(path):
+    """Return {beam ID: index entry} of cube, in order of delivery"""
+    with open(index_path(path)) as f:
+        return { b["beam_id"]:b for b in json.load(f)["beams"] }
+
+
+
+def beam_images(location, slot):
+    """Return read-only (entry, exit) views of images in slot of cube"""
+    cube = open_cube(location)
+    return cube[slot,0], cube[slot,1]
+
+
+
+def records(path):
+    """Return BeamRecords of all beams in cube file that it holds images
+    of, in order of delivery"""
+    import full_analyze as xan
+    out = []
+    for b in read_index(path).values():
+        if b["slot"] is None:
+            continue
+        entry, exit = beam_images(path, b["slot"])
+        out.append( xan.BeamRecord(b["beam_id"], entry, exit, b["pitch"], b["diameter"],
+                                   b["arc"], b["radial"],
+                                   None if b["p1"] is None else np.array(b["p1"]),
+                                   None if b["p2"] is None else np.array(b["p2"]),
+                                   (path,b["slot"])) )
+    return out
+
+
+
+def fits(cube, img):
+    """True if image can be stored in cube without loss"""
+    return img.shape==cube.shape[2:] and np.can_cast(img.dtype, cube.dtype, "safe")
+
+
+
+def store(location, slot, record):
+    """Store images of BeamRecord in slot of cube; return record holding
+    read-only views of the cube, or record unchanged if its images do not
+    fit the cube (e.g. a different size)"""
+    cube = open_cube(location, "r+")
+    if not fits(cube, record.entry) or not fits(cube, record.exit):
+        return record
+    cube[slot,0] = record.entry
+    cube[slot,1] = record.exit
+    entry, exit = beam_images(location, slot)
+    return record._replace(entry=entry, exit=exit, cube=(location,slot))
+
+
+
+def load_beam(location, slot, directory, beam_id):
+    """Read beam from its spot files into slot of cube; return BeamRecord
+    without its images if they were stored (for worker processes)"""
+    import full_analyze as xan
+    return detach( store(location, slot, xan.load_beam(directory, beam_id)) )
+
+
+
+def detach(arg):
+    """Return BeamRecord stored in a cube without its images, to send to
+    another process; other arguments are returned unchanged"""
+    if getattr(arg, "cube", None) is None or arg.entry is None:
+        return arg
+    return arg._replace(entry=None, exit=None)
+
+
+
+def attach(arg):
+    """Return detached BeamRecord with views of its images in the cube;
+    other arguments are returned unchanged"""
+    if getattr(arg, "cube", None) is None or arg.entry is not None:
+        return arg
+    entry, exit = beam_images(*arg.cube)
+    return arg._replace(entry=entry, exit=exit)
+
+
+
+def call(func, *args):
+    """Call func with detached BeamRecords in args attached; for running
+    per-beam functions in worker processes"""
+    return func( *[attach(a) for a in args] )
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Memory profiling of the stages of an analysis.
+
+When ENABLED (config.PROFILE_MEMORY, or --profile-memory on the command
+line) every timing.stage() also records, with tracemalloc, the memory
+allocated by Python at its start and end and the peak during it, plus the
+resident set size (RSS) of the process. These are written to
+memory_profile.txt in the results directory, with the call sites holding
+most memory at the end of the top-level stage with the most memory, and
+those that allocated most during the top-level stage that grew most.
+
+Snapshots of all traced allocations are slow to take and very slow to
+compare, so they are only taken at the end of top-level stages and only
+compared when the report is written.
+
+Only the main process is traced, so use a single worker (--workers 1).
+tracemalloc slows the analysis down considerably.
+"""
+
+import os
+import sys
+import tracemalloc
+from os.path import join
+
+import config
+
+
+ENABLED = config.PROFILE_MEMORY
+# Frames of traceback kept per allocation and number of sites reported
+FRAMES = 1
+TOP_SITES = 10
+
+MB = 1024*1024
+
+# Stages in progress (innermost last) and all stages in order of start
+_open = []
+_stages = []
+# Snapshots at end of top-level stages: the last, the one with most memory
+# (size, stage, snapshot) and the one that grew most since the previous
+# (increase, stage, snapshot, previous snapshot)
+_last = None
+_largest = None
+_growth = None
+
+
+
+def start():
+    """Start tracing allocations, if not already"""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(FRAMES)
+
+
+
+def stop():
+    """Stop tracing allocations"""
+    tracemalloc.stop()
+
+
+
+def reset():
+    """Forget recorded stages"""
+    global _last, _largest, _growth
+    del _open[:]
+    del _stages[:]
+    _last = _largest = _growth = None
+
+
+
+def current_rss():
+    """Resident set size of this process (bytes); None if not known"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int( f.read().split()[1] )*os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+
+def peak_rss():
+    """Peak resident set size of this process (bytes); None if not known"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kB on Linux, bytes on macOS
+        return peak if sys.platform=="darwin" else peak*1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", None)
+    except ImportError:
+        return None
+
+
+
+def _boundary():
+    """Return traced memory now, updating the peak of the open stages with
+    the peak since the previous boundary"""
+    current, peak = tracemalloc.get_traced_memory()
+    for s in _open:
+        s["peak"] = max(s["peak"], peak)
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    return current
+
+
+
+def begin(name):
+    """Record start of stage"""
+    start()
+    current = _boundary()
+    stage = {"name":name, "start":current, "peak":current, "depth":len(_open)}
+    _open.append(stage)
+    _stages.append(stage)
+
+
+
+def end(name):
+    """Record end of stage; snapshot allocations if it is a top-level stage"""
+    global _last, _largest, _growth
+    current = _boundary()
+    stage = _open.pop()
+    stage.update( {"end":current, "rss":current_rss(), "peak_rss":peak_rss()} )
+    if _open:
+        return
+
+    snapshot = tracemalloc.take_snapshot()
+    if _largest is None or current>_largest[0]:
+        _largest = (current, name, snapshot)
+    if _last is not None:
+        increase = current - _last[0]
+        if _growth is None or increase>_growth[0]:
+            _growth = (increase, name, snapshot, _last[1])
+    _last = (current, snapshot)
+
+
+
+def stages():
+    """Return list of finished stages as dicts with the traced memory (bytes)
+    at "start" and "end", "peak" during it and "rss"/"peak_rss" at its end"""
+    return [ dict(s) for s in _stages if "end" in s ]
+
+
+
+def format_report():
+    """Return memory profile as text"""
+    def mb(b):
+        return "{:10.1f}".format(b/MB) if b is not None else "{:>10}".format("n/a")
+
+    lines = [ "Memory traced by tracemalloc and resident set size (RSS), MB",
+              "{:28}{:>10}{:>10}{:>10}{:>10}{:>10}".format("Stage", "Start", "Peak", "End",
+                                                           "RSS", "Peak RSS") ]
+    # In order of start; nested stages are indented
+    for s in stages():
+        lines.append( "{:28}".format("  "*s["depth"]+s["name"]) + mb(s["start"]) + mb(s["peak"])
+                      + mb(s["end"]) + mb(s["rss"]) + mb(s["peak_rss"]) )
+
+    if _growth is not None:
+        increase, name, snapshot, previous = _growth
+        lines += [ "", "Memory allocated during {} and since the previous stage ({:+.1f} MB), "
+                       "by site (size change, blocks):".format(name, increase/MB) ]
+        lines += [ "  {:+10.2f} MB {:+8d}  {}".format(s.size_diff/MB, s.count_diff, s.traceback)
+                   for s in snapshot.compare_to(previous, "lineno")[:TOP_SITES] ]
+
+    if _largest is not None:
+        size, name, snapshot = _largest
+        lines += [ "", "Memory held at end of {} ({:.1f} MB), by site:".format(name, size/MB) ]
+        lines += [ "  {:10.2f} MB {:8d}  {}".format(s.size/MB, s.count, s.traceback)
+                   for s in snapshot.statistics("lineno")[:TOP_SITES] ]
+    return "\n".join(lines)
+
+
+
+def write_report(directory):
+    """Print stage table and write memory_profile.txt to directory"""
+    text = format_report()
+    print( text.split("\n\n")[0] )
+    with open(join(directory,"memory_profile.txt"),"w") as f:
+        f.write(text+"\n")
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Repeatability of results over many sessions, e.g. repeat irradiations
+without touching the xrv124 (beam consistency) or with a new set-up each
+time (inter-user variation).
+
+Results files (e.g. results_shifts.txt) are read one at a time into an
+array of shape (n_sessions, n_gantry, n_energy, k) covering every beam in
+any of the files; beams missing from a session are NaN. Statistics over sessions are
+computed per beam.
+"""
+
+import csv
+import json
+import warnings
+
+import numpy as np
+
+from results import SHIFT_FIELDS, parse_key
+
+
+# Max difference (mm) between sessions considered repeatable
+TOLERANCE = 0.5
+
+
+
+def read_results(filename):
+    """Return dict of form {"GA180E245":[x,y],...} of results file"""
+    with open(filename) as json_file:
+        return json.load(json_file)
+
+
+
+def stack_sessions(files, fields=SHIFT_FIELDS):
+    """Return (array of shape (n_sessions,n_gantry,n_energy,k), gantry angles,
+    energies) of results files; the axes hold every gantry angle and energy
+    in any file, in order of first appearance
+
+    Files are read twice, one at a time: first for the beams they hold, then
+    for their values, so only the stacked array is kept in memory
+    """
+    ga_index, en_index = {}, {}
+    for f in files:
+        for key in read_results(f):
+            ga, en = parse_key(key)
+            ga_index.setdefault(ga, len(ga_index))
+            en_index.setdefault(en, len(en_index))
+    gas, ens = list(ga_index), list(en_index)
+
+    stack = np.full( (len(files),len(gas),len(ens),len(fields)), np.nan )
+    for n,f in enumerate(files):
+        for key,value in read_results(f).items():
+            ga, en = parse_key(key)
+            # None (missing value) becomes NaN
+            value = np.array(value, dtype=float).ravel()
+            if value.size!=len(fields):
+                raise ValueError("{}: expected {} values for {}, got {}".format(
+                                                    f, len(fields), key, value.size))
+            stack[n, ga_index[ga], en_index[en]] = value
+
+    return stack, gas, ens
+
+
+
+def repeatability(stack, tolerance=TOLERANCE, percentiles=(5,50,95)):
+    """Return dict of statistics over sessions (axis 0) of stacked results
+
+    "n": number of sessions with the beam, shape (n_gantry,n_energy)
+    "range": max-min, "std": standard deviation; shape (n_gantry,n_energy,k)
+    "percentiles": shape (len(percentiles),n_gantry,n_energy,k)
+    "out_of_tolerance": range of any component >= tolerance; shape
+    (n_gantry,n_energy). Beams in fewer than 2 sessions are NaN / False.
+    """
+    n = np.count_nonzero( ~np.isnan(stack[...,0]), axis=0 )
+    # Only beams in at least 2 sessions
+    stack = np.where( (n>1)[np.newaxis,...,np.newaxis], stack, np.nan )
+
+    with warnings.catch_warnings():
+        # All-NaN beams give RuntimeWarnings
+        warnings.simplefilter("ignore", RuntimeWarning)
+        rng = np.nanmax(stack, axis=0) - np.nanmin(stack, axis=0)
+        std = np.nanstd(stack, axis=0, ddof=1)
+        pct = np.nanpercentile(stack, percentiles, axis=0)
+
+    return {"n":n, "range":rng, "std":std, "percentiles":pct,
+            "percentile_levels":tuple(percentiles),
+            "out_of_tolerance":np.any( rng>=tolerance, axis=-1 ),
+            "tolerance":tolerance}
+
+
+
+def write_table(filename, gantry_angles, energies, stats, fields=SHIFT_FIELDS):
+    """Write per-beam repeatability statistics to csv file"""
+    header = ["GA","Energy","Sessions"]
+    header += [ f+"_range" for f in fields ] + [ f+"_std" for f in fields ]
+    header += [ "{}_p{}".format(f,p) for p in stats["percentile_levels"] for f in fields ]
+    header += [ "Range >= {}".format(stats["tolerance"]) ]
+
+    with open(filename,"w",newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for i,ga in enumerate(gantry_angles):
+            for j,en in enumerate(energies):
+                row = [ga, en, int(stats["n"][i,j])]
+                row += stats["range"][i,j].tolist() + stats["std"][i,j].tolist()
+                row += stats["percentiles"][:,i,j].ravel().tolist()
+                row += [ bool(stats["out_of_tolerance"][i,j]) ]
+                writer.writerow(row)
+
+
+
+def out_of_tolerance_beams(gantry_angles, energies, stats):
+    """Return list of (ga, en) of beams with range >= tolerance"""
+    i, j = np.nonzero( stats["out_of_tolerance"] )
+    return [ (gantry_angles[a], energies[b]) for a,b in zip(i,j) ]
+
+
+
+def plot_range_histogram(stats, labels=("BEV-X","BEV-Y"), imgname=None):
+    """Histogram of max difference between sessions of each component"""
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure()
+    bins = [0,0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9]
+    for c,label in enumerate(labels):
+        rng = stats["range"][...,c]
+        plt.hist( rng[~np.isnan(rng)], alpha=0.3, label=label, bins=bins, align="left" )
+    plt.legend()
+    plt.xlabel("Max difference (mm)")
+    plt.title("Max difference in spot position between irradiations")
+    if imgname is not None:
+        fig.savefig(imgname, dpi=fig.dpi)
+        plt.close(fig)
+    else:
+        plt.show()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Container for per-beam results of a QA session (shifts, sigmas, diameters,
+etc). Values are held in a single array of shape (n_gantry, n_energy, k)
+indexed in the order of delivery, with the gantry angles, energies and the
+names of the k components as axis labels. Views per gantry angle, energy or
+component share the array so no copies or key strings are needed downstream.
+
+Results are saved as JSON dictionaries of the form {"GA180E245":[x,y],...}
+as before, so old results files can still be read.
+"""
+
+import json
+
+import numpy as np
+
+
+
+SHIFT_FIELDS = ("x","y")
+SHIFT_3D_FIELDS = ("x","y","z")
+DIAMETER_FIELDS = ("diameter",)
+SIGMA_FIELDS = ("x_sigma","y_sigma")
+ARC_RADIAL_FIELDS = ("arc","radial")
+
+
+
+def beam_key(ga, en):
+    """Return key of beam used in results files, e.g. "GA180E245" """
+    return "GA"+str(ga)+"E"+str(en)
+
+
+
+def parse_key(key):
+    """Return (gantry angle, energy) from key of form "GA180E245" """
+    ga, en = key[2:].split("E")
+    return int(ga), int(en)
+
+
+
+class BeamResults:
+    """Results of all beams of a session
+
+    values has shape (n_gantry, n_energy, k), ordered as gantry_angles and
+    energies; fields are the names of the k components (e.g. "x","y").
+    Missing values (e.g. no arc width in spot file) are NaN.
+    """
+
+    def __init__(self, gantry_angles, energies, values, fields):
+        self.gantry_angles = list(gantry_angles)
+        self.energies = list(energies)
+        self.fields = tuple(fields)
+        values = np.asarray(values, dtype=float)
+        shape = ( len(self.gantry_angles), len(self.energies), len(self.fields) )
+        if values.shape==shape[:2]:
+            values = values[...,np.newaxis]
+        if values.shape!=shape:
+            raise ValueError("Expected results of shape {}, got {}".format(shape, values.shape))
+        self.values = values
+        self._ga_index = { ga:i for i,ga in enumerate(self.gantry_angles) }
+        self._en_index = { en:i for i,en in enumerate(self.energies) }
+
+
+    @classmethod
+    def from_beams(cls, gantry_angles, energies, beam_values, fields):
+        """Make from list of per-beam values in order of delivery
+        (all energies at first gantry angle, then the next, ...)"""
+        # None becomes NaN
+        values = np.array( beam_values, dtype=float )
+        return cls( gantry_angles, energies,
+                    values.reshape(len(gantry_angles), len(energies), len(fields)), fields )
+
+
+    @classmethod
+    def from_dict(cls, results, fields=None, gantry_angles=None, energies=None):
+        """Make from dict of form {"GA180E245":[x,y],...}
+
+        Gantry angles and energies are taken from the keys, in order of
+        first appearance, if not given
+        """
+        beams = [ parse_key(k) for k in results ]
+        if gantry_angles is None:
+            gantry_angles = list( dict.fromkeys( [ga for ga,en in beams] ) )
+        if energies is None:
+            energies = list( dict.fromkeys( [en for ga,en in beams] ) )
+        beam_values = [ results[beam_key(ga,en)] for ga in gantry_angles for en in energies ]
+        if fields is None:
+            k = np.size(beam_values[0])
+            fields = tuple( str(i) for i in range(k) )
+        return cls.from_beams(gantry_angles, energies, beam_values, fields)
+
+
+    @classmethod
+    def from_json(cls, filename, fields=None, gantry_angles=None, energies=None):
+        """Read results file written by to_json (or older versions of run.py)"""
+        with open(filename) as f:
+            return cls.from_dict( json.load(f), fields, gantry_angles, energies )
+
+
+    def to_dict(self):
+        """Return dict of form {"GA180E245":[x,y],...}; single component
+        results are stored as numbers and NaN as None"""
+        results = {}
+        for i,ga in enumerate(self.gantry_angles):
+            for j,en in enumerate(self.energies):
+                v = [ None if np.isnan(e) else e for e in self.values[i,j].tolist() ]
+                results[beam_key(ga,en)] = v[0] if len(v)==1 else v
+        return results
+
+
+    def to_json(self, filename):
+        with open(filename,"w") as json_file:
+            json.dump(self.to_dict(), json_file)
+
+
+    def __getitem__(self, beam):
+        """Values of beam (ga,en); shape (k,)"""
+        ga, en = beam
+        return self.values[ self._ga_index[ga], self._en_index[en] ]
+
+
+    def __len__(self):
+        return len(self.gantry_angles)*len(self.energies)
+
+
+    def by_gantry(self, ga):
+        """View of all energies at gantry angle ga; shape (n_energy, k)"""
+        return self.values[ self._ga_index[ga] ]
+
+
+    def by_energy(self, en):
+        """View of all gantry angles at energy en; shape (n_gantry, k)"""
+        return self.values[ :, self._en_index[en] ]
+
+
+    def field(self, name):
+        """View of one component, e.g. "x"; shape (n_gantry, n_energy)"""
+        return self.values[ ..., self.fields.index(name) ]
+
+
+    def magnitude(self):
+        """Length of vector of components, e.g. total displacement of
+        x,y shifts; shape (n_gantry, n_energy)"""
+        return np.sqrt( (self.values**2).sum(axis=-1) )
+
+
+    def beams(self):
+        """Return (ga, en, values) of each beam in order of delivery"""
+        return [ (ga, en, self.values[i,j]) for i,ga in enumerate(self.gantry_angles)
+                                            for j,en in enumerate(self.energies) ]
+
+
+
+def stack(results_list):
+    """Stack results of several sessions into array of shape
+    (n_sessions, n_gantry, n_energy, k); axes must match"""
+    first = results_list[0]
+    for r in results_list[1:]:
+        if (r.gantry_angles!=first.gantry_angles or r.energies!=first.energies
+                or r.fields!=first.fields):
+            raise ValueError("Cannot stack results with different gantry angles, energies or fields")
+    return np.stack( [r.values for r in results_list] )
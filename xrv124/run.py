@@ -1,20 +1,38 @@
+import sys
+import shutil
+import argparse
+import tempfile
+import traceback
 from os import listdir, mkdir
 from os.path import isfile, splitext, join
-import json
 import csv
-
-import pandas as pd
+import threading
+from datetime import datetime
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
 import full_analyze as xan
-import full_plot as xplot
-import full_report as xreport
-import partial_analyze
+import archive
 import config
-import gui
+import image_cube
 import database as db
+import timing
+import memprofile
+
+# Slow imports (matplotlib, reportlab, PySimpleGUI) are made in the
+# functions that need them so that the GUI opens quickly
 
 
 TARGET = config.TARGET
+WORKERS = config.WORKERS
+WRITE_DB_CSV = config.WRITE_DB_CSV
+WRITE_ARCHIVE = config.WRITE_ARCHIVE
+USE_IMAGE_CUBE = config.USE_IMAGE_CUBE
+SHARED_MEMORY = config.SHARED_MEMORY
+
+# Figures included in the PDF report
+REPORT_IMAGES = ["shifts_by_gantry", "shifts_by_energy", "shifts_histo",
+                 "shifts_polar", "diameter_by_energy"]
 
 
 def get_acquisition_date_time(outputfile):
@@ -94,120 +112,283 @@ def make_results_directory(basedir,attempted_name):
     return join(basedir,result_dir)           
                 
 
-def full_analysis(gas, ens, op1, op2, directory, beams, gantry_name, acq_date,
-                  acq_time, comment, outputdir):
-    """Analsysis of full data set"""
-    
-    db.test_db_connection()
+def parse_angles_energies(gantry_angles_in, energies_in):
+    """Return GA and energy lists from comma-separated input strings
     
-    acq_datetime = acq_date+" "+acq_time
-     
-    result_dir=outputdir
-      
-    print("Analyzing BEV spot shifts...")
-    results_shifts = {}
-    results_shifts = xan.analyse_shifts(gas, ens, directory, beams)
+    Ensures -180 < ga <= 180
+    """
+    energies = [ int(e) for e in energies_in.split(",")  ]    
+    gas = [ int(ga) for ga in gantry_angles_in.split(",")  ]
+    gantry_angles = [ ga-360 if ga>180 else ga for ga in gas]
+    return gantry_angles, energies
+
+
+
+def image_to_bev(results_shifts):
+    """Convert BeamResults of shifts from image to BEV coordinates (in place)"""
     ############## IMAGE TO BEV CONVERSION ########################
     # The analyse_shifts method works in image coordinate system.
     # IMG-Y = -BEV-Y hence if we want results in BEV coords:
-    for key in results_shifts:
-        results_shifts[key][1] *= -1
+    results_shifts.field("y")[...] *= -1
     ##############################################################
-    print("Saving and printing shift results...")
-    with open(join(result_dir,"results_shifts.txt"),"w") as json_file:
-        json.dump(results_shifts, json_file)    
-    # 2D plot of shifts (x,y) grouped by GA
-    xplot.plot_shifts_by_gantry(gas, ens,results_shifts, imgname=join(result_dir,"shifts_by_gantry.png"))
-    # 2D plot of shifts (x,y) grouped by ENERGY
-    xplot.plot_shifts_by_energy(gas, ens,results_shifts, imgname=join(result_dir,"shifts_by_energy.png"))
-    # x & y shifts plotted separately vs GA (for each E)
-    xplot.plot_xyshifts_vs_gantry(gas, ens,results_shifts, imgname=join(result_dir,"xy_shifts_vs_gantry.png"))
-    # x & y shifts plotted separately vs E (for each GA)
-    xplot.plot_xyshifts_vs_energy(gas, ens,results_shifts, imgname=join(result_dir,"xy_shifts_vs_energy.png"))
-    # Histogram of shifts
-    xplot.shifts_histogram(results_shifts, imgname=join(result_dir,"shifts_histo.png"))
-    # Polar plot of shifts
-    xplot.shifts_polar(gas, ens,results_shifts, imgname=join(result_dir,"shifts_polar.png"))    
+    return results_shifts
+
+
+
+def full_analysis(gas, ens, op1, op2, records, gantry_name, acq_date,
+                  acq_time, comment, outputdir, executor=None):
+    """Analsysis of full data set
+
+    records is the list of BeamRecords (xan.load_beams) in order of delivery.
+    Per-beam analysis runs in parallel if a concurrent.futures executor is
+    given, in a single pass over the beams (xan.analyse_beams)
+    """
+    
+    with timing.stage("database connection"):
+        db.test_db_connection()
+
+    if executor is not None:
+        print("Analyzing BEV spot shifts, diameters and sigmas...")
+        with timing.stage("shifts, diameters and sigmas"):
+            beam_results = xan.analyse_beams(gas, ens, records, executor)
+        results_shifts = beam_results["shifts"]
+        results_spot_diameters = beam_results["spot_diameters"]
+        results_sigmas = beam_results["spot_sigmas"]
+    else:
+        print("Analyzing BEV spot shifts...")
+        with timing.stage("shifts"):
+            results_shifts = xan.analyse_shifts(gas, ens, records)
+    image_to_bev(results_shifts)
 
 
     """
     ## 3D SHIFTS VECTORS IN LOGOS COORDINATES - not using this
     print("Calculating 3D shifts (presence of ball bearing will reduce accuracy)...")
-    results_3d_shifts = xan.shift_vector_logos_coords(directory, beams, GANTRY, ENERGY, TARGET)
-    with open(join(result_dir,"results_3d_shifts.txt"),"w") as json_file:
-        json.dump(results_3d_shifts, json_file)
-    xplot.shifts_3d_histogram(results_3d_shifts, imgname=join(result_dir,"shifts_3d_histo.png"))  
+    results_3d_shifts = xan.shift_vector_logos_coords(gas, ens, records, TARGET)
+    results_3d_shifts.to_json(join(result_dir,"results_3d_shifts.txt"))
+    (add to plots in report_results) "shifts_3d_histo": (xplot.shifts_3d_histogram, (results_3d_shifts,), {})
     """
       
-    results_spot_diameters = {}
-    results_sigmas = {}
-    print("Reading spot diameters...")
-    results_spot_diameters = xan.read_spot_diameters(gas, ens, directory, beams)
-    with open(join(result_dir,"results_spot_diameters.txt"),"w") as json_file:
-        json.dump(results_spot_diameters, json_file)    
-    ## Spot diameter plots
-    xplot.plot_spot_diameters_by_gantry(gas, ens, results_spot_diameters, imgname=join(result_dir,"diameter_by_gantry.png"))
-    xplot.plot_spot_diameters_by_energy(gas, ens, results_spot_diameters, imgname=join(result_dir,"diameter_by_energy.png"))        
-        
-    
-    print("Analzying spot sigmas...")
-    results_sigmas = xan.analyse_spot_profiles(gas, ens,directory, beams)
-    with open(join(result_dir,"results_spot_sigmas.txt"),"w") as json_file:
-        json.dump(results_sigmas, json_file)    
-    ## Spot sigma (method can do either "image" or "spot" coordinate systems
-    xplot.plot_spot_sigmas(gas, ens, results_sigmas, imgname=join(result_dir,"sigmas_xy.png"))        
+    if executor is None:
+        print("Reading spot diameters...")
+        with timing.stage("spot diameters"):
+            results_spot_diameters = xan.read_spot_diameters(gas, ens, records)
         
+        print("Analzying spot sigmas...")
+        with timing.stage("sigmas"):
+            results_sigmas = xan.analyse_spot_profiles(gas, ens, records)
     
     print("Reading arc and radial entry spot widths...")
-    results_arc_radial = xan.read_arc_radial_widths(gas, ens,directory, beams)
-    with open(join(result_dir,"results_arc_radial.txt"),"w") as json_file:
-        json.dump(results_arc_radial, json_file)
-    ## Arc and radial widths from entry spot
-    xplot.plot_spot_sigmas(gas, ens, results_arc_radial, imgname=join(result_dir,"arc_radial.png"),
-                               arc_radial=True)
-    
-
-    print("Generating summary PDF report...")
-    xreport.summary_reportlab(gas,ens,op1,op2,results_shifts, acq_datetime, gantry_name,
-                images=[join(result_dir,"shifts_by_gantry.png"),
-                        join(result_dir,"shifts_by_energy.png"),
-                        join(result_dir,"shifts_histo.png"),
-                        join(result_dir,"shifts_polar.png"),
-                        join(result_dir,"diameter_by_energy.png")                         
-                       ],
-                output=join(result_dir,"{0} {1}.pdf".format(gantry_name,acq_date))
-                )
-
-
-    print("Generating data for database...")
-    # Store x and y shifts plus Logos-diameter for each spot
-    db_results = join(result_dir,"db_results.csv")
+    with timing.stage("arc/radial widths"):
+        results_arc_radial = xan.read_arc_radial_widths(gas, ens, records)
+
+    results = {"shifts":results_shifts, "spot_diameters":results_spot_diameters,
+               "spot_sigmas":results_sigmas, "arc_radial":results_arc_radial}
+    report_results(op1, op2, results, gantry_name, acq_date,
+                   acq_time, comment, outputdir, executor)
+
+
+
+def report_figures(results):
+    """Return {image name: (plot function, args, kwargs)} of the figures of
+    the report (see full_plot.render_figures)"""
+    import full_plot as xplot
+    # {image name: (plot function, args, kwargs)}
+    plots = {
+        # 2D plot of shifts (x,y) grouped by GA
+        "shifts_by_gantry": (xplot.plot_shifts_by_gantry, (results["shifts"],), {}),
+        # 2D plot of shifts (x,y) grouped by ENERGY
+        "shifts_by_energy": (xplot.plot_shifts_by_energy, (results["shifts"],), {}),
+        # x & y shifts plotted separately vs GA (for each E)
+        "xy_shifts_vs_gantry": (xplot.plot_xyshifts_vs_gantry, (results["shifts"],), {}),
+        # x & y shifts plotted separately vs E (for each GA)
+        "xy_shifts_vs_energy": (xplot.plot_xyshifts_vs_energy, (results["shifts"],), {}),
+        # Histogram of shifts
+        "shifts_histo": (xplot.shifts_histogram, (results["shifts"],), {}),
+        # Polar plot of shifts
+        "shifts_polar": (xplot.shifts_polar, (results["shifts"],), {}),
+        ## Spot diameter plots
+        "diameter_by_gantry": (xplot.plot_spot_diameters_by_gantry, (results["spot_diameters"],), {}),
+        "diameter_by_energy": (xplot.plot_spot_diameters_by_energy, (results["spot_diameters"],), {}),
+        ## Spot sigma (method can do either "image" or "spot" coordinate systems
+        "sigmas_xy": (xplot.plot_spot_sigmas, (results["spot_sigmas"],), {}),
+        ## Arc and radial widths from entry spot
+        "arc_radial": (xplot.plot_spot_sigmas, (results["arc_radial"],), {"arc_radial":True}),
+    }
+    return plots
+
+
+
+def write_db_results(filename, op1, op2, rows):
+    """Write database rows (see database.session_rows) to csv file"""
     # need newline to avoid blank lines
-    with open(db_results,'w', encoding='UTF8',newline='') as f:
+    with open(filename,'w', encoding='UTF8',newline='') as f:
         writer = csv.writer(f)
         header = ["ADate","Operator 1","Operator 2","MachineName","GA","Energy","x-offset","y-offset","Diameter"]
         writer.writerow(header)
-        for key in results_shifts:
-            ga = key.split("GA")[1].split("E")[0]
-            e = key.split("E")[1]
-            xoff,yoff = results_shifts[key]
-            diam = results_spot_diameters[key]
-            
-            data = [acq_datetime,op1,op2,gantry_name,ga,e,xoff,yoff,diam]
-            writer.writerow(data)
-            
-            
-            
-    print("Attempting to write to database...")
-    df = pd.read_csv(db_results)
-    db.write_to_db(df,comment)
+        for adate,mach_name,ga,e,xoff,yoff,diam in rows:
+            writer.writerow([adate,op1,op2,mach_name,ga,e,xoff,yoff,diam])
+
+
+
+def report_results(op1, op2, results, gantry_name, acq_date, acq_time,
+                   comment, outputdir, executor=None):
+    """Save results, plot them, generate PDF report and write to database
+
+    The database write is queued first and runs in the background while the
+    plots and report are generated
+
+    results is a dict of BeamResults with keys "shifts" (BEV coords),
+    "spot_diameters", "spot_sigmas" and "arc_radial"
+    """
+
+    acq_datetime = acq_date+" "+acq_time
+     
+    result_dir=outputdir
+
+    results_shifts = results["shifts"]
+    results_spot_diameters = results["spot_diameters"]
+
+    print("Saving results...")
+    with timing.stage("save results"):
+        for name in results:
+            results[name].to_json( join(result_dir,"results_{}.txt".format(name)) )
+
+    if WRITE_ARCHIVE:
+        print("Adding session to archive...")
+        with timing.stage("archive"):
+            try:
+                archive.append_session(gantry_name, acq_date, acq_time, results)
+            except OSError as e:
+                print("  Warning: could not add session to archive: {}".format(e))
+
+
+    print("Writing to database in background...")
+    # Store x and y shifts plus Logos-diameter for each spot
+    with timing.stage("queue database write"):
+        adate = datetime.strptime(acq_datetime, '%Y-%m-%d %H:%M:%S')
+        rows = db.session_rows(adate, gantry_name, results_shifts, results_spot_diameters)
+        db.write_to_db( db.session_record(gantry_name, adate, op1, op2, rows, comment) )
+    if WRITE_DB_CSV:
+        csv_writer = threading.Thread(target=write_db_results,
+                                      args=(join(result_dir,"db_results.csv"), op1, op2, rows))
+        csv_writer.start()
+
+
+    print("Plotting results...")
+    with timing.stage("plots"):
+        import full_plot as xplot
+        pngs = xplot.render_figures(report_figures(results), result_dir, executor)
+
+
+    print("Generating summary PDF report...")
+    with timing.stage("PDF report"):
+        import full_report as xreport
+        xreport.summary_reportlab(op1,op2,results_shifts, acq_datetime, gantry_name,
+                    images=[ pngs[name] for name in REPORT_IMAGES ],
+                    output=join(result_dir,"{0} {1}.pdf".format(gantry_name,acq_date))
+                    )
+
+    print("Waiting for database writes...")
+    with timing.stage("wait for database"):
+        db.wait_for_writer()
+        if WRITE_DB_CSV:
+            csv_writer.join()
+
+    if timing.ENABLED:
+        print("\nTimings:")
+        timing.write_reports(result_dir)
+    if memprofile.ENABLED:
+        print("\nMemory:")
+        memprofile.write_report(result_dir)
 
 
 
 
+
+
+def set_options(headless, use_cache, timed=False, profile_memory=False):
+    """Set dialog, image cache, timing and memory profiling options (also
+    used in worker processes)"""
+    db.HEADLESS = headless
+    timing.ENABLED = timed
+    memprofile.ENABLED = profile_memory
+    xan.USE_IMAGE_CACHE = use_cache
+
+
+
+def analyse_session(directory, gantry_name, op1, op2, gantry_angles, energies,
+                    comment, outputdir, workers=WORKERS):
+    """Full analysis of one session; return results directory or None if
+    the data set is incomplete"""
+
+    filenames = get_filenames(directory)
+    filesok = check_files(filenames, gantry_angles, energies) 
+    if not filesok:
+        return None
+    print("Full data set found")
+    
+    # Get acquisition date and time from from Logos output.txt file
+    adate,atime=get_acquisition_date_time( join(directory,"output.txt"))
+
+    # New directory for results
+    res_dir_name = gantry_name+" "+str(adate)
+    result_dir = make_results_directory(outputdir,res_dir_name)
+    print("Results will be printed to {}".format(result_dir))
+
+    beams = get_ordered_beams(filenames)
+    # Pool of worker processes if running in parallel
+    if workers>1 and memprofile.ENABLED:
+        print("  Warning: memory of the {} worker processes is not profiled".format(workers))
+    if workers>1:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=set_options,
+                                   initargs=(db.HEADLESS, xan.USE_IMAGE_CACHE, timing.ENABLED))
+    else:
+        pool = nullcontext()
+    # Images of all beams in one cube for the worker processes, in shared
+    # memory or else a memory-mapped file; removed afterwards. A single
+    # process keeps them in memory
+    cube_dir = None
+    if not USE_IMAGE_CUBE or workers<=1:
+        cube = None
+    elif SHARED_MEMORY:
+        cube = image_cube.SHARED
+    else:
+        cube_dir = tempfile.mkdtemp(prefix="xrv124_")
+        cube = join(cube_dir,"images.npy")
+    records = None
+    try:
+        with pool as executor:
+            print("Reading beam files...")
+            with timing.stage("read beam files"):
+                records = xan.load_beams(directory, beams, executor, cube,
+                                         gantry_angles, energies)
+            full_analysis(gantry_angles, energies, op1, op2, 
+                          records, gantry_name, adate, atime,
+                          comment, result_dir, executor)
+    except BaseException as e:
+        # Views of the cube held by the frames of the traceback would keep
+        # its file open, and on Windows stop it being removed
+        traceback.clear_frames(e.__traceback__)
+        raise
+    finally:
+        # Views must go before the cube is closed; frees the shared memory too
+        records = None
+        image_cube.close()
+        if cube_dir is not None:
+            shutil.rmtree(cube_dir, ignore_errors=True)
+        # Timings and memory of this session, even if it failed, must not
+        # appear in the reports of the next
+        timing.reset()
+        memprofile.reset()
+    return result_dir
+
+
+
 def main():
 
     # User GUI input
+    import gui
     gui_input = gui.gui()  
     directory = gui_input["datadir"]
     gantry_name = gui_input["gantry"]
@@ -218,33 +399,15 @@ def main():
     energies_in = gui_input["energies"]
     comment = gui_input["comment"]
 
-    # Make energies and GA lists from input; ensure -180 < ga < 180
-    energies = [ int(e) for e in energies_in.split(",")  ]    
-    gas = [ int(ga) for ga in gantry_angles_in.split(",")  ]
-    gantry_angles = [ ga-360 if ga>180 else ga for ga in gas]
+    gantry_angles, energies = parse_angles_energies(gantry_angles_in, energies_in)
     
     print(f"GAs: {gantry_angles}")
     print(f"Es: {energies}")
 
-    filenames = get_filenames(directory)
-    filesok = check_files(filenames, gantry_angles, energies) 
+    result_dir = analyse_session(directory, gantry_name, operator1, operator2,
+                                 gantry_angles, energies, comment, outputdir)
     
-    # Get acquisition date and time from from Logos output.txt file
-    adate,atime=get_acquisition_date_time( join(directory,"output.txt"))
-
-    # New directory for results
-    res_dir_name = gantry_name+" "+str(adate)
-    result_dir = make_results_directory(outputdir,res_dir_name)
-    print("Results will be printed to {}".format(result_dir))
-    
-    
-    if filesok:
-        print("Full data set found")
-        beams = get_ordered_beams(filenames)
-        full_analysis(gantry_angles, energies, operator1, operator2, 
-                      directory, beams, gantry_name, adate, atime,
-                      comment, result_dir)
-    else:
+    if result_dir is None:
         msg = ("\nINCORRECT NUMBER OF FILES FOUND\n"
          "- Did you choose correct directory?\n"
          "- Are GANTRY and ENERGY correct in config.py?\n")
@@ -256,14 +419,91 @@ def main():
                 print("Exiting program")
                 exit(0)
             elif ans.lower().strip()[0]=="y":
+                import partial_analyze
                 partial_analyze.analysis()
                 ask=False
 
 
 
+def session_job(directory, kwargs):
+    """Run analyse_session for batch processing; return (status, message)"""
+    try:
+        result_dir = analyse_session(directory, **kwargs)
+    except Exception as e:
+        return "FAILED", "{}: {}".format(type(e).__name__, e)
+    if result_dir is None:
+        return "INCOMPLETE", "incorrect number of files found"
+    return "OK", result_dir
+
+
+
+def analyse_sessions(directories, sessions=1, use_cache=config.USE_IMAGE_CACHE,
+                     timed=timing.ENABLED, profile_memory=memprofile.ENABLED, **kwargs):
+    """Analyse many session directories without any dialogs, up to sessions 
+    at a time; kwargs are passed to analyse_session. Returns 
+    {directory:(status, message)}"""
+
+    set_options(True, use_cache, timed, profile_memory)
+    if sessions>1:
+        pool = ProcessPoolExecutor(max_workers=sessions, initializer=set_options,
+                                   initargs=(True, use_cache, timed, profile_memory))
+    else:
+        pool = nullcontext()
+    with pool as executor:
+        if executor is None:
+            status = [ session_job(d, kwargs) for d in directories ]
+        else:
+            futures = [ executor.submit(session_job, d, kwargs) for d in directories ]
+            status = [ f.result() for f in futures ]
+    return dict( zip(directories,status) )
+
+
+
+def cli(argv=None):
+    """Headless command-line entry point; returns exit status"""
+    parser = argparse.ArgumentParser(description="XRV-124 monthly QA analysis of one or more sessions without the GUI")
+    parser.add_argument("datadirs", nargs="+", metavar="DATADIR", help="Logos data directory of each session")
+    parser.add_argument("--gantry", required=True, choices=config.GANTRY_NAMES, help="gantry the data were acquired on")
+    parser.add_argument("--op1", default="", help="operator 1")
+    parser.add_argument("--op2", default="", help="operator 2")
+    parser.add_argument("--angles", default=config.GANTRY_ANGLE_OPTIONS[0], help="gantry angles in order of delivery (default: %(default)s)")
+    parser.add_argument("--energies", default=config.ENERGIES, help="energies in order of delivery (default: %(default)s)")
+    parser.add_argument("--outputdir", required=True, help="directory in which results directories are made")
+    parser.add_argument("--comment", default="", help="comment for database")
+    parser.add_argument("--sessions", type=int, default=1, help="number of sessions analysed at a time (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="processes used within each session (default: %(default)s)")
+    # Paired flags rather than argparse.BooleanOptionalAction (Python 3.9+)
+    parser.add_argument("--cache", dest="cache", action="store_true", default=config.USE_IMAGE_CACHE, help="use the cache of parsed spot images (default: %(default)s)")
+    parser.add_argument("--no-cache", dest="cache", action="store_false", default=config.USE_IMAGE_CACHE, help="do not use the cache of parsed spot images")
+    parser.add_argument("--timing", dest="timing", action="store_true", default=config.TIMING, help="write stage and per-beam timings to each results directory (default: %(default)s)")
+    parser.add_argument("--no-timing", dest="timing", action="store_false", default=config.TIMING, help="do not write timings")
+    parser.add_argument("--profile-memory", dest="profile_memory", action="store_true", default=config.PROFILE_MEMORY, help="write memory use of each stage and largest allocations to each results directory (slow; use --workers 1; default: %(default)s)")
+    parser.add_argument("--no-profile-memory", dest="profile_memory", action="store_false", default=config.PROFILE_MEMORY, help="do not profile memory")
+    args = parser.parse_args(argv)
+
+    gantry_angles, energies = parse_angles_energies(args.angles, args.energies)
+    print(f"GAs: {gantry_angles}")
+    print(f"Es: {energies}")
+
+    status = analyse_sessions(args.datadirs, args.sessions, args.cache, args.timing, args.profile_memory,
+                              gantry_name=args.gantry, op1=args.op1, op2=args.op2,
+                              gantry_angles=gantry_angles, energies=energies,
+                              comment=args.comment, outputdir=args.outputdir,
+                              workers=args.workers)
+
+    print("\nSummary:")
+    for d in args.datadirs:
+        print("  {:10} {} -> {}".format(status[d][0], d, status[d][1]))
+    return 0 if all( s[0]=="OK" for s in status.values() ) else 1
+
+
+
 
 
 if __name__=="__main__":
+    # Any arguments: headless command line; otherwise GUI
+    if len(sys.argv)>1:
+        sys.exit( cli() )
     main()
 
 
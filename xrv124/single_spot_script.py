@@ -1,8 +1,7 @@
 from os.path import join
 import numpy as np
-from skimage.measure import label, regionprops#, profile_line
-import matplotlib.pyplot as plt
-import easygui
+
+from full_analyze import get_image_data
 
 ################################################################
 #
@@ -24,29 +23,6 @@ THRESHOLD = 50.0
 
 
 
-def get_image_data(filename):
-    """Return image numpy array of image plus pitch (pixel size)
-    """
-    
-    spotdata = open(filename).readlines()
-
-    # Image pitch (pixel width) is in first line
-    pitch = float( spotdata[0].split("Pitch:,")[1].split(",")[0].strip() )
-
-    # 3rd line contains image dimension - ALWAYS??      ##TODO: CHECK CORRECT FOR NON-SQUARE IMAGES
-    nrows = int( spotdata[2].split(",")[1].strip() )    # or is this x dim => no. columns?
-    ncols = int( spotdata[2].split(",")[2].strip() )    # y dim => no. rows?
-    
-    spotimage = np.zeros( [nrows,ncols] )   ## format np([rows,cols])  
-
-    for row in range(3,nrows+3): # Image data starts on fourth row
-        spotimage[row-3] = np.array( spotdata[row].split(",") ).astype(float)
-
-    return spotimage, pitch
-
-
-
-
 def print_spot_diameter(spotfile, spot="Entry"):
     """Retrieve entry spot "diameter" from csv file
     """  
@@ -94,6 +70,9 @@ def print_arc_radial_widths(spotfile, spot="Entry"):
 def print_shifts(beamname):
     """Print x,y shifts in BEV coords of exit spot from BB shadown
     """
+    # Slow imports; made here so the file dialog opens quickly
+    from skimage.measure import label, regionprops#, profile_line
+    import matplotlib.pyplot as plt
 
     entry, pitch_en = get_image_data( join(beamname+".csv" ) )
     exit, pitch_ex  = get_image_data( join(beamname+".txt" ) )
@@ -111,8 +90,8 @@ def print_shifts(beamname):
     plt.title( "Entry spot" )
     plt.show()
 
-    # subtract exit spot from entry spot
-    sub = entry - exit
+    # subtract exit spot from entry spot; images are uint8 so subtract as float
+    sub = np.subtract(entry, exit, dtype=np.float32)
     # float images must be between -1 and 1
     sub = sub / sub.max() 
 
@@ -139,6 +118,7 @@ def print_shifts(beamname):
     print( f"    x={shift_mm[0]}, y={-shift_mm[1]}" )
 
     #Plot centre of image and centroid of ball-bearing shadow
+    exit = exit.astype(np.float32)
     exit[imagecentre[1]][imagecentre[0]] = -0.99
     exit[shadowcentre[1]][shadowcentre[0]] = -0.99
     plt.ylabel("BEV  Y  --->", fontsize=16)
@@ -239,6 +219,7 @@ def print_pixel_stats(spotfile):
 
 if __name__=="__main__":
     
+    import easygui
     #myfile = easygui.fileopenbox(msg="Choose a beamfile", default=r"C:\pathtofiles")
     beamfile = str(easygui.fileopenbox(msg="Choose a beamfile"))
     beampath = rm_ext(beamfile)
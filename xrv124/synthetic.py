@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Logos XRV-124 sessions with known results, for benchmarks and for
+checking the analysis without the sample data.
+
+Each beam has an entry (.csv) and exit (.txt) spot file in Logos format plus
+an empty .bmp, and the session has an output.txt giving the acquisition time,
+so a session can be analysed exactly like a real one. Spots are 2D Gaussians
+centred in the image. The exit spot has the shadow of the ball bearing,
+displaced from the image centre by the injected shift. The injected results
+are saved in truth.json, in the form returned by full_analyze (shifts in
+IMAGE coordinates), and are read back with read_truth().
+
+Usage: python synthetic.py outputdir [--angles 180,90,0,-90] [--size 600]
+       [--noise 1.0] [--peak 200] [--sessions 1] [--seed 0]
+A peak grey value above 255 gives saturated (clipped) spots.
+"""
+
+import json
+import argparse
+from os import makedirs
+from os.path import join
+
+import numpy as np
+
+import config
+from results import BeamResults, SHIFT_FIELDS, SHIFT_3D_FIELDS, DIAMETER_FIELDS, SIGMA_FIELDS, ARC_RADIAL_FIELDS
+
+
+# Ratio of FWHM to sigma of a Gaussian
+FWHM = 2*np.sqrt(2*np.log(2))
+
+# Fields of each result in truth.json
+TRUTH_FIELDS = {"shifts":SHIFT_FIELDS, "shifts_3d":SHIFT_3D_FIELDS,
+                "spot_diameters":DIAMETER_FIELDS, "spot_sigmas":SIGMA_FIELDS,
+                "arc_radial":ARC_RADIAL_FIELDS}
+
+
+
+def gaussian_spot(shape, centre, sigmas, peak):
+    """Return image of 2D Gaussian spot; centre (x,y) and sigmas (x,y) in
+    pixels"""
+    y = np.arange(shape[0])[:,np.newaxis]
+    x = np.arange(shape[1])[np.newaxis,:]
+    return ( peak * np.exp( -(x-centre[0])**2/(2*sigmas[0]**2) )
+                  * np.exp( -(y-centre[1])**2/(2*sigmas[1]**2) ) )
+
+
+
+def bb_transmission(shape, centre, radius, depth=0.5):
+    """Return fraction of beam transmitted through ball bearing centred at
+    (x,y) pixels; attenuation is proportional to path length through it"""
+    y = np.arange(shape[0])[:,np.newaxis]
+    x = np.arange(shape[1])[np.newaxis,:]
+    r2 = ( (x-centre[0])**2 + (y-centre[1])**2 ) / radius**2
+    return 1 - depth*np.sqrt( np.clip(1-r2, 0, None) )
+
+
+
+def to_grey(img, noise, rng):
+    """Add Gaussian noise and round to 8-bit grey values, clipping any
+    saturated pixels"""
+    if noise>0:
+        img = img + rng.normal(0, noise, img.shape)
+    return np.round(img).clip(0,255).astype(int)
+
+
+
+def write_spot_file(filename, img, pitch, diameter, arc=None, radial=None, beamdata=None):
+    """Write spot image in Logos format (as read by full_analyze.parse_spot_file)"""
+    with open(filename,"w") as f:
+        f.write("Diameter:,{:.2f},mm,Pitch:,{},mm\n".format(diameter, pitch))
+        f.write("Synthetic XRV-124 spot\n")
+        f.write("Size,{},{}\n".format(*img.shape))
+        np.savetxt(f, img, fmt="%d", delimiter=",")
+        if arc is not None:
+            f.write("Arc Style,Width,Entry (mm):,{:.2f},Exit (mm):,{:.2f}\n".format(arc, arc))
+            f.write("Radial Style,Width,Entry (mm):,{:.2f},Exit (mm):,{:.2f}\n".format(radial, radial))
+        if beamdata is not None:
+            f.write(beamdata+"\n")
+
+
+
+def beam_data_line(p1, p2, gray, exit_gray):
+    """Return "XRV Beam Data" line of entry (p1) and exit (p2) spot centres"""
+    return "XRV Beam Data,1,{:.3f},{:.3f},{:.3f},2,{:.3f},{:.3f},{:.3f},Gray,{},ExitGray,{}".format(
+                                *p1, *p2, gray, exit_gray)
+
+
+
+def beam_spot_centres(ga, shift_3d, target, length=100.0):
+    """Return centres (Logos coords, mm) of entry and exit spots of a beam at
+    gantry angle ga that misses target by -shift_3d (perpendicular to beam)"""
+    direction = np.array( [np.cos(np.radians(ga)), np.sin(np.radians(ga)), 0.0] )
+    closest = np.asarray(target) - shift_3d
+    return closest - length*direction, closest + length*direction
+
+
+
+def energy_sigma(en, sigma_min=3.0, sigma_max=6.5):
+    """Typical spot sigma (mm), which falls with energy"""
+    return sigma_max - (sigma_max-sigma_min)*(np.clip(en,70,245)-70)/175.0
+
+
+
+def make_session(directory, gantry_angles, energies, size=600, pitch=0.1,
+                 shift_sd=0.5, noise=1.0, peak=200.0, bb_radius=1.5,
+                 acq_datetime="2020-01-02 10:11:12", target=config.TARGET, seed=0):
+    """Write synthetic session to directory; return dict of injected results
+    (BeamResults), also saved in truth.json
+
+    size is the image size in pixels, either n or (nrows,ncols); shift_sd is
+    the standard deviation of the injected shifts (mm); noise is the standard
+    deviation of the grey values; spots with peak>255 are saturated.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (size,size) if np.isscalar(size) else tuple(size)
+    nrows, ncols = shape
+    makedirs(directory, exist_ok=True)
+
+    # Shifts are measured from the image centre (full_analyze.beam_shift)
+    centre = ( ncols//2, nrows//2 )
+    truth = {name:[] for name in TRUTH_FIELDS}
+    beam_id = 0
+    for ga in gantry_angles:
+        for en in energies:
+            beam_id += 1
+            shift = rng.normal(0, shift_sd, 2)
+            sigmas = energy_sigma(en) + rng.normal(0, 0.1, 2)
+            sigmas_px = sigmas/pitch
+
+            spot = gaussian_spot(shape, centre, sigmas_px, peak)
+            # Ball bearing shadow at image centre - shift
+            bb = ( centre[0]-shift[0]/pitch, centre[1]-shift[1]/pitch )
+            entry = to_grey(spot, noise, rng)
+            exit = to_grey(spot*bb_transmission(shape, bb, bb_radius/pitch), noise, rng)
+
+            # Equivalent diameter of spot above 50% of max, as given by Logos
+            diameter = round( FWHM*np.sqrt(sigmas[0]*sigmas[1]), 2 )
+            arc, radial = round(FWHM*sigmas[0], 2), round(FWHM*sigmas[1], 2)
+            shift_3d = np.array( [-np.sin(np.radians(ga))*shift[0], np.cos(np.radians(ga))*shift[0], shift[1]] )
+            p1, p2 = beam_spot_centres(ga, shift_3d, target)
+            beamdata = beam_data_line(p1, p2, entry.max(), exit.max())
+
+            write_spot_file(join(directory,str(beam_id)+".csv"), entry, pitch, diameter, arc, radial, beamdata)
+            write_spot_file(join(directory,str(beam_id)+".txt"), exit, pitch, diameter, arc, radial, beamdata)
+            open(join(directory,str(beam_id)+".bmp"),"w").close()
+
+            truth["shifts"].append(shift)
+            truth["shifts_3d"].append(shift_3d)
+            truth["spot_diameters"].append(diameter)
+            truth["spot_sigmas"].append(sigmas)
+            truth["arc_radial"].append( (arc,radial) )
+
+    adate, atime = acq_datetime.split()
+    year, month, day = adate.split("-")
+    with open(join(directory,"output.txt"),"w") as f:
+        f.write("Time, {} {}/{}/{}\n".format(atime, month, day, year))
+
+    truth = { name:BeamResults.from_beams(gantry_angles, energies, values, TRUTH_FIELDS[name])
+              for name,values in truth.items() }
+    with open(join(directory,"truth.json"),"w") as f:
+        json.dump( {name:res.to_dict() for name,res in truth.items()}, f )
+    return truth
+
+
+
+def read_truth(directory):
+    """Return dict of injected results (BeamResults) of synthetic session"""
+    with open(join(directory,"truth.json")) as f:
+        truth = json.load(f)
+    return { name:BeamResults.from_dict(res, TRUTH_FIELDS[name]) for name,res in truth.items() }
+
+
+
+def max_errors(results, truth):
+    """Return {name: max absolute difference} between analysed results and
+    truth for the results present in both"""
+    return { name:float( np.nanmax(np.abs(results[name].values-truth[name].values)) )
+             for name in results if name in truth }
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic Logos XRV-124 sessions")
+    parser.add_argument("outputdir", help="session directory (or parent directory if --sessions > 1)")
+    parser.add_argument("--angles", default=config.GANTRY_ANGLE_OPTIONS[2], help="gantry angles (default: %(default)s)")
+    parser.add_argument("--energies", default=config.ENERGIES, help="energies (default: all)")
+    parser.add_argument("--size", type=int, nargs="+", default=[600], help="image size in pixels, n or nrows ncols (default: 600)")
+    parser.add_argument("--pitch", type=float, default=0.1, help="pixel size in mm (default: %(default)s)")
+    parser.add_argument("--shift-sd", type=float, default=0.5, help="sd of injected shifts in mm (default: %(default)s)")
+    parser.add_argument("--noise", type=float, default=1.0, help="sd of noise in grey values (default: %(default)s)")
+    parser.add_argument("--peak", type=float, default=200.0, help="peak grey value; >255 saturates (default: %(default)s)")
+    parser.add_argument("--sessions", type=int, default=1, help="number of sessions (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: %(default)s)")
+    args = parser.parse_args()
+
+    gantry_angles = [ int(ga) for ga in args.angles.split(",") ]
+    energies = [ int(e) for e in args.energies.split(",") ]
+    size = args.size[0] if len(args.size)==1 else args.size[:2]
+    for n in range(args.sessions):
+        directory = args.outputdir if args.sessions==1 else join(args.outputdir,"session{}".format(n+1))
+        make_session(directory, gantry_angles, energies, size, args.pitch, args.shift_sd,
+                     args.noise, args.peak, seed=args.seed+n,
+                     acq_datetime="2020-01-{:02d} 10:11:12".format(n%28+1))
+        print("Wrote {} beams to {}".format(len(gantry_angles)*len(energies), directory))
+
+
+
+if __name__=="__main__":
+    main()
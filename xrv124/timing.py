@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of the stages of an analysis and of each per-beam operation.
+
+Stages are timed with
+    with timing.stage("shifts"):
+        ...
+and per-beam functions with the @timing.per_beam decorator. Nothing is
+recorded unless ENABLED (config.TIMING, or --timing on the command line),
+in which case a summary table, a table of per-beam times and a trace that
+can be opened in chrome://tracing or https://ui.perfetto.dev are written
+to the results directory.
+
+Stages are also the points at which memory is recorded by memprofile.py
+when it is enabled.
+
+Events are kept in the Chrome trace event format: "complete" events
+("ph":"X") with start ("ts") and duration ("dur") in microseconds.
+"""
+
+import os
+import csv
+import json
+import time
+import threading
+import functools
+from contextlib import nullcontext
+from os.path import join
+
+import config
+import memprofile
+
+
+ENABLED = config.TIMING
+# Also write trace.json of all events
+TRACE = config.TIMING_TRACE
+
+# Events recorded in this process
+_events = []
+
+_NULL = nullcontext()
+
+
+
+def record(name, category, t0, t1, args=None):
+    """Record event lasting from t0 to t1 (time.perf_counter, s)"""
+    _events.append( {"name":name, "cat":category, "ph":"X", "ts":t0*1e6,
+                     "dur":(t1-t0)*1e6, "pid":os.getpid(),
+                     "tid":threading.get_ident(), "args":args or {}} )
+
+
+
+class _Timer:
+    """Context manager recording its duration as an event, and the memory
+    used at its start and end if memory profiling is on"""
+    __slots__ = ("name", "category", "args", "t0")
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        if memprofile.ENABLED:
+            memprofile.begin(self.name)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if ENABLED:
+            record(self.name, self.category, self.t0, time.perf_counter(), self.args)
+        if memprofile.ENABLED:
+            memprofile.end(self.name)
+
+
+
+def stage(name, **args):
+    """Context manager timing a stage of the analysis; does nothing unless
+    ENABLED or memory profiling is on"""
+    if not ENABLED and not memprofile.ENABLED:
+        return _NULL
+    return _Timer(name, "stage", args)
+
+
+
+def per_beam(beam):
+    """Decorator timing each call of a per-beam function
+
+    beam is called with the function's arguments and returns a dict
+    identifying the beam, e.g. {"beam":"12", "ga":90, "en":70}
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(func.__name__, "beam", t0, time.perf_counter(), beam(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+
+def collect(func, *args):
+    """Return (func(*args), events recorded during the call) with timing
+    enabled; used to bring back the events of worker processes"""
+    global ENABLED
+    ENABLED = True
+    start = len(_events)
+    result = func(*args)
+    events = _events[start:]
+    del _events[start:]
+    return result, events
+
+
+
+def add_events(events):
+    """Add events recorded elsewhere, e.g. in a worker process"""
+    _events.extend(events)
+
+
+
+def reset():
+    """Forget all events"""
+    del _events[:]
+
+
+
+def summary(events=None):
+    """Return rows of (name, category, calls, total, mean, max) in seconds,
+    in order of first start"""
+    events = _events if events is None else events
+    durations = {}
+    for e in sorted(events, key=lambda e: e["ts"]):
+        durations.setdefault( (e["name"],e["cat"]), [] ).append( e["dur"]/1e6 )
+    return [ (name, cat, len(d), sum(d), sum(d)/len(d), max(d))
+             for (name,cat),d in durations.items() ]
+
+
+
+def beam_table(events=None):
+    """Return (operations, rows) of per-beam times (s); each row is
+    [beam, ga, en, time of each operation]"""
+    events = _events if events is None else events
+    beams = {}
+    operations = []
+    for e in events:
+        if e["cat"]!="beam":
+            continue
+        if e["name"] not in operations:
+            operations.append(e["name"])
+        beam = beams.setdefault( e["args"]["beam"], {"ga":None, "en":None} )
+        for key in ("ga","en"):
+            if e["args"].get(key) is not None:
+                beam[key] = e["args"][key]
+        beam[e["name"]] = beam.get(e["name"],0) + e["dur"]/1e6
+    rows = [ [b, t["ga"], t["en"]] + [ t.get(op) for op in operations ]
+             for b,t in sorted(beams.items(), key=lambda bt: int(bt[0])) ]
+    return operations, rows
+
+
+
+def format_summary(events=None):
+    """Return summary table as text"""
+    lines = [ "{:28} {:>6} {:>10} {:>10} {:>10}".format("Stage / operation", "Calls",
+                                                          "Total (s)", "Mean (ms)", "Max (ms)") ]
+    for name, cat, calls, total, mean, longest in summary(events):
+        label = name if cat=="stage" else "  "+name+" (per beam)"
+        lines.append( "{:28} {:6d} {:10.3f} {:10.2f} {:10.2f}".format(label, calls, total,
+                                                                  1000*mean, 1000*longest) )
+    return "\n".join(lines)
+
+
+
+def write_trace(filename, events=None):
+    """Write events as Chrome/Perfetto trace JSON"""
+    events = _events if events is None else events
+    with open(filename,"w") as f:
+        json.dump( {"traceEvents":events, "displayTimeUnit":"ms"}, f )
+
+
+
+def write_reports(directory, trace=None):
+    """Print summary and write timing_summary.txt, timing_beams.csv and
+    (if trace, default TRACE) trace.json to directory"""
+    text = format_summary()
+    print(text)
+    with open(join(directory,"timing_summary.txt"),"w") as f:
+        f.write(text+"\n")
+
+    operations, rows = beam_table()
+    with open(join(directory,"timing_beams.csv"),"w",newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow( ["Beam","GA","Energy"] + [ op+" (ms)" for op in operations ] )
+        for row in rows:
+            writer.writerow( row[:3] + [ None if t is None else round(1000*t,3) for t in row[3:] ] )
+
+    if trace or (trace is None and TRACE):
+        write_trace( join(directory,"trace.json") )
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Watch mode: analyse each beam while the session is being acquired.
+
+The Logos data directory is polled for numeric .csv (entry) and .txt (exit)
+spot files. A beam is analysed as soon as both of its files exist and their
+sizes have not changed since the previous poll. Beams are matched to the
+expected gantry angle and energy order in ascending beam ID order, exactly
+as in run.py, so a beam is only analysed once every beam with a lower ID
+has been. Beams already in the directory when watching starts are ignored,
+or analysed first if WATCH_EXISTING (for starting partway through a
+session). Only the small per-beam results are kept in memory. When
+the last beam has been analysed the plots, PDF report and database export
+are produced as for a full analysis.
+
+Usage: python watch.py  (start it before the session, or during it with
+WATCH_EXISTING = True in config.py)
+"""
+
+import time
+from os import listdir, stat
+from os.path import join, isfile, splitext
+
+import full_analyze as xan
+import run
+import config
+import database as db
+from results import BeamResults, SHIFT_FIELDS, DIAMETER_FIELDS, SIGMA_FIELDS, ARC_RADIAL_FIELDS
+
+
+POLL = config.WATCH_POLL
+TIMEOUT = config.WATCH_TIMEOUT
+EXISTING = config.WATCH_EXISTING
+
+
+
+def spot_file_sizes(directory):
+    """Return {beam_id:(csv size,txt size)} of beams having a spot file; the
+    size of a file not (yet) written is None"""
+    sizes = {}
+    for f in listdir(directory):
+        name, ext = splitext(f)
+        if str.isdigit(name) and ext in (".csv",".txt"):
+            try:
+                sizes.setdefault(name,{})[ext] = stat(join(directory,f)).st_size
+            except OSError:
+                # File removed or renamed between listdir and stat
+                pass
+    return { b:(s.get(".csv"),s.get(".txt")) for b,s in sizes.items() }
+
+
+
+def analyse_beam(record, ga, en):
+    """Return dict of results for a single beam; images are not kept
+
+    Spot profiles are returned instead of sigmas if SIGMA_FIT="batch" so
+    that they can be fitted together once the session is complete
+    """
+    result = {"shift":xan.beam_shift(record, ga, en),
+              "diameter":record.diameter,
+              "arc_radial":(record.arc, record.radial),
+              "pitch":record.pitch}
+    if xan.SIGMA_FIT=="batch":
+        result["profiles"] = xan.beam_profiles(record, ga, en)
+    else:
+        result["sigmas"] = xan.beam_sigmas(record, ga, en)
+    return result
+
+
+
+def collect_results(gantry_angles, energies, beam_results):
+    """Combine list of per-beam results, in order of delivery, into the 
+    dict of BeamResults used by run.report_results (shifts in image 
+    coordinates)"""
+    if xan.SIGMA_FIT=="batch":
+        flat = [ p for r in beam_results for p in r["profiles"] ]
+        pitches = [ r["pitch"] for r in beam_results for i in range(2) ]
+        fitted = xan.sigmas_from_gaussian_batch(flat, pitches)
+        sigmas = [ (fitted[2*i], fitted[2*i+1]) for i in range(len(beam_results)) ]
+        for x_sigma, y_sigma in sigmas:
+            xan.check_sigmas(x_sigma, y_sigma)
+    else:
+        sigmas = [ r["sigmas"] for r in beam_results ]
+
+    def combine(name, fields):
+        return BeamResults.from_beams(gantry_angles, energies, 
+                                      [r[name] for r in beam_results], fields)
+
+    return {"shifts":combine("shift", SHIFT_FIELDS),
+            "spot_diameters":combine("diameter", DIAMETER_FIELDS),
+            "spot_sigmas":BeamResults.from_beams(gantry_angles, energies, sigmas, SIGMA_FIELDS),
+            "arc_radial":combine("arc_radial", ARC_RADIAL_FIELDS)}
+
+
+
+def watch(directory, gantry_angles, energies, poll=POLL, timeout=TIMEOUT,
+          existing=EXISTING):
+    """Analyse beams in directory as they are acquired
+
+    Beams already in directory are ignored unless existing, when they are
+    taken as the first beams of the session. Returns the results dict once
+    all GA*E beams are analysed, or None if no new beam appears for timeout
+    seconds
+    """
+    expected = [ (ga,en) for ga in gantry_angles for en in energies ]
+    beam_results = []
+    previous = {}
+    last_beam = time.time()
+
+    # Unless they are of this session, beams of an earlier session must not
+    # take the GA/E of this one
+    found = spot_file_sizes(directory)
+    last_id = -1
+    if found and existing:
+        print("Analysing {} beams already in {} first".format(len(found), directory))
+    elif found:
+        last_id = max( [int(b) for b in found] )
+        print("WARNING: ignoring {} beams already in {} (IDs up to {}); set "
+              "WATCH_EXISTING = True to analyse them".format(len(found), directory, last_id))
+
+    print("Watching {} for {} beams...".format(directory, len(expected)))
+    while len(beam_results)<len(expected):
+        sizes = spot_file_sizes(directory)
+        new = sorted( [b for b in sizes if int(b)>last_id], key=lambda e: int(e) )
+
+        # Analyse in order of delivery, stopping at the first beam that is
+        # not complete (both files, size unchanged since last poll) so that
+        # a later beam never takes its GA/E
+        for beam_id in new:
+            if not all(sizes[beam_id]) or previous.get(beam_id)!=sizes[beam_id]:
+                break
+            if len(beam_results)==len(expected):
+                print("WARNING: more beams than expected; ignoring beam {}".format(beam_id))
+                last_id = int(beam_id)
+                continue
+            try:
+                record = xan.load_beam(directory, beam_id)
+            except (ValueError, IndexError):
+                # Still being written; try again on next poll
+                break
+            ga, en = expected[len(beam_results)]
+            beam_results.append( analyse_beam(record, ga, en) )
+            last_id = int(beam_id)
+            last_beam = time.time()
+            print("Beam {} -> GA={}, E={} ({}/{})".format(beam_id, ga, en, 
+                                                       len(beam_results), len(expected)))
+        previous = sizes
+
+        if len(beam_results)<len(expected):
+            if time.time()-last_beam > timeout:
+                print("\nNo new beam for {} s; {} of {} beams analysed".format(
+                                        timeout, len(beam_results), len(expected)))
+                return None
+            time.sleep(poll)
+
+    return collect_results(gantry_angles, energies, beam_results)
+
+
+
+def wait_for_acquisition_date_time(directory, poll=POLL, timeout=TIMEOUT):
+    """Return acquisition date and time from Logos output.txt, waiting for
+    it to be written. Current date and time are used if it never appears"""
+    outputfile = join(directory,"output.txt")
+    t0 = time.time()
+    while time.time()-t0 < timeout:
+        if isfile(outputfile):
+            try:
+                return run.get_acquisition_date_time(outputfile)
+            except ValueError:
+                # Incomplete file
+                pass
+        time.sleep(poll)
+    print("WARNING: output.txt not found; using current date and time")
+    return time.strftime("%Y-%m-%d"), time.strftime("%H:%M:%S")
+
+
+
+def main():
+
+    # User GUI input
+    import gui
+    gui_input = gui.gui()
+    directory = gui_input["datadir"]
+    gantry_name = gui_input["gantry"]
+    outputdir = gui_input["outputdir"]
+    operator1 = gui_input["op1"]
+    operator2 = gui_input["op2"]
+    comment = gui_input["comment"]
+
+    gantry_angles, energies = run.parse_angles_energies(gui_input["angles"],
+                                                        gui_input["energies"])
+    print(f"GAs: {gantry_angles}")
+    print(f"Es: {energies}")
+
+    db.test_db_connection()
+
+    results = watch(directory, gantry_angles, energies)
+    if results is None:
+        print("Incomplete session; use run.py for a partial analysis")
+        return
+    run.image_to_bev(results["shifts"])
+
+    adate,atime = wait_for_acquisition_date_time(directory)
+
+    # New directory for results
+    res_dir_name = gantry_name+" "+str(adate)
+    result_dir = run.make_results_directory(outputdir,res_dir_name)
+    print("Results will be printed to {}".format(result_dir))
+
+    run.report_results(operator1, operator2, results, gantry_name, adate, 
+                       atime, comment, result_dir)
+
+
+
+
+
+if __name__=="__main__":
+    main()